@@ -0,0 +1,115 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+import features
+
+
+ARTIST_BUDGET = 0.3
+
+
+class ArtistStage:
+
+    def __init__(self, get_spotify, budget=ARTIST_BUDGET, workers=4):
+        """
+        Этап признаков исполнителя для расширенной модели. Для пачки треков берет их исполнителей
+        (Spotify.get_tracks_artists) и подписчиков с популярностью (Spotify.get_artists_info) - оба метода
+        пакетные и с кэшем, так что повторные треки и исполнители в Spotify не ходят.
+
+        Этап запускается в фоне одновременно с запросом аудио фич и ждется не дольше budget секунд
+        от запуска. Не успел - предсказание считается базовой моделью, а этап все равно доделывается
+        и кладет ответы в кэш, так что следующий запрос про тех же исполнителей уже уложится.
+        Если все workers заняты недоделанными этапами (Spotify тормозит), новые не ставятся в очередь за ними -
+        запрос сразу считается базовой моделью.
+
+        :param get_spotify:     callable без аргументов -> spotipy_framework.Spotify
+        :param budget:          float / сколько секунд от запуска этапа можно ждать его результат
+        :param workers:         int / сколько этапов может идти одновременно
+        """
+
+        self.get_spotify = get_spotify
+        self.budget = budget
+        self.workers = workers
+
+        self.requests = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.rejected = 0
+        self.in_flight = 0
+
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='artist-features')
+        self._lock = threading.Lock()
+
+    def fetch(self, track_ids):
+        """
+        Синхронно достает признаки исполнителей, без бюджета
+
+        :param track_ids:   list айди треков
+        :return:            np.ndarray из features.encode_artists в порядке track_ids
+        """
+
+        spotify = self.get_spotify()
+        tracks_artists = spotify.get_tracks_artists(track_ids)
+        artist_ids = list({artist_id for artist_ids in tracks_artists.values() for artist_id in artist_ids})
+        artists = spotify.get_artists_info(artist_ids) if artist_ids else {}
+        return features.encode_artists([[artists[artist_id] for artist_id in tracks_artists.get(track_id, [])
+                                         if artist_id in artists]
+                                        for track_id in track_ids])
+
+    def _done(self, future):
+        with self._lock:
+            self.in_flight -= 1
+
+    def submit(self, track_ids):
+        """
+        Запускает fetch в фоне
+
+        :param track_ids:   list айди треков
+        :return:            объект для result() или None, если все workers заняты
+        """
+
+        with self._lock:
+            self.requests += 1
+            if self.in_flight >= self.workers:
+                self.rejected += 1
+                return None
+            self.in_flight += 1
+        future = self._executor.submit(self.fetch, track_ids)
+        future.add_done_callback(self._done)
+        return future, time.monotonic()
+
+    def result(self, pending):
+        """
+        Ждет результат submit() до конца бюджета
+
+        :param pending:     то, что вернул submit()
+        :return:            np.ndarray из features.encode_artists или None, если не уложились в бюджет или упали
+        """
+
+        future, started = pending
+        try:
+            return future.result(max(self.budget - (time.monotonic() - started), 0))
+        except TimeoutError:
+            with self._lock:
+                self.timeouts += 1
+        except Exception as error:
+            with self._lock:
+                self.errors += 1
+            print(f'!!! Artist features failed: {error!r}')
+        return None
+
+    def stats(self):
+        """
+        :return:    словарь: requests, timeouts, errors, rejected, in_flight, timeout_rate
+        """
+
+        with self._lock:
+            return {'requests': self.requests,
+                    'timeouts': self.timeouts,
+                    'errors': self.errors,
+                    'rejected': self.rejected,
+                    'in_flight': self.in_flight,
+                    'timeout_rate': self.timeouts / self.requests if self.requests else 0.0}
+
+    def close(self):
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,317 @@
+import asyncio
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import predictor
+from single_flight import AsyncSingleFlight
+from spotipy_framework import normalize_query
+
+
+class AsyncSpotify:
+
+    def __init__(self, get_spotify, executor):
+        """
+        Асинхронная обертка над spotipy_framework.Spotify: любой метод Spotify можно await-ить.
+        Объект Spotify берется из get_spotify на каждом вызове, так что клиент можно создавать лениво.
+        spotipy блокирующий, поэтому сами запросы уходят в пул потоков executor, а event loop не ждет сеть.
+
+        :param get_spotify:     callable без аргументов, возвращает spotipy_framework.Spotify
+        :param executor:        concurrent.futures.Executor для блокирующих запросов
+        """
+
+        self.get_spotify = get_spotify
+        self.executor = executor
+
+    def __getattr__(self, name):
+        async def call(*args, **kwargs):
+            bound = getattr(self.get_spotify(), name)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(bound, *args, **kwargs))
+
+        return call
+
+
+service_seconds = {stage: metrics.histogram('service_stage_seconds', 'Time spent in prediction service stages',
+                                            stage=stage)
+                   for stage in ('queue', 'predict', 'reply', 'total')}
+service_results = {result: metrics.counter('service_requests_total', 'Prediction service requests by result',
+                                           result=result)
+                   for result in ('completed', 'failed')}
+inline_results = {result: metrics.counter('service_inline_queries_total', 'Inline queries by result', result=result)
+                  for result in ('processed', 'superseded', 'rejected')}
+
+
+class PredictionService:
+
+    def __init__(self, spotify=None, io_workers=32, inference_workers=4, max_in_flight=64, per_chat_in_flight=2,
+                 debounce=0.3):
+        """
+        Асинхронный конвейер предсказаний для бота. Event loop крутится в отдельном потоке,
+        поиск и аудио фичи запрашиваются через AsyncSpotify, модель считается в отдельном
+        ограниченном пуле, чтобы тяжелый predict_proba не занимал потоки под сеть.
+        Одновременно в работе не больше max_in_flight запросов и не больше per_chat_in_flight на один чат,
+        так что один активный чат не забивает очередь остальным.
+
+        :param spotify:                 spotipy_framework.Spotify, по умолчанию predictor.get_spotify()
+        :param io_workers:              int / потоков под запросы к Spotify и отправку ответов
+        :param inference_workers:       int / потоков под модель
+        :param max_in_flight:           int / максимум запросов в работе на весь бот
+        :param per_chat_in_flight:      int / максимум запросов в работе на один чат
+        :param debounce:                float / сколько секунд ждать следующей буквы инлайн запроса,
+                                        прежде чем его обрабатывать
+        """
+
+        self.io_executor = ThreadPoolExecutor(io_workers, thread_name_prefix='spotify-io')
+        self.inference_executor = ThreadPoolExecutor(inference_workers, thread_name_prefix='inference')
+        get_spotify = predictor.get_spotify if spotify is None else lambda: spotify
+        self.spotify = AsyncSpotify(get_spotify, self.io_executor)
+        self.max_in_flight = max_in_flight
+        self.per_chat_in_flight = per_chat_in_flight
+        self.debounce = debounce
+
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.inline_processed = 0
+        self.inline_superseded = 0
+        self.inline_rejected = 0
+        self.query_flights = AsyncSingleFlight()
+        self.track_flights = AsyncSingleFlight()
+
+        self.loop = None
+        self._thread = None
+        self._global_limit = None
+        self._chats = {}
+        self._inline_latest = {}
+
+    def start(self):
+        """
+        Запускает event loop в фоновом потоке
+        """
+
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name='prediction-loop', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Останавливает loop и дожидается завершения пулов
+        """
+
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+            self.loop.close()
+            self.loop = None
+        self.io_executor.shutdown(wait=True)
+        self.inference_executor.shutdown(wait=True)
+
+    async def _fetch_and_score_ids(self, track_ids):
+        # Асинхронный аналог predictor._fetch_and_score_ids: аудио фичи через AsyncSpotify,
+        # признаки исполнителя качаются в фоне одновременно с ними, ждем их в пуле io в пределах бюджета
+        pending = await self.loop.run_in_executor(self.inference_executor, predictor._start_artists, track_ids)
+        with predictor.stage_seconds['audio_features'].time():
+            tracks_features = await self.spotify.get_audio_features(track_ids)
+        artists, cacheable = await self.loop.run_in_executor(self.io_executor, predictor._wait_artists, pending)
+        # Там же при первом обращении грузится модель, поэтому не в потоке loop-а
+        return await self.loop.run_in_executor(self.inference_executor, predictor._score_features,
+                                               track_ids, tracks_features, artists, cacheable)
+
+    async def _fetch_and_score(self, track_id):
+        return (await self._fetch_and_score_ids([track_id])).get(track_id)
+
+    async def _search_track(self, q):
+        with predictor.stage_seconds['search'].time():
+            # Индекс - это SQLite, поэтому тоже в пуле io, а не в потоке loop-а
+            index = await self.loop.run_in_executor(self.io_executor, predictor.get_track_index)
+            track = await self.loop.run_in_executor(self.io_executor, index.get, q)
+            if track is not None:
+                return track
+
+            started = time.perf_counter()
+            result = await self.spotify.search_tracks(q, limit=1)
+            index.record_search(time.perf_counter() - started)
+
+            track = predictor._top_hit(result[q])
+            await self.loop.run_in_executor(self.io_executor, index.add, q, track)
+            return track
+
+    async def _predict(self, q):
+        # Индекс новых релизов - словарь в памяти, его можно спрашивать прямо из loop-а
+        if predictor.release_index is not None:
+            prediction = predictor.release_index.lookup(q)
+            if prediction is not None:
+                return prediction
+
+        artist_name, track_name, track_id = await self._search_track(q)
+        if not track_id:
+            return None
+
+        hit_proba = predictor.prediction_cache.get(track_id)
+        if hit_proba is None:
+            hit_proba = await self.track_flights.do(track_id, self._fetch_and_score, track_id)
+            if hit_proba is None:
+                return None
+
+        return {'artist_name': artist_name,
+                'track_name': track_name,
+                'hit_proba': hit_proba}
+
+    async def _search_candidates(self, q, n):
+        # PrefixQueryCache в памяти, его можно спрашивать прямо из loop-а
+        tracks = predictor.candidates_cache.get(q, n)
+        if tracks is not None:
+            return tracks
+
+        with predictor.stage_seconds['search'].time():
+            result = await self.spotify.search_tracks(q, limit=max(predictor.CANDIDATES_SEARCH_LIMIT, n))
+        found = predictor._hits(result[q])
+        predictor.candidates_cache.put(q, found)
+        index = await self.loop.run_in_executor(self.io_executor, predictor.get_track_index)
+        await self.loop.run_in_executor(self.io_executor, index.add_many, [(None, track) for track in found])
+        return found[:n]
+
+    async def _predict_candidates(self, q, n):
+        tracks = await self._search_candidates(q, n)
+        probas, missing = predictor._cached_probas(track[2] for track in tracks)
+        if missing:
+            probas.update(await self._fetch_and_score_ids(missing))
+
+        return [{'artist_name': artist_name,
+                 'track_name': track_name,
+                 'track_id': track_id,
+                 'hit_proba': probas[track_id]}
+                for artist_name, track_name, track_id in tracks if track_id in probas]
+
+    async def predict_candidates(self, q, n):
+        """
+        Асинхронный аналог predictor.predict_candidates: один поиск, один запрос audio features
+        и один вызов модели на всех кандидатов
+
+        :param q:       str / поисковый запрос
+        :param n:       int / сколько кандидатов
+        :return:        list словарей как у predictor.predict_candidates
+        """
+
+        return await self.query_flights.do(('candidates', n, normalize_query(q)), self._predict_candidates, q, n)
+
+    async def predict(self, q):
+        """
+        Асинхронный аналог predictor.predict. Одинаковые запросы и одинаковые треки,
+        которые обрабатываются одновременно, склеиваются в один поход в Spotify и одно предсказание.
+
+        :param q:       str / поисковый запрос
+        :return:        словарь как у predictor.predict или None
+        """
+
+        return await self.query_flights.do(normalize_query(q), self._predict, q)
+
+    async def handle(self, chat_id, q, reply, on_error=None, candidates=None):
+        """
+        Обрабатывает один запрос из чата с учетом лимитов и отправляет ответ
+
+        :param chat_id:     айди чата
+        :param q:           str / поисковый запрос
+        :param reply:       callable(prediction) / блокирующая отправка ответа, вызывается в пуле io
+        :param on_error:    callable(error) / что сделать, если предсказание упало
+        :param candidates:  int / отдать в reply список предсказаний для стольких результатов поиска
+        """
+
+        # Семафоры создаются здесь, внутри loop-а, чтобы они были привязаны к нему, а не к главному потоку
+        if self._global_limit is None:
+            self._global_limit = asyncio.Semaphore(self.max_in_flight)
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = [asyncio.Semaphore(self.per_chat_in_flight), 0]
+        chat[1] += 1
+
+        started = time.perf_counter()
+        try:
+            async with chat[0]:
+                async with self._global_limit:
+                    service_seconds['queue'].observe(time.perf_counter() - started)
+                    self.in_flight += 1
+                    try:
+                        with service_seconds['predict'].time():
+                            if candidates:
+                                prediction = await self.predict_candidates(q, candidates)
+                            else:
+                                prediction = await self.predict(q)
+                        with service_seconds['reply'].time():
+                            await self.loop.run_in_executor(self.io_executor, reply, prediction)
+                        self.completed += 1
+                        service_results['completed'].inc()
+                    except Exception as error:
+                        self.failed += 1
+                        service_results['failed'].inc()
+                        print(f'!!! predict failed for {q!r}: {error!r}')
+                        if on_error is not None:
+                            await self.loop.run_in_executor(self.io_executor, on_error, error)
+                    finally:
+                        self.in_flight -= 1
+                        service_seconds['total'].observe(time.perf_counter() - started)
+        finally:
+            chat[1] -= 1
+            if not chat[1]:
+                del self._chats[chat_id]
+
+    def submit(self, chat_id, q, reply, on_error=None, candidates=None):
+        """
+        Потокобезопасно ставит запрос в очередь loop-а и сразу возвращает управление.
+        Вызывается из обработчиков python-telegram-bot.
+
+        :return:        concurrent.futures.Future
+        """
+
+        return asyncio.run_coroutine_threadsafe(self.handle(chat_id, q, reply, on_error, candidates), self.loop)
+
+    async def _handle_inline(self, user_id, q, reply, candidates, on_error, allow):
+        # Пока пользователь печатает, каждая буква - новый инлайн запрос. Обрабатываем только тот,
+        # после которого debounce секунд не было следующего, предыдущие просто остаются без ответа
+        token = object()
+        self._inline_latest[user_id] = token
+        await asyncio.sleep(self.debounce)
+        if self._inline_latest.get(user_id) is not token:
+            self.inline_superseded += 1
+            inline_results['superseded'].inc()
+            return
+        del self._inline_latest[user_id]
+        if allow is not None and not allow():
+            self.inline_rejected += 1
+            inline_results['rejected'].inc()
+            return
+
+        self.inline_processed += 1
+        inline_results['processed'].inc()
+        await self.handle(('inline', user_id), q, reply, on_error, candidates)
+
+    def submit_inline(self, user_id, q, reply, candidates, on_error=None, allow=None):
+        """
+        Инлайн запрос с debounce: потокобезопасно, сразу возвращает управление
+
+        :param user_id:     айди пользователя (debounce и лимиты - на пользователя)
+        :param q:           str / поисковый запрос
+        :param reply:       callable(predictions) / ответ на инлайн запрос, вызывается в пуле io
+        :param candidates:  int / сколько кандидатов оценивать
+        :param on_error:    callable(error)
+        :param allow:       callable() -> bool / проверка лимитов, вызывается только для запроса,
+                            который пережил debounce и действительно будет обработан
+        :return:            concurrent.futures.Future
+        """
+
+        return asyncio.run_coroutine_threadsafe(self._handle_inline(user_id, q, reply, candidates, on_error, allow),
+                                                self.loop)
+
+    def stats(self):
+        return {'in_flight': self.in_flight,
+                'completed': self.completed,
+                'failed': self.failed,
+                'active_chats': len(self._chats),
+                'inline': {'processed': self.inline_processed,
+                           'superseded': self.inline_superseded,
+                           'rejected': self.inline_rejected},
+                'flights': {'queries': self.query_flights.stats(),
+                            'tracks': self.track_flights.stats()}}
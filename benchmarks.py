@@ -0,0 +1,771 @@
+import argparse
+import contextlib
+import json
+import os
+import pickle
+import random
+import subprocess
+import tempfile
+import threading
+import time
+import timeit
+import types
+
+import numpy as np
+
+import features
+
+
+SCALER_PATH = 'ml_models/scaler.pkl'
+FOREST_PATH = 'ml_models/random_forest.pkl'
+
+# Поведение фейкового Spotify в e2e сценариях, main() переопределяет их аргументами командной строки
+FAKE_SPOTIFY = {'latency': 0.02, 'jitter': 0.01, 'rate_429': 0.01}
+SPOTIFY_RATE = 1000
+
+
+def _random_features(n, seed=0):
+    """
+    Генерирует синтетические аудио фичи в тех же диапазонах, что отдает Spotify
+
+    :param n:           количество треков
+    :param seed:        seed генератора
+    :return:            список словарей с фичами
+    """
+
+    rnd = random.Random(seed)
+    tracks = []
+    for _ in range(n):
+        tracks.append({'danceability': rnd.random(),
+                       'energy': rnd.random(),
+                       'loudness': rnd.uniform(-30, 0),
+                       'mode': rnd.randint(0, 1),
+                       'speechiness': rnd.random(),
+                       'acousticness': rnd.random(),
+                       'instrumentalness': rnd.random() ** 4,
+                       'liveness': rnd.random(),
+                       'valence': rnd.random(),
+                       'tempo': rnd.uniform(60, 200),
+                       'duration_ms': rnd.randint(90000, 360000),
+                       'key': rnd.randint(-1, 11),
+                       'time_signature': rnd.randint(1, 5)})
+    return tracks
+
+
+def _legacy_matrix(track_features, scaler):
+    """
+    Старый pandas-вариант подготовки признаков (_create_df + _preprocess_df), оставлен как эталон для сравнения
+    """
+
+    import pandas as pd
+
+    columns = {column: [track_features[column]] for column in features.RAW_COLUMNS}
+    for key in range(1, 12):
+        columns[f'key_{key}'] = [1 if track_features['key'] == key else 0]
+    for ts in range(3, 6):
+        columns[f'time_signature_{ts}'] = [1 if track_features['time_signature'] == ts else 0]
+    df = pd.DataFrame(columns)
+
+    numerical = list(features.NUMERICAL_COLUMNS)
+    df['duration_ms'] = (df['duration_ms'] + 1).apply(np.log)
+    df['instrumentalness'] = (df['instrumentalness'] + 1).apply(np.log)
+    df['liveness'] = (df['liveness'] + 1).apply(np.log)
+    df['speechiness'] = (df['speechiness'] + 1).apply(np.log)
+    df[numerical] = scaler.transform(df[numerical])
+    return df
+
+
+def _load_forest(sample):
+    if os.path.exists(FOREST_PATH):
+        with open(FOREST_PATH, 'rb') as file:
+            return pickle.load(file)
+
+    from sklearn.ensemble import RandomForestClassifier
+    print(f'{FOREST_PATH} not found, using synthetic forest')
+    labels = np.arange(len(sample)) % 2
+    return RandomForestClassifier(n_estimators=50, random_state=0).fit(sample, labels)
+
+
+def bench_features(repeat=5):
+    """
+    Микробенчмарк подготовки признаков: pandas против numpy-энкодера,
+    плюс проверка побитового совпадения матриц и вероятностей
+    """
+
+    with open(SCALER_PATH, 'rb') as file:
+        scaler = pickle.load(file)
+
+    tracks = _random_features(1000)
+
+    legacy = np.vstack([_legacy_matrix(track, scaler).to_numpy(dtype=np.float64) for track in tracks])
+    vectorized = features.preprocess(features.encode(tracks), scaler)
+    assert np.array_equal(legacy, vectorized), 'encoder output differs from pandas path'
+
+    forest = _load_forest(vectorized)
+    legacy_proba = np.vstack([forest.predict_proba(_legacy_matrix(track, scaler)) for track in tracks[:100]])
+    vectorized_proba = forest.predict_proba(vectorized[:100])
+    assert np.array_equal(legacy_proba, vectorized_proba), 'probabilities differ from pandas path'
+
+    out = np.empty((len(tracks), len(features.FEATURE_COLUMNS)))
+    cases = {
+        'pandas, 1 row': (lambda: _legacy_matrix(tracks[0], scaler), 1),
+        'numpy, 1 row': (lambda: features.preprocess(features.encode(tracks[0]), scaler), 1),
+        'pandas, 1000 rows': (lambda: [_legacy_matrix(track, scaler) for track in tracks], 1000),
+        'numpy, 1000 rows': (lambda: features.preprocess(features.encode(tracks, out=out), scaler), 1000),
+    }
+    for name, (func, rows) in cases.items():
+        number = 1000 // rows or 1
+        best = min(timeit.repeat(func, number=number, repeat=repeat)) / number
+        print(f'{name:<20} {best * 1e6:12.1f} us/call {best / rows * 1e6:8.2f} us/row')
+
+
+def bench_forest_arrays(repeat=5):
+    """
+    Сравнение pickle-леса и компактного .npy из forest_arrays: загрузка, память, предсказание
+    """
+
+    import tracemalloc
+
+    import forest_arrays
+
+    with open(SCALER_PATH, 'rb') as file:
+        scaler = pickle.load(file)
+    matrix = features.preprocess(features.encode(_random_features(1000)), scaler)
+    forest = _load_forest(matrix)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        pickle_path = os.path.join(tmp, 'forest.pkl')
+        arrays_path = os.path.join(tmp, 'forest.npy')
+        with open(pickle_path, 'wb') as file:
+            pickle.dump(forest, file)
+        forest_arrays.export_forest(forest, arrays_path)
+
+        def load_pickle():
+            with open(pickle_path, 'rb') as file:
+                return pickle.load(file)
+
+        for name, load in (('pickle', load_pickle), ('npy mmap', lambda: forest_arrays.load_forest(arrays_path))):
+            tracemalloc.start()
+            model = load()
+            memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            load_time = min(timeit.repeat(load, number=1, repeat=repeat))
+            one_row = min(timeit.repeat(lambda: model.predict_proba(matrix[:1]), number=100, repeat=repeat)) / 100
+            rows = min(timeit.repeat(lambda: model.predict_proba(matrix), number=1, repeat=repeat))
+            print(f'{name:<10} load {load_time * 1e3:8.2f} ms, heap {memory / 1024 / 1024:7.2f} MB, '
+                  f'1 row {one_row * 1e6:8.1f} us, 1000 rows {rows * 1e3:7.2f} ms, '
+                  f'file {os.path.getsize(pickle_path if name == "pickle" else arrays_path) / 1024 / 1024:.2f} MB')
+
+        exported = forest_arrays.load_forest(arrays_path)
+        assert np.array_equal(exported.predict_proba(matrix), forest.predict_proba(matrix)), \
+            'ArrayForest differs from RandomForestClassifier'
+
+
+def bench_backends(rows=20000, n_estimators=100):
+    """
+    Бэкенды inference против текущего леса: качество, совпадение с лесом, задержка, размер и память.
+    Лес обучается на синтетической выборке с шумной меткой, так что качество тут только для сравнения бэкендов
+    между собой - на настоящей выборке то же самое делает python inference.py
+    """
+
+    import inference
+    import training
+
+    tracks = _random_features(rows, seed=3)
+    rnd = random.Random(4)
+    X = features.encode(tracks)
+    y = np.array([track['danceability'] * track['energy'] + rnd.gauss(0, 0.1) > 0.3 for track in tracks],
+                 dtype=np.int64)
+
+    # Учитель учится только на той части, на которой ученики дистиллируются, чтобы оценка была честной
+    rows_order = np.random.RandomState(0).permutation(rows)
+    train_rows = rows_order[:int(rows * 0.75)]
+    forest, scaler = training.train(X[train_rows], y[train_rows], n_estimators)
+    return inference.compare(forest, scaler, X, y, seed=0)
+
+
+def bench_scoring_pool(rows=20000, batch=500):
+    """
+    Пропускная способность пакетного скоринга в ScoringPool в зависимости от числа процессов
+    """
+
+    import shutil
+
+    import predictor
+    from scoring_pool import ScoringPool
+
+    tracks = _random_features(rows)
+    batches = [tracks[i:i + batch] for i in range(0, rows, batch)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(SCALER_PATH, 'rb') as file:
+            scaler = pickle.load(file)
+        forest = _load_forest(features.preprocess(features.encode(tracks[:2000]), scaler))
+
+        predictor.FOREST_PATH = os.path.join(tmp, 'random_forest.pkl')
+        predictor.FOREST_ARRAYS_PATH = os.path.join(tmp, 'random_forest.npy')
+        predictor.SCALER_PATH = os.path.join(tmp, 'scaler.pkl')
+        with open(predictor.FOREST_PATH, 'wb') as file:
+            pickle.dump(forest, file)
+        shutil.copy(SCALER_PATH, predictor.SCALER_PATH)
+
+        baseline = None
+        for processes in sorted({1, 2, 4, os.cpu_count()}):
+            pool = ScoringPool(processes)
+            list(pool.score_batches(batches[:processes]))     # прогрев воркеров
+            started = timeit.default_timer()
+            for _ in pool.score_batches(batches):
+                pass
+            elapsed = timeit.default_timer() - started
+            pool.close()
+
+            throughput = rows / elapsed
+            baseline = baseline or throughput
+            print(f'{processes:>3} processes: {throughput:10.0f} rows/s, speedup {throughput / baseline:5.2f}x')
+
+
+def bench_records(n=200000, artists=2000):
+    """
+    Память под n треков: старые вложенные словари против компактных записей spotify_records
+    """
+
+    import gc
+    import tracemalloc
+
+    from spotify_records import RecordFactory, tracks_to_legacy
+
+    rnd = random.Random(0)
+    api_tracks = [{'artists': [{'name': f'Artist {a}', 'id': f'{a:022d}'} for a in rnd.sample(range(artists), 2)],
+                   'name': f'Track {i}',
+                   'id': f'{i:022d}',
+                   'popularity': rnd.randint(0, 100)} for i in range(n)]
+
+    def legacy():
+        return tracks_to_legacy([RecordFactory(shared_artists=False).track(track) for track in api_tracks])
+
+    def compact():
+        factory = RecordFactory()
+        return [factory.track(track) for track in api_tracks]
+
+    for name, build in (('legacy dicts', legacy), ('compact records', compact)):
+        gc.collect()
+        tracemalloc.start()
+        started = timeit.default_timer()
+        result = build()
+        elapsed = timeit.default_timer() - started
+        retained = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print(f'{name:<16} {retained / 1024 / 1024:8.1f} MB retained, {retained / n:6.0f} B/track, '
+              f'build {elapsed:.2f} s')
+        del result
+
+
+def _latency_stats(latencies, elapsed):
+    """
+    :param latencies:   список задержек в секундах
+    :param elapsed:     общее время сценария в секундах
+    :return:            словарь: count, throughput (в секунду), p50_ms, p99_ms, max_ms
+    """
+
+    latencies = np.asarray(latencies)
+    return {'count': len(latencies),
+            'throughput': len(latencies) / elapsed,
+            'p50_ms': float(np.percentile(latencies, 50) * 1000),
+            'p99_ms': float(np.percentile(latencies, 99) * 1000),
+            'max_ms': float(latencies.max() * 1000)}
+
+
+def _synthetic_models(directory, rows=5000, n_estimators=100, artists=False):
+    """
+    Синтетическая модель для e2e сценариев: лес и скейлер, обученные training.train на случайных фичах
+    с простой зависимостью метки от танцевальности и энергии. Кладет их в directory и переключает туда predictor.
+    С artists рядом обучается и расширенная модель, у которой метка зависит еще и от популярности исполнителя.
+    """
+
+    import predictor
+    import training
+
+    tracks = _random_features(rows, seed=1)
+    X = features.encode(tracks)
+    y = np.array([track['danceability'] * track['energy'] > 0.3 for track in tracks], dtype=np.int64)
+    forest, scaler = training.train(X, y, n_estimators)
+
+    predictor.FOREST_PATH = os.path.join(directory, 'random_forest.pkl')
+    predictor.FOREST_ARRAYS_PATH = os.path.join(directory, 'random_forest.npy')
+    predictor.SCALER_PATH = os.path.join(directory, 'scaler.pkl')
+    predictor.EXTENDED_FOREST_PATH = os.path.join(directory, 'random_forest_artists.pkl')
+    predictor.EXTENDED_SCALER_PATH = os.path.join(directory, 'scaler_artists.pkl')
+    predictor.MODELS_LOCK_PATH = os.path.join(directory, '.swap.lock')
+    training.save_models(forest, scaler)
+
+    if artists:
+        rnd = random.Random(2)
+        tracks_artists = [[['', '', rnd.randint(0, 10000000), rnd.randint(0, 100)]] for _ in tracks]
+        X = features.encode_extended(tracks, features.encode_artists(tracks_artists))
+        y = np.array([track['danceability'] * track['energy'] * artist[0][3] > 20
+                      for track, artist in zip(tracks, tracks_artists)], dtype=np.int64)
+        forest, scaler = training.train(X, y, n_estimators)
+        training.save_models(forest, scaler, extended=True)
+
+
+@contextlib.contextmanager
+def _e2e_environment(artists=False, **server_options):
+    """
+    Поднимает фейковый Spotify и синтетическую модель и подключает к ним predictor с пустыми кэшами.
+    После сценария все возвращается как было.
+
+    :param artists:         bool / обучить и расширенную модель с признаками исполнителя
+    :param server_options:  переопределения FAKE_SPOTIFY для FakeSpotifyServer
+    :return:                (FakeSpotifyServer, временный каталог)
+    """
+
+    import predictor
+    from fake_spotify import FakeSpotifyServer
+    from prediction_cache import PredictionCache
+    from query_cache import PrefixQueryCache
+    from spotify_cache import SpotifyCache
+    from spotipy_framework import RateLimiter, Spotify
+    from track_index import TrackIndex
+
+    saved = {name: getattr(predictor, name) for name in ('FOREST_PATH', 'FOREST_ARRAYS_PATH', 'SCALER_PATH',
+                                                          'EXTENDED_FOREST_PATH', 'EXTENDED_SCALER_PATH',
+                                                          'MODELS_LOCK_PATH', 'models', 'spotify', 'track_index',
+                                                          'prediction_cache', 'candidates_cache')}
+    server = FakeSpotifyServer(**dict(FAKE_SPOTIFY, **server_options)).start()
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            _synthetic_models(tmp, artists=artists)
+            cache = SpotifyCache(':memory:')
+            predictor.models = None
+            predictor.prediction_cache = PredictionCache()
+            predictor.candidates_cache = PrefixQueryCache()
+            predictor.track_index = TrackIndex(cache)
+            predictor.spotify = Spotify(None, None, cache=cache, client=server.client(),
+                                        rate_limiter=RateLimiter(SPOTIFY_RATE, SPOTIFY_RATE))
+            predictor._check_models()
+            yield server, tmp
+        finally:
+            server.stop()
+            for name, value in saved.items():
+                setattr(predictor, name, value)
+
+
+def bench_e2e_predict(n=200):
+    """
+    predictor.predict по одному запросу через фейковый Spotify: холодный проход (поиск, аудио фичи, модель)
+    и повторный по тем же запросам (индекс треков и кэш предсказаний)
+    """
+
+    import predictor
+
+    qs = [f'benchmark artist {i} song {i}' for i in range(n)]
+    result = {}
+    with _e2e_environment() as (server, _):
+        for name in ('cold', 'warm'):
+            latencies = []
+            started = time.perf_counter()
+            for q in qs:
+                call_started = time.perf_counter()
+                predictor.predict(q)
+                latencies.append(time.perf_counter() - call_started)
+            result[name] = _latency_stats(latencies, time.perf_counter() - started)
+            print(f'{name:<5} {result[name]}')
+        result['spotify_requests'] = server.stats()['total']
+    return result
+
+
+def bench_e2e_bulk(rows=5000):
+    """
+    bulk_predict.score_file на CSV из поисковых запросов (с повторами) и айди треков
+    """
+
+    import bulk_predict
+    from fake_spotify import fake_id
+
+    rnd = random.Random(0)
+    with _e2e_environment() as (server, tmp):
+        source = os.path.join(tmp, 'input.csv')
+        with open(source, 'w', encoding='utf-8') as file:
+            file.write('q\n')
+            for _ in range(rows):
+                if rnd.random() < 0.2:
+                    file.write(f'spotify:track:{fake_id("bulk", rnd.randint(0, rows))}\n')
+                else:
+                    file.write(f'bulk artist {rnd.randint(0, rows // 2)}\n')
+
+        summary = bulk_predict.score_file(source, os.path.join(tmp, 'output.csv'))
+        result = {'rows': summary['rows'],
+                  'throughput': summary['rows'] / summary['seconds'],
+                  'spotify_requests': server.stats()['total']}
+    print(result)
+    return result
+
+
+def bench_e2e_pagination(artists=20, albums_per_artist=120):
+    """
+    Постраничные методы spotipy_framework: время до каждой следующей страницы
+    в iter_tracks_by_years и iter_artist_albums (следующая страница запрашивается в фоне)
+    """
+
+    import predictor
+    from fake_spotify import fake_id
+
+    result = {}
+    with _e2e_environment(albums_per_artist=albums_per_artist):
+        spotify = predictor.get_spotify()
+        artist_ids = [fake_id('pagination', n) for n in range(artists)]
+        cases = {'tracks_by_years': lambda: spotify.iter_tracks_by_years(2019, limit=1000),
+                 'artist_albums': lambda: spotify.iter_artist_albums(artist_ids)}
+        for name, pages in cases.items():
+            latencies = []
+            started = previous = time.perf_counter()
+            for _ in pages():
+                now = time.perf_counter()
+                latencies.append(now - previous)
+                time.sleep(0.005)       # обработка страницы, пока следующая качается в фоне
+                previous = time.perf_counter()
+            result[name] = _latency_stats(latencies, time.perf_counter() - started)
+            print(f'{name:<16} {result[name]}')
+    return result
+
+
+def bench_e2e_new_releases(countries=('RU', 'US'), n=200):
+    """
+    new_releases.ReleaseIndex: полное обновление индекса новых релизов и ответы на запросы
+    про свежие треки из индекса против обычного predictor.predict по тем же трекам
+    """
+
+    import predictor
+    from new_releases import ReleaseIndex
+    from prediction_cache import PredictionCache
+
+    result = {}
+    with _e2e_environment() as (server, tmp):
+        index = ReleaseIndex(os.path.join(tmp, 'new_releases.json'), countries)
+        started = time.perf_counter()
+        index.refresh()
+        result['refresh_seconds'] = time.perf_counter() - started
+        result['refresh_requests'] = server.stats()['total']
+        result['tracks'] = index.stats()['tracks']
+
+        tracks = index.top(n)
+        qs = [f"{track['track_name']} {track['artist_name']}" for track in tracks]
+        for name, release_index in (('predict', None), ('lookup', index)):
+            predictor.release_index = release_index
+            predictor.prediction_cache = PredictionCache()
+            requests_before = server.stats()['total']
+            latencies = []
+            started = time.perf_counter()
+            for q in qs:
+                call_started = time.perf_counter()
+                predictor.predict(q)
+                latencies.append(time.perf_counter() - call_started)
+            result[name] = _latency_stats(latencies, time.perf_counter() - started)
+            result[name]['spotify_requests'] = server.stats()['total'] - requests_before
+            print(f'{name:<8} {result[name]}')
+        predictor.release_index = None
+    print(f"refresh {result['refresh_seconds']:.2f}s, {result['refresh_requests']} requests, "
+          f"{result['tracks']} tracks")
+    return result
+
+
+def bench_e2e_artists(n=200, budget=0.1):
+    """
+    Расширенная модель с признаками исполнителя: задержка predictor.predict, когда Spotify отвечает быстро
+    (признаки успевают за бюджет), медленно (бюджет заканчивается, считается базовая модель)
+    и на повторных треках (исполнители уже в кэше)
+    """
+
+    import predictor
+    from artist_features import ArtistStage
+    from fake_spotify import fake_id
+    from prediction_cache import PredictionCache
+
+    result = {}
+    saved_stage = predictor.artist_stage
+    track_ids = [fake_id('artists benchmark', i) for i in range(n)]
+    for name, latency in (('fast', 0.02), ('slow', budget * 2)):
+        with _e2e_environment(artists=True, latency=latency, jitter=0, rate_429=0):
+            for run in ('cold', 'warm'):
+                predictor.artist_stage = ArtistStage(predictor.get_spotify, budget)
+                predictor.prediction_cache = PredictionCache()
+                latencies = []
+                started = time.perf_counter()
+                for track_id in track_ids:
+                    call_started = time.perf_counter()
+                    predictor.predict(track_id)
+                    latencies.append(time.perf_counter() - call_started)
+                stats = _latency_stats(latencies, time.perf_counter() - started)
+                stats.update(predictor.artist_stage.stats())
+                result[f'{name}_{run}'] = stats
+                print(f'{name:<4} {run:<4} {stats}')
+                predictor.artist_stage.close()
+    predictor.artist_stage = saved_stage
+    return result
+
+
+class FakeTelegramBot:
+
+    def __init__(self, latency=0.01):
+        """
+        Замена context.bot для сценария нагрузки на бота: send_message ждет latency секунд,
+        как поход в Telegram API, и будит того, кто ждет ответа в этом чате
+        """
+
+        self.latency = latency
+        self.sent = 0
+        self._waiting = {}
+        self._lock = threading.Lock()
+
+    def expect(self, chat_id):
+        event = self._waiting[chat_id] = threading.Event()
+        return event
+
+    def send_message(self, chat_id, text, **kwargs):
+        time.sleep(self.latency)
+        with self._lock:
+            self.sent += 1
+        event = self._waiting.pop(chat_id, None)
+        if event is not None:
+            event.set()
+
+
+def bench_e2e_inline(users=10, n=5, keystroke=0.05, word_pause=0.5, debounce=0.3):
+    """
+    Инлайн режим: users пользователей параллельно печатают запрос по букве раз в keystroke секунд и думают
+    word_pause секунд после каждого слова. Каждая буква от трех символов - инлайн запрос с n кандидатами
+    в PredictionService.submit_inline. Поиск идет по каталогу, где у каждого пользователя свои треки,
+    так что продолжение запроса может ответить PrefixQueryCache. Без debounce и с ним: сколько запросов дошло
+    до обработки, сколько из них ответил PrefixQueryCache, сколько запросов ушло в Spotify и задержка
+    от последней буквы до ответа на полный запрос.
+    """
+
+    import predictor
+    from async_service import PredictionService
+
+    texts = {user_id: f'user{user_id} favourite song' for user_id in range(users)}
+    catalog = [f'user{user_id} {title} {k}' for user_id in texts for title in ('favourite song', 'other tune')
+               for k in range(10)]
+    result = {}
+    for name, seconds in (('no_debounce', 0), ('debounce', debounce)):
+        with _e2e_environment(rate_429=0, catalog=catalog) as (server, tmp):
+            service = PredictionService(debounce=seconds)
+            service.start()
+            latencies = []
+            lock = threading.Lock()
+
+            def user(user_id):
+                text = texts[user_id]
+                answered = threading.Event()
+                typed = {}
+
+                def reply_for(q):
+                    def reply(predictions):
+                        if q == text:
+                            with lock:
+                                latencies.append(time.perf_counter() - typed[q])
+                            answered.set()
+                    return reply
+
+                for end in range(3, len(text) + 1):
+                    q = text[:end]
+                    typed[q] = time.perf_counter()
+                    service.submit_inline(user_id, q, reply_for(q), n)
+                    time.sleep(word_pause if end < len(text) and text[end] == ' ' else keystroke)
+                answered.wait()
+
+            try:
+                started = time.perf_counter()
+                threads = [threading.Thread(target=user, args=(user_id,)) for user_id in texts]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                result[name] = _latency_stats(latencies, time.perf_counter() - started)
+                while service.stats()['active_chats']:
+                    time.sleep(0.01)
+                result[name].update(service.stats()['inline'])
+            finally:
+                service.stop()
+            result[name]['spotify_requests'] = server.stats()['total']
+            result[name].update(predictor.candidates_cache.stats())
+        print(f'{name:<12} {result[name]}')
+    assert result['debounce']['prefix_hits'], 'PrefixQueryCache did not serve any inline query'
+    return result
+
+
+def fake_update(username, chat_id, text):
+    """
+    Минимальный telegram.Update с теми полями, которые читают обработчики бота
+    """
+
+    return types.SimpleNamespace(effective_user=types.SimpleNamespace(username=username, id=chat_id),
+                                 effective_chat=types.SimpleNamespace(id=chat_id),
+                                 effective_message=types.SimpleNamespace(chat_id=chat_id),
+                                 message=types.SimpleNamespace(text=text))
+
+
+def fake_messages(users, messages, popular=50, seed=0):
+    """
+    Генератор сообщений для нагрузки: у каждого пользователя messages запросов, половина из них -
+    популярные треки, которые спрашивают многие, остальные уникальные
+
+    :return:    словарь {username: [текст, ...]}
+    """
+
+    rnd = random.Random(seed)
+    return {f'user{user}': [f'popular song {rnd.randint(0, popular)}' if rnd.random() < 0.5
+                            else f'user{user} track {n}' for n in range(messages)]
+            for user in range(users)}
+
+
+def bench_e2e_bot(users=20, messages=10, workers=4):
+    """
+    Нагрузка на бота: users пользователей параллельно шлют по messages сообщений, каждый ждет ответа
+    перед следующим. Сообщения обрабатываются hit_predictor_bot.bot_predict в workers потоках,
+    как в диспетчере python-telegram-bot. Задержка - от апдейта до отправленного ответа.
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    import hit_predictor_bot
+    from permissions import PermissionIndex
+
+    texts = fake_messages(users, messages)
+    bot = FakeTelegramBot()
+    context = types.SimpleNamespace(bot=bot)
+
+    with _e2e_environment() as (server, tmp):
+        permissions_path = os.path.join(tmp, 'permissions.txt')
+        with open(permissions_path, 'w') as file:
+            file.write('\n'.join(texts))
+        saved_permissions = hit_predictor_bot.permissions
+        hit_predictor_bot.permissions = PermissionIndex(permissions_path)
+
+        dispatcher = ThreadPoolExecutor(workers)
+        hit_predictor_bot.service.start()
+        latencies = []
+        lock = threading.Lock()
+
+        def user(chat_id, username):
+            for text in texts[username]:
+                replied = bot.expect(chat_id)
+                call_started = time.perf_counter()
+                dispatcher.submit(hit_predictor_bot.bot_predict, fake_update(username, chat_id, text), context)
+                replied.wait()
+                with lock:
+                    latencies.append(time.perf_counter() - call_started)
+
+        try:
+            started = time.perf_counter()
+            threads = [threading.Thread(target=user, args=(chat_id, username))
+                       for chat_id, username in enumerate(texts)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            result = _latency_stats(latencies, time.perf_counter() - started)
+            # Ответ уже отправлен, но handle() еще дописывает счетчики - даем ему закончиться до остановки loop-а
+            while hit_predictor_bot.service.stats()['active_chats']:
+                time.sleep(0.01)
+        finally:
+            hit_predictor_bot.service.stop()
+            dispatcher.shutdown()
+            hit_predictor_bot.permissions = saved_permissions
+
+        result['spotify_requests'] = server.stats()['total']
+    print(result)
+    return result
+
+
+BENCHMARKS = {
+    'features': bench_features,
+    'forest_arrays': bench_forest_arrays,
+    'backends': bench_backends,
+    'scoring_pool': bench_scoring_pool,
+    'records': bench_records,
+    'e2e_predict': bench_e2e_predict,
+    'e2e_bulk': bench_e2e_bulk,
+    'e2e_pagination': bench_e2e_pagination,
+    'e2e_bot': bench_e2e_bot,
+    'e2e_new_releases': bench_e2e_new_releases,
+    'e2e_artists': bench_e2e_artists,
+    'e2e_inline': bench_e2e_inline,
+}
+
+
+def _flatten(result, prefix=''):
+    flat = {}
+    for key, value in result.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)):
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, results):
+    """
+    Печатает изменения throughput и перцентилей относительно сохраненного прогона (--json с прошлого коммита)
+    """
+
+    old, new = _flatten(baseline['results']), _flatten(results)
+    print(f'\n--- compare with {baseline.get("commit")} ---')
+    for key in sorted(set(old) & set(new)):
+        if key.rsplit('.', 1)[-1] not in ('throughput', 'p50_ms', 'p99_ms'):
+            continue
+        change = (new[key] - old[key]) / old[key] * 100 if old[key] else 0.0
+        print(f'{key:<40} {old[key]:12.2f} -> {new[key]:12.2f} {change:+7.1f}%')
+
+
+def main():
+    global SPOTIFY_RATE
+
+    parser = argparse.ArgumentParser(description='hit_predictor_bot benchmarks')
+    parser.add_argument('names', nargs='*', help=f'какие бенчмарки запускать: {", ".join(BENCHMARKS)}')
+    parser.add_argument('--json', help='сохранить результаты e2e сценариев в JSON для сравнения между коммитами')
+    parser.add_argument('--compare', help='JSON прошлого прогона, с которым сравнить')
+    parser.add_argument('--latency', type=float, default=FAKE_SPOTIFY['latency'],
+                        help='задержка ответа фейкового Spotify, с')
+    parser.add_argument('--jitter', type=float, default=FAKE_SPOTIFY['jitter'], help='случайная добавка к задержке, с')
+    parser.add_argument('--rate-429', type=float, default=FAKE_SPOTIFY['rate_429'], help='доля ответов 429')
+    parser.add_argument('--spotify-rate', type=float, default=SPOTIFY_RATE,
+                        help='лимит запросов в секунду к фейковому Spotify')
+    args = parser.parse_args()
+
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f'unknown benchmarks: {", ".join(sorted(unknown))}')
+
+    FAKE_SPOTIFY.update(latency=args.latency, jitter=args.jitter, rate_429=args.rate_429)
+    SPOTIFY_RATE = args.spotify_rate
+
+    results = {}
+    for name in args.names or BENCHMARKS:
+        print(f'\n--- {name} ---')
+        result = BENCHMARKS[name]()
+        if result is not None:
+            results[name] = result
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({'commit': _git_commit(),
+                       'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'options': dict(FAKE_SPOTIFY, spotify_rate=SPOTIFY_RATE),
+                       'results': results}, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            compare(json.load(file), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+import argparse
+import itertools
+import json
+import os
+import shutil
+import time
+
+import predictor
+from spotipy_framework import AUDIO_FEATURES_BATCH
+
+
+CHUNK_SIZE = 1000
+RESULT_COLUMNS = ['artist_name', 'track_name', 'hit_proba']
+
+
+def _format(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ('.csv', '.parquet', '.jsonl'):
+        return extension[1:]
+    if extension in ('.json', '.ndjson'):
+        return 'jsonl'
+    raise ValueError(f'Unsupported file format: {path} (csv, parquet or jsonl)')
+
+
+def read_chunks(path, chunk_size=CHUNK_SIZE, skip_rows=0):
+    """
+    Читает входной файл пачками по chunk_size строк, целиком в память он не загружается.
+    Для Parquet нужен pyarrow
+
+    :param path:            str / .csv, .parquet или .jsonl
+    :param chunk_size:      int / строк в пачке
+    :param skip_rows:       int / сколько строк с начала пропустить (продолжение после падения)
+    :return:                генератор pandas.DataFrame
+    """
+
+    import pandas as pd
+
+    file_format = _format(path)
+
+    if file_format == 'csv':
+        reader = pd.read_csv(path, dtype=str, keep_default_na=False, chunksize=chunk_size,
+                             skiprows=range(1, skip_rows + 1))
+        yield from reader
+
+    elif file_format == 'jsonl':
+        with open(path, encoding='utf-8') as file:
+            lines = itertools.islice((line for line in file if line.strip()), skip_rows, None)
+            while True:
+                chunk = [json.loads(line) for line in itertools.islice(lines, chunk_size)]
+                if not chunk:
+                    break
+                yield pd.DataFrame(chunk)
+
+    else:
+        import pyarrow.parquet as pq
+
+        skipped = 0
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            if skipped + batch.num_rows <= skip_rows:
+                skipped += batch.num_rows
+                continue
+            chunk = batch.to_pandas()
+            yield chunk.iloc[skip_rows - skipped:] if skipped < skip_rows else chunk
+            skipped = skip_rows
+
+
+class ResultWriter:
+
+    def __init__(self, path, chunks=0, output_bytes=0):
+        """
+        Дописывает результаты пачками. CSV и JSONL дописываются в один файл, Parquet пишется
+        файлом на пачку в каталог {path}.parts и собирается в один файл в finish().
+        При продолжении CSV/JSONL обрезаются до размера из чекпоинта, чтобы выкинуть недописанную пачку.
+
+        :param path:            str / выходной файл
+        :param chunks:          int / сколько пачек уже записано
+        :param output_bytes:    int / размер выходного файла на момент чекпоинта
+        """
+
+        self.path = path
+        self.format = _format(path)
+        self.chunks = chunks
+        self.parts_dir = f'{path}.parts'
+
+        if self.format == 'parquet':
+            os.makedirs(self.parts_dir, exist_ok=True)
+        elif chunks:
+            with open(path, 'r+b') as file:
+                file.truncate(output_bytes)
+        else:
+            open(path, 'w').close()
+
+    def write(self, chunk):
+        if self.format == 'csv':
+            with open(self.path, 'a', encoding='utf-8', newline='') as file:
+                chunk.to_csv(file, header=not self.chunks, index=False)
+        elif self.format == 'jsonl':
+            records = chunk.astype(object).where(chunk.notna(), None).to_dict('records')
+            with open(self.path, 'a', encoding='utf-8') as file:
+                file.writelines(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+        else:
+            chunk.to_parquet(os.path.join(self.parts_dir, f'part-{self.chunks:06d}.parquet'), index=False)
+        self.chunks += 1
+
+    def size(self):
+        return 0 if self.format == 'parquet' else os.path.getsize(self.path)
+
+    def finish(self):
+        """
+        Для Parquet - склеивает пачки в один файл по одной, не загружая все сразу
+        """
+
+        if self.format != 'parquet':
+            return
+
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        parts = [os.path.join(self.parts_dir, f'part-{n:06d}.parquet') for n in range(self.chunks)]
+        if parts:
+            # В пачке, где ничего не нашлось, колонки с результатами пустые (тип null) - приводим к общей схеме
+            schema = pa.unify_schemas([pq.read_schema(part) for part in parts])
+            tmp_path = f'{self.path}.tmp'
+            with pq.ParquetWriter(tmp_path, schema) as writer:
+                for part in parts:
+                    writer.write_table(pq.read_table(part).cast(schema))
+            os.replace(tmp_path, self.path)
+        shutil.rmtree(self.parts_dir)
+
+
+def _load_checkpoint(path, source, column, chunk_size):
+    try:
+        with open(path) as file:
+            checkpoint = json.load(file)
+    except FileNotFoundError:
+        return None
+    if (checkpoint['input'], checkpoint['column'], checkpoint['chunk_size']) != (source, column, chunk_size):
+        raise ValueError(f'Checkpoint {path} was made for other input, column or chunk size, '
+                         f'remove it or run with --restart')
+    return checkpoint
+
+
+def _save_checkpoint(path, checkpoint):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(checkpoint, file)
+    os.replace(tmp_path, path)
+
+
+def score_file(source, target, column='q', chunk_size=CHUNK_SIZE, batch_size=AUDIO_FEATURES_BATCH, restart=False):
+    """
+    Считает вероятность хита для каждой строки файла: в колонке column - айди трека, URI, ссылка
+    или поисковый запрос. Файл читается пачками по chunk_size строк, каждая пачка прогоняется
+    через predictor.predict_many (кэш Spotify, пакетные эндпоинты, один вызов модели на пачку)
+    и дописывается в target со столбцами artist_name, track_name, hit_proba.
+
+    После каждой записанной пачки обновляется чекпоинт {target}.checkpoint, после падения
+    повторный запуск с теми же аргументами продолжает с первой незаписанной пачки.
+
+    :param source:          str / входной .csv, .parquet или .jsonl
+    :param target:          str / выходной .csv, .parquet или .jsonl
+    :param column:          str / колонка с запросами
+    :param chunk_size:      int / строк в пачке (ограничивает память)
+    :param batch_size:      int / размер пачки predict_many
+    :param restart:         bool / игнорировать чекпоинт и начать сначала
+    :return:                словарь: rows, found, seconds
+    """
+
+    checkpoint_path = f'{target}.checkpoint'
+    checkpoint = None if restart else _load_checkpoint(checkpoint_path, source, column, chunk_size)
+    if checkpoint is None:
+        checkpoint = {'input': source, 'column': column, 'chunk_size': chunk_size,
+                      'chunks': 0, 'rows': 0, 'found': 0, 'output_bytes': 0}
+    elif checkpoint['rows']:
+        print(f'Resuming from row {checkpoint["rows"]} ({checkpoint["chunks"]} chunks done)')
+
+    writer = ResultWriter(target, checkpoint['chunks'], checkpoint['output_bytes'])
+
+    started = time.perf_counter()
+    rows = 0
+    for chunk in read_chunks(source, chunk_size, checkpoint['rows']):
+        if column not in chunk.columns:
+            raise ValueError(f'No column {column!r} in {source}, columns: {", ".join(map(str, chunk.columns))}')
+
+        # Пустые строки не ищем, повторы внутри пачки считаем один раз
+        qs = ['' if q is None else str(q).strip() for q in chunk[column].tolist()]
+        results = dict(predictor.predict_many(list(dict.fromkeys(q for q in qs if q)), batch_size))
+        predictions = [results.get(q) for q in qs]
+
+        chunk = chunk.reset_index(drop=True)
+        for result_column in RESULT_COLUMNS:
+            chunk[result_column] = [prediction[result_column] if prediction else None for prediction in predictions]
+        writer.write(chunk)
+
+        rows += len(chunk)
+        checkpoint.update(chunks=writer.chunks,
+                          rows=checkpoint['rows'] + len(chunk),
+                          found=checkpoint['found'] + sum(1 for prediction in predictions if prediction),
+                          output_bytes=writer.size())
+        _save_checkpoint(checkpoint_path, checkpoint)
+
+        seconds = time.perf_counter() - started
+        print(f'{checkpoint["rows"]} rows ({checkpoint["found"]} found), '
+              f'{rows / seconds:.1f} rows/s, chunk {writer.chunks}')
+
+    writer.finish()
+    os.remove(checkpoint_path)
+
+    seconds = time.perf_counter() - started
+    print(f'Done: {checkpoint["rows"]} rows, {checkpoint["found"]} found, {seconds:.1f}s '
+          f'({rows / max(seconds, 1e-9):.1f} rows/s in this run) -> {target}')
+    print(f'Track index: {predictor.get_track_index().stats()}')
+    return {'rows': checkpoint['rows'], 'found': checkpoint['found'], 'seconds': seconds}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Пакетный скоринг треков из CSV/Parquet/JSONL')
+    parser.add_argument('input', help='.csv, .parquet или .jsonl с запросами')
+    parser.add_argument('output', help='.csv, .parquet или .jsonl для результатов')
+    parser.add_argument('--column', default='q', help='колонка с айди, URI, ссылкой или названием трека')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='строк в пачке')
+    parser.add_argument('--batch-size', type=int, default=AUDIO_FEATURES_BATCH, help='размер пачки predict_many')
+    parser.add_argument('--restart', action='store_true', help='не продолжать с чекпоинта, начать заново')
+    args = parser.parse_args()
+
+    score_file(args.input, args.output, args.column, args.chunk_size, args.batch_size, args.restart)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+import base64
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+YEAR_SEARCH_TOTAL = 1000
+NEW_RELEASES_TOTAL = 100
+
+
+def fake_id(*parts):
+    """
+    Детерминированный айди в формате Spotify (22 символа) из любых строк
+    """
+
+    digest = hashlib.sha1('|'.join(map(str, parts)).encode('utf-8')).digest()
+    return base64.b64encode(digest, b'Ab').decode('ascii')[:22]
+
+
+def fake_artist(artist_id):
+    rnd = random.Random(artist_id)
+    return {'id': artist_id,
+            'name': f'Artist {artist_id[:6]}',
+            'genres': [],
+            'popularity': rnd.randint(0, 100),
+            'followers': {'total': rnd.randint(0, 10000000)}}
+
+
+def fake_track(track_id, name=None):
+    rnd = random.Random(track_id)
+    artist_id = fake_id('artist', rnd.randint(0, 5000))
+    return {'id': track_id,
+            'name': name or f'Track {track_id[:6]}',
+            'artists': [{'id': artist_id, 'name': f'Artist {artist_id[:6]}'}],
+            'album': {'id': fake_id('album', track_id), 'name': f'Album {track_id[:6]}'},
+            'popularity': rnd.randint(0, 100)}
+
+
+def fake_audio_features(track_id):
+    rnd = random.Random(track_id)
+    return {'id': track_id,
+            'danceability': rnd.random(),
+            'energy': rnd.random(),
+            'loudness': rnd.uniform(-30, 0),
+            'mode': rnd.randint(0, 1),
+            'speechiness': rnd.random(),
+            'acousticness': rnd.random(),
+            'instrumentalness': rnd.random() ** 4,
+            'liveness': rnd.random(),
+            'valence': rnd.random(),
+            'tempo': rnd.uniform(60, 200),
+            'duration_ms': rnd.randint(90000, 360000),
+            'key': rnd.randint(-1, 11),
+            'time_signature': rnd.randint(1, 5)}
+
+
+def fake_album(album_id, tracks=10):
+    return {'id': album_id,
+            'name': f'Album {album_id[:6]}',
+            'album_type': 'single' if tracks == 1 else 'album',
+            'artists': fake_track(fake_id(album_id, 0))['artists'],
+            'tracks': {'items': [fake_track(fake_id(album_id, n)) for n in range(tracks)]}}
+
+
+class FakeSpotifyServer:
+
+    def __init__(self, latency=0.0, jitter=0.0, rate_429=0.0, retry_after=0.05, payloads=None, albums_per_artist=30,
+                 catalog=None, seed=0):
+        """
+        Локальная замена api.spotify.com для бенчмарков. Отдает синтетический, но детерминированный каталог
+        (один и тот же запрос - всегда тот же ответ) в формате Web API: search, audio-features, tracks, albums,
+        artists, artist albums, related artists, top tracks, new releases. Подключается к Spotify через
+        api_prefix=server.prefix и клиент spotipy с любым токеном (см. client()).
+
+        :param latency:             float / задержка каждого ответа в секундах
+        :param jitter:              float / случайная добавка к задержке, от 0 до jitter секунд
+        :param rate_429:            float / доля запросов, на которые отвечать 429 Too Many Requests
+        :param retry_after:         float / Retry-After в ответах 429
+        :param payloads:            dict {путь с query после /v1/: ответ} - записанные ответы, отдаются
+                                    вместо синтетических, если запрос совпал
+        :param albums_per_artist:   int / сколько альбомов у каждого исполнителя (для пагинации artist albums)
+        :param catalog:             list названий треков - если задан, поиск ищет по нему как Spotify:
+                                    каждое слово запроса должно быть началом какого-то слова в названии
+        :param seed:                int / seed для задержек и 429
+        """
+
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.payloads = payloads or {}
+        self.albums_per_artist = albums_per_artist
+        self.catalog = [(name, name.lower().split()) for name in catalog or []]
+
+        self.requests = {}
+        self.throttled = 0
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def prefix(self):
+        return f'http://127.0.0.1:{self._server.server_address[1]}/v1/'
+
+    def client(self, requests_timeout=10):
+        """
+        :return:    spotipy.Spotify, который ходит в этот сервер (без авторизации в accounts.spotify.com)
+        """
+
+        import spotipy
+
+        from spotipy_framework import shared_session
+
+        client = spotipy.Spotify(auth='fake-token', requests_session=shared_session(),
+                                 requests_timeout=requests_timeout)
+        client.prefix = self.prefix
+        return client
+
+    def start(self):
+        handler = type('Handler', (_Handler,), {'fake': self})
+        self._server = _Server(('127.0.0.1', 0), handler)
+        threading.Thread(target=self._server.serve_forever, name='fake-spotify', daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def stats(self):
+        with self._lock:
+            return {'requests': dict(self.requests),
+                    'total': sum(self.requests.values()),
+                    'throttled': self.throttled}
+
+    def _respond(self, raw_path):
+        """
+        :param raw_path:    str / путь запроса с query
+        :return:            (status, тело ответа)
+        """
+
+        url = urlparse(raw_path)
+        path, params = url.path, parse_qs(url.query)
+        parts = [part for part in path.split('/') if part][1:]      # без v1
+        endpoint = '/'.join(part if n != 1 or parts[0] != 'artists' else '{id}' for n, part in enumerate(parts))
+        ids = [track_id for value in params.get('ids', []) for track_id in value.split(',') if track_id]
+
+        with self._lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            throttled = self._random.random() < self.rate_429
+            if throttled:
+                self.throttled += 1
+            delay = self.latency + self._random.random() * self.jitter
+        if delay:
+            time.sleep(delay)
+        if throttled:
+            return 429, {'error': {'status': 429, 'message': 'API rate limit exceeded'}}
+
+        recorded = self.payloads.get(raw_path.split('/v1/', 1)[-1])
+        if recorded is not None:
+            return 200, recorded
+
+        if endpoint == 'search':
+            q = params['q'][0]
+            limit = int(params.get('limit', ['10'])[0])
+            offset = int(params.get('offset', ['0'])[0])
+            if q.startswith('year:'):
+                count = max(min(limit, YEAR_SEARCH_TOTAL - offset), 0)
+                items = [fake_track(fake_id(q, offset + n)) for n in range(count)]
+            elif 'nothing' in q:
+                items = []
+            elif self.catalog:
+                words = q.lower().split()
+                names = [name for name, name_words in self.catalog
+                         if all(any(name_word.startswith(word) for name_word in name_words) for word in words)]
+                items = [fake_track(fake_id('catalog', name), name) for name in names[offset:offset + limit]]
+            else:
+                items = [fake_track(fake_id(q.lower(), offset + n), q if not offset + n else None)
+                         for n in range(limit)]
+            return 200, {'tracks': {'items': items, 'offset': offset, 'limit': limit}}
+
+        if endpoint == 'audio-features':
+            return 200, {'audio_features': [None if track_id.startswith('missing') else fake_audio_features(track_id)
+                                            for track_id in ids]}
+        if endpoint == 'tracks':
+            return 200, {'tracks': [None if track_id.startswith('missing') else fake_track(track_id)
+                                    for track_id in ids]}
+        if endpoint == 'albums':
+            return 200, {'albums': [fake_album(album_id) for album_id in ids]}
+        if endpoint == 'artists':
+            return 200, {'artists': [fake_artist(artist_id) for artist_id in ids]}
+
+        if endpoint == 'artists/{id}/albums':
+            limit = int(params.get('limit', ['20'])[0])
+            offset = int(params.get('offset', ['0'])[0])
+            items = [fake_album(fake_id(parts[1], 'album', n), tracks=1 + n % 3)
+                     for n in range(offset, min(offset + limit, self.albums_per_artist))]
+            more = offset + limit < self.albums_per_artist
+            return 200, {'items': items, 'next': f'{self.prefix}{path}?offset={offset + limit}' if more else None}
+        if endpoint == 'artists/{id}/related-artists':
+            return 200, {'artists': [fake_artist(fake_id(parts[1], 'related', n)) for n in range(20)]}
+        if endpoint == 'artists/{id}/top-tracks':
+            return 200, {'tracks': [fake_track(fake_id(parts[1], 'top', n)) for n in range(10)]}
+
+        if endpoint == 'browse/new-releases':
+            limit = int(params.get('limit', ['20'])[0])
+            offset = int(params.get('offset', ['0'])[0])
+            items = [fake_album(fake_id('new', n), tracks=1 + n % 5)
+                     for n in range(offset, min(offset + limit, NEW_RELEASES_TOTAL))]
+            return 200, {'albums': {'items': items, 'offset': offset, 'limit': limit}}
+
+        return 404, {'error': {'status': 404, 'message': f'Unknown endpoint {endpoint}'}}
+
+
+class _Server(ThreadingHTTPServer):
+    # Стандартная очередь в 5 соединений переполняется при десятках параллельных запросов,
+    # и лишние соединения ждут повторного SYN целую секунду
+    request_queue_size = 256
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    fake = None
+
+    def do_GET(self):
+        status, body = self.fake._respond(self.path)
+
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if status == 429:
+            self.send_header('Retry-After', str(self.fake.retry_after))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
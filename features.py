@@ -0,0 +1,150 @@
+from operator import itemgetter
+
+import numpy as np
+
+
+RAW_COLUMNS = ('danceability', 'energy', 'loudness', 'mode', 'speechiness', 'acousticness', 'instrumentalness',
+               'liveness', 'valence', 'tempo', 'duration_ms')
+
+KEY_COLUMNS = tuple(f'key_{key}' for key in range(1, 12))
+
+TIME_SIGNATURE_COLUMNS = tuple(f'time_signature_{ts}' for ts in range(3, 6))
+
+FEATURE_COLUMNS = RAW_COLUMNS + KEY_COLUMNS + TIME_SIGNATURE_COLUMNS
+
+NUMERICAL_COLUMNS = ('danceability', 'energy', 'loudness', 'speechiness', 'acousticness', 'instrumentalness',
+                     'liveness', 'valence', 'tempo', 'duration_ms')
+
+LOG_COLUMNS = ('duration_ms', 'instrumentalness', 'liveness', 'speechiness')
+
+# Масштаб исполнителя для расширенной модели: дописываются справа к FEATURE_COLUMNS,
+# поэтому preprocess и скейлер для них те же самые
+ARTIST_COLUMNS = ('artist_followers', 'artist_popularity', 'artists_count')
+
+EXTENDED_COLUMNS = FEATURE_COLUMNS + ARTIST_COLUMNS
+
+
+# Индексы колонок считаются один раз при импорте, дальше работаем только с ними
+_get_raw = itemgetter(*RAW_COLUMNS)
+_NUMERICAL_IDX = np.array([FEATURE_COLUMNS.index(column) for column in NUMERICAL_COLUMNS])
+_LOG_IDX = np.array([FEATURE_COLUMNS.index(column) for column in LOG_COLUMNS])
+_KEY_OFFSET = FEATURE_COLUMNS.index('key_1') - 1
+_TIME_SIGNATURE_OFFSET = FEATURE_COLUMNS.index('time_signature_3') - 3
+
+
+def encode(features, out=None):
+    """
+    Переводит аудио фичи из Spotify в матрицу признаков с фиксированным порядком колонок
+    (FEATURE_COLUMNS). Ключ и размер такта кодируются one-hot так же, как при обучении модели.
+
+    :param features:    dict или list словарей с аудио фичами (как из Spotify.get_audio_features)
+    :param out:         np.ndarray / заранее выделенная float64 матрица (n, len(FEATURE_COLUMNS))
+    :return:            np.ndarray формы (n, len(FEATURE_COLUMNS)), float64
+    """
+
+    if isinstance(features, dict):
+        features = [features]
+
+    n = len(features)
+    if out is None:
+        matrix = np.zeros((n, len(FEATURE_COLUMNS)), dtype=np.float64)
+    else:
+        matrix = out[:n]
+        matrix.fill(0)
+
+    if not n:
+        return matrix
+
+    matrix[:, :len(RAW_COLUMNS)] = [_get_raw(track) for track in features]
+
+    rows = np.arange(n)
+    keys = np.fromiter((track['key'] for track in features), dtype=np.int64, count=n)
+    mask = (keys >= 1) & (keys <= 11)
+    matrix[rows[mask], _KEY_OFFSET + keys[mask]] = 1
+
+    signatures = np.fromiter((track['time_signature'] for track in features), dtype=np.int64, count=n)
+    mask = (signatures >= 3) & (signatures <= 5)
+    matrix[rows[mask], _TIME_SIGNATURE_OFFSET + signatures[mask]] = 1
+
+    return matrix
+
+
+def encode_artists(tracks_artists):
+    """
+    Признаки масштаба исполнителя (ARTIST_COLUMNS): логарифм подписчиков и популярность самого крупного
+    из исполнителей трека, количество исполнителей. Для трека без данных об исполнителях - нули.
+
+    :param tracks_artists:  list списков [artist_name, artist_id, followers, popularity] по каждому треку
+                            (как из Spotify.get_artists_info)
+    :return:                np.ndarray формы (n, len(ARTIST_COLUMNS)), float64
+    """
+
+    matrix = np.zeros((len(tracks_artists), len(ARTIST_COLUMNS)), dtype=np.float64)
+    for row, artists in enumerate(tracks_artists):
+        if artists:
+            matrix[row, 0] = np.log(max(artist[2] for artist in artists) + 1)
+            matrix[row, 1] = max(artist[3] for artist in artists)
+            matrix[row, 2] = len(artists)
+    return matrix
+
+
+def encode_extended(features, artists):
+    """
+    Матрица для расширенной модели: encode() и справа encode_artists() (EXTENDED_COLUMNS)
+
+    :param features:    list словарей с аудио фичами
+    :param artists:     np.ndarray из encode_artists в том же порядке
+    :return:            np.ndarray формы (n, len(EXTENDED_COLUMNS)), float64
+    """
+
+    return np.hstack([encode(features), artists])
+
+
+def log_transform(matrix):
+    """
+    Логарифмирует скошенные признаки (LOG_COLUMNS) как np.log(x + 1). Матрица меняется на месте.
+
+    :param matrix:      np.ndarray из encode()
+    :return:            та же матрица
+    """
+
+    matrix[:, _LOG_IDX] = np.log(matrix[:, _LOG_IDX] + 1)
+    return matrix
+
+
+def fit_scaler(matrix):
+    """
+    Обучает StandardScaler для preprocess() на числовых колонках после логарифмирования,
+    как он обучался для модели в ml_models. Сама матрица не меняется.
+
+    :param matrix:      np.ndarray из encode()
+    :return:            обученный sklearn StandardScaler
+    """
+
+    from sklearn.preprocessing import StandardScaler
+
+    numerical = log_transform(matrix.copy())[:, _NUMERICAL_IDX]
+    return StandardScaler().fit(numerical)
+
+
+def preprocess(matrix, scaler):
+    """
+    Логарифмирует скошенные признаки и стандартизирует числовые колонки параметрами обученного скейлера.
+    Матрица меняется на месте. Результат побитово совпадает со старым pandas-вариантом:
+    log считается как np.log(x + 1), а не np.log1p, а скейлинг - как в StandardScaler.transform.
+
+    :param matrix:      np.ndarray из encode()
+    :param scaler:      обученный sklearn StandardScaler (по NUMERICAL_COLUMNS)
+    :return:            та же матрица
+    """
+
+    log_transform(matrix)
+
+    numerical = matrix[:, _NUMERICAL_IDX]
+    if scaler.with_mean:
+        numerical -= scaler.mean_
+    if scaler.with_std:
+        numerical /= scaler.scale_
+    matrix[:, _NUMERICAL_IDX] = numerical
+
+    return matrix
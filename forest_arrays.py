@@ -0,0 +1,172 @@
+import argparse
+import os
+import pickle
+
+import numpy as np
+
+
+TREE_LEAF = -1
+
+
+def _node_dtype(n_classes):
+    return np.dtype([('feature', '<i4'),
+                     ('threshold', '<f8'),
+                     ('left', '<i4'),
+                     ('right', '<i4'),
+                     ('value', '<f8', (n_classes,))])
+
+
+def pack_trees(trees, n_outputs, normalize=True):
+    """
+    Складывает деревья sklearn в один структурный массив узлов (признак, порог, левый и правый потомок,
+    значения в узле). Айди потомков глобальные, корень каждого дерева - первый его узел.
+
+    :param trees:       list объектов sklearn Tree (estimator.tree_)
+    :param n_outputs:   int / сколько значений в узле: классов для классификатора, 1 для регрессии
+    :param normalize:   bool / нормировать значения в узле в вероятности, как DecisionTreeClassifier
+    :return:            np.ndarray узлов
+    """
+
+    nodes = np.zeros(sum(tree.node_count for tree in trees), dtype=_node_dtype(n_outputs))
+
+    offset = 0
+    for tree in trees:
+        part = nodes[offset:offset + tree.node_count]
+        leaf = tree.children_left == TREE_LEAF
+
+        part['feature'] = np.where(leaf, 0, tree.feature)
+        part['threshold'] = tree.threshold
+        part['left'] = np.where(leaf, TREE_LEAF, tree.children_left + offset)
+        part['right'] = np.where(leaf, TREE_LEAF, tree.children_right + offset)
+
+        value = tree.value[:, 0, :n_outputs]
+        if normalize:
+            # Так же, как DecisionTreeClassifier.predict_proba нормирует значения в листе
+            normalizer = value.sum(axis=1)[:, np.newaxis]
+            normalizer[normalizer == 0.0] = 1.0
+            value = value / normalizer
+        part['value'] = value
+
+        offset += tree.node_count
+
+    return nodes
+
+
+def export_forest(forest, path):
+    """
+    Сохраняет обученный sklearn RandomForestClassifier одним .npy файлом из pack_trees.
+    Файл пишется во временный и подменяется через os.replace, так что процессы, у которых
+    старый файл открыт через mmap, продолжают работать со старой версией.
+
+    :param forest:      обученный RandomForestClassifier
+    :param path:        str / куда сохранить, обычно ml_models/random_forest.npy
+    """
+
+    nodes = pack_trees([estimator.tree_ for estimator in forest.estimators_], int(forest.n_classes_))
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as file:
+        np.save(file, nodes)
+    os.replace(tmp_path, path)
+
+
+class ArrayForest:
+
+    def __init__(self, nodes):
+        """
+        Лес из export_forest или pack_trees. Предсказание - пакетный обход всех деревьев сразу чистым numpy,
+        результат совпадает с RandomForestClassifier.predict_proba.
+
+        :param nodes:       структурный массив узлов (обычно np.memmap из load_forest)
+        """
+
+        self.nodes = nodes
+        self.feature = nodes['feature']
+        self.threshold = nodes['threshold']
+        self.left = nodes['left']
+        self.right = nodes['right']
+        self.value = nodes['value']
+
+        # Корни - узлы, которые не являются ничьими потомками, по порядку деревьев
+        is_root = np.ones(len(nodes), dtype=bool)
+        is_root[self.left[self.left != TREE_LEAF]] = False
+        is_root[self.right[self.right != TREE_LEAF]] = False
+        self.roots = np.flatnonzero(is_root)
+
+        self.n_estimators = len(self.roots)
+        self.n_classes_ = self.value.shape[1]
+
+    def predict_proba(self, X):
+        """
+        :param X:       матрица признаков (n, n_features)
+        :return:        np.ndarray (n, n_classes), как у RandomForestClassifier.predict_proba
+        """
+
+        return self.predict_mean(X)
+
+    def predict_mean(self, X):
+        """
+        Среднее по деревьям значение в листьях - для леса классификаторов это и есть вероятности классов
+
+        :param X:       матрица признаков (n, n_features)
+        :return:        np.ndarray (n, n_outputs)
+        """
+
+        # sklearn сравнивает признаки во float32 с порогами во float64, делаем так же
+        X = np.asarray(X, dtype=np.float32)
+        n_rows = X.shape[0]
+
+        # Пары (дерево, строка) идут плоско, на каждом шаге спускаемся только по тем, что еще не в листе
+        node = np.repeat(self.roots, n_rows)
+        row = np.tile(np.arange(n_rows), self.n_estimators)
+        active = np.arange(len(node))
+        while active.size:
+            current = node[active]
+            left = self.left[current]
+            inner = left != TREE_LEAF
+            active, current, left = active[inner], current[inner], left[inner]
+            go_left = X[row[active], self.feature[current]] <= self.threshold[current]
+            node[active] = np.where(go_left, left, self.right[current])
+
+        # Суммируем по деревьям по порядку, как RandomForestClassifier, чтобы совпадали и последние биты
+        proba = np.zeros((n_rows, self.n_classes_))
+        for tree_value in self.value[node].reshape(self.n_estimators, n_rows, self.n_classes_):
+            proba += tree_value
+        proba /= self.n_estimators
+        return proba
+
+
+def load_forest(path, mmap_mode='r'):
+    """
+    Загружает лес из export_forest. С mmap_mode='r' файл не читается целиком, а отображается в память,
+    так что несколько процессов бота делят одну копию в page cache.
+
+    :param path:        str / путь к .npy
+    :param mmap_mode:   режим np.load, None - прочитать в память целиком
+    :return:            ArrayForest
+    """
+
+    return ArrayForest(np.load(path, mmap_mode=mmap_mode))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Экспорт random forest из pickle в компактный .npy')
+    parser.add_argument('source', nargs='?', default='ml_models/random_forest.pkl')
+    parser.add_argument('target', nargs='?', default='ml_models/random_forest.npy')
+    args = parser.parse_args()
+
+    with open(args.source, 'rb') as file:
+        forest = pickle.load(file)
+
+    export_forest(forest, args.target)
+    exported = load_forest(args.target)
+
+    X = np.random.RandomState(0).normal(size=(1000, forest.estimators_[0].tree_.n_features))
+    diff = np.abs(exported.predict_proba(X) - forest.predict_proba(X)).max()
+    size = os.path.getsize(args.target)
+    print(f'{args.target}: {exported.n_estimators} trees, {len(exported.nodes)} nodes, '
+          f'{size / 1024 / 1024:.1f} MB, max proba diff {diff:g}')
+
+
+if __name__ == '__main__':
+    main()
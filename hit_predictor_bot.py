@@ -1,15 +1,40 @@
-from telegram.ext import Updater, CommandHandler, MessageHandler, ConversationHandler, Filters
-from predictor import predict
+import time
+
+from telegram import InlineQueryResultArticle, InputTextMessageContent
+from telegram.ext import Updater, CommandHandler, MessageHandler, InlineQueryHandler, ConversationHandler, Filters
+from async_service import PredictionService
+from new_releases import ReleaseIndex
+from scoring_pool import ScoringPool
+from permissions import PermissionIndex
+import metrics
+import predictor
 import settings
 
 
+permissions = PermissionIndex('permissions.txt',
+                              rate_limit=getattr(settings, 'RATE_LIMIT', None),
+                              rate_period=getattr(settings, 'RATE_PERIOD', 60),
+                              daily_quota=getattr(settings, 'DAILY_QUOTA', None))
+
+
+service = PredictionService(io_workers=getattr(settings, 'IO_WORKERS', 32),
+                            inference_workers=getattr(settings, 'INFERENCE_WORKERS', 4),
+                            max_in_flight=getattr(settings, 'MAX_IN_FLIGHT', 64),
+                            per_chat_in_flight=getattr(settings, 'PER_CHAT_IN_FLIGHT', 2),
+                            debounce=getattr(settings, 'INLINE_DEBOUNCE', 0.3))
+
+
+# Время обработки сообщения: проверка доступа, отправка ответа и весь путь от апдейта до отправленного ответа
+bot_seconds = {stage: metrics.histogram('bot_stage_seconds', 'Time spent handling Telegram messages', stage=stage)
+               for stage in ('permissions', 'send', 'message')}
+bot_messages = {result: metrics.counter('bot_messages_total', 'Telegram prediction requests by result', result=result)
+                for result in ('accepted', 'rejected', 'invalid', 'failed')}
+
+
 def _is_user_known(context, update):
     username = update.effective_user.username
 
-    with open('permissions.txt') as file:
-        users = file.read().rstrip().split('\n')
-
-    if username not in users:
+    if not permissions.is_known(username):
         context.bot.send_message(chat_id=update.effective_chat.id,
                                  text='Я тебя не знаю. Напиши @vnkl_iam. '
                                       'Может быть, он нас познакомит.')
@@ -19,6 +44,26 @@ def _is_user_known(context, update):
         return True
 
 
+def _is_request_allowed(context, update):
+    username = update.effective_user.username
+
+    reason = permissions.consume(username)
+    if reason == 'unknown':
+        return _is_user_known(context, update)
+    elif reason == 'rate_limited':
+        context.bot.send_message(chat_id=update.effective_chat.id,
+                                 text='Слишком много запросов подряд, дай мне немного передохнуть')
+        print(f'!!! @{username} rate limited')
+        return False
+    elif reason == 'quota_exceeded':
+        context.bot.send_message(chat_id=update.effective_chat.id,
+                                 text='На сегодня запросы закончились, приходи завтра')
+        print(f'!!! @{username} daily quota exceeded')
+        return False
+    else:
+        return True
+
+
 def start(update, context):
     if _is_user_known(context, update):
         chat_id = update.effective_message.chat_id
@@ -40,43 +85,223 @@ def start(update, context):
 
 
 def bot_predict(update, context):
-    if _is_user_known(context, update):
-        chat_id = update.effective_message.chat_id
-        text = update.message.text
-        if '&' in text:
-            context.bot.send_message(chat_id=chat_id,
-                                     text='Я не говорил? Символ & использовать нельзя - особенности работы '
-                                          'Spotify API. Замени его пробелом или запятой, как там больше подходит '
-                                          'на твой взгляд')
+    started = time.perf_counter()
+    chat_id = update.effective_message.chat_id
+    text = update.message.text
+
+    # Сначала доступ, потом текст, потом лимиты: невалидное сообщение не должно тратить запрос и дневную квоту
+    with bot_seconds['permissions'].time():
+        known = _is_user_known(context, update)
+    if not known:
+        bot_messages['rejected'].inc()
+        return
+
+    if '&' in text:
+        bot_messages['invalid'].inc()
+        context.bot.send_message(chat_id=chat_id,
+                                 text='Я не говорил? Символ & использовать нельзя - особенности работы '
+                                      'Spotify API. Замени его пробелом или запятой, как там больше подходит '
+                                      'на твой взгляд')
+        return
+
+    with bot_seconds['permissions'].time():
+        allowed = _is_request_allowed(context, update)
+    if not allowed:
+        bot_messages['rejected'].inc()
+        return
+
+    bot_messages['accepted'].inc()
+    username = update.effective_user.username
+
+    def reply(prediction):
+        with bot_seconds['send'].time():
+            _send_prediction(context, chat_id, text, username, prediction)
+        bot_seconds['message'].observe(time.perf_counter() - started)
+
+    def on_error(error):
+        bot_messages['failed'].inc()
+        context.bot.send_message(chat_id=chat_id,
+                                 text='Что-то пошло не так, попробуй еще раз чуть позже')
+
+    service.submit(chat_id, text, reply, on_error)
+
+
+TOP_DEFAULT = 10
+TOP_MAX = 30
+
+
+def top(update, context):
+    if not _is_user_known(context, update):
+        return
+
+    # /top, /top 20, /top US, /top 20 US
+    n = TOP_DEFAULT
+    country = None
+    for arg in context.args or []:
+        if arg.isdigit():
+            n = min(max(int(arg), 1), TOP_MAX)
         else:
-            prediction = predict(text)
-            if not prediction:
-                context.bot.send_message(chat_id=chat_id,
-                                         text='По твоему запросу в Spotify ничего не нашлось((')
-            else:
-                context.bot.send_message(chat_id=chat_id,
-                                         text=f"Вот, что нашлось в Spotify, и что я об этом думаю:\n\n"
-                                              f"\n{prediction['artist_name']} - {prediction['track_name']}\n"
-                                              f"Вероятность стать хитом:  {prediction['hit_proba'] * 100}%\n\n"
-                                              f"--------------\n\n"
-                                              f"Обрати внимание, тот ли это трек, который тебе был нужен? "
-                                              f"Spotify иногда находит не то, что мы ищем.\n\n"
-                                              f"И помни, что я пока не умею учитывать масштаб исполнителя и смысл "
-                                              f"текста.")
-                username = update.effective_user.username
-                print(f'@{username} get predict for {text}')
+            country = arg.upper()
+
+    chat_id = update.effective_message.chat_id
+    release_index = predictor.release_index
+    if release_index is not None and country is not None and country not in release_index.countries:
+        context.bot.send_message(chat_id=chat_id,
+                                 text=f'Новые релизы в {country} я не отслеживаю. '
+                                      f'Есть: {", ".join(release_index.countries)}')
+        return
+
+    tracks = release_index.top(n, country) if release_index is not None else []
+    if not tracks:
+        context.bot.send_message(chat_id=chat_id,
+                                 text='Новые релизы еще не посчитаны, загляни чуть позже')
+        return
+
+    lines = [f"{place}. {track['artist_name']} - {track['track_name']}: {track['hit_proba'] * 100:.0f}%"
+             for place, track in enumerate(tracks, 1)]
+    context.bot.send_message(chat_id=chat_id,
+                             text=f"Самые перспективные новые релизы{f' ({country})' if country else ''}:\n\n"
+                                  + '\n'.join(lines))
+    print(f'@{update.effective_user.username} get top {n} {country or ""}')
+
+
+def candidates(update, context):
+    if not _is_user_known(context, update):
+        bot_messages['rejected'].inc()
+        return
+
+    chat_id = update.effective_message.chat_id
+    text = ' '.join(context.args or [])
+    if not text or '&' in text:
+        bot_messages['invalid'].inc()
+        context.bot.send_message(chat_id=chat_id,
+                                 text='Напиши запрос после команды, например /candidates егор крид. '
+                                      'Символ & использовать нельзя')
+        return
+
+    if not _is_request_allowed(context, update):
+        bot_messages['rejected'].inc()
+        return
+
+    bot_messages['accepted'].inc()
+    username = update.effective_user.username
+
+    def reply(predictions):
+        if not predictions:
+            context.bot.send_message(chat_id=chat_id,
+                                     text='По твоему запросу в Spotify ничего не нашлось((')
+            return
+        lines = [f"{place}. {track['artist_name']} - {track['track_name']}: {track['hit_proba'] * 100:.0f}%"
+                 for place, track in enumerate(predictions, 1)]
+        context.bot.send_message(chat_id=chat_id,
+                                 text='Вот, что нашлось в Spotify, и что я об этом думаю:\n\n' + '\n'.join(lines))
+        print(f'@{username} get candidates for {text}')
+
+    def on_error(error):
+        bot_messages['failed'].inc()
+        context.bot.send_message(chat_id=chat_id,
+                                 text='Что-то пошло не так, попробуй еще раз чуть позже')
+
+    service.submit(chat_id, text, reply, on_error, candidates=predictor.CANDIDATES)
+
+
+INLINE_MIN_LENGTH = 3
+
+
+def inline_predict(update, context):
+    # Инлайн запрос приходит на каждую букву, поэтому лимит запросов списывается только с того,
+    # который пережил debounce в PredictionService, а дневная квота не тратится вовсе
+    inline_query = update.inline_query
+    username = update.effective_user.username
+    text = inline_query.query.strip()
+    if not permissions.is_known(username) or len(text) < INLINE_MIN_LENGTH or '&' in text:
+        return
+
+    def reply(predictions):
+        results = [InlineQueryResultArticle(
+                       id=track['track_id'],
+                       title=f"{track['artist_name']} - {track['track_name']}",
+                       description=f"Вероятность стать хитом: {track['hit_proba'] * 100:.0f}%",
+                       input_message_content=InputTextMessageContent(
+                           f"{track['artist_name']} - {track['track_name']}\n"
+                           f"Вероятность стать хитом:  {track['hit_proba'] * 100:.0f}%"))
+                   for track in predictions]
+        inline_query.answer(results, cache_time=getattr(settings, 'INLINE_CACHE_TIME', 300))
+        print(f'@{username} get inline candidates for {text}')
+
+    def allow():
+        reason = permissions.consume(username, quota=False)
+        if reason is not None:
+            print(f'!!! @{username} inline {reason}')
+        return reason is None
+
+    service.submit_inline(update.effective_user.id, text, reply, predictor.CANDIDATES, allow=allow)
+
+
+def _send_prediction(context, chat_id, text, username, prediction):
+    if not prediction:
+        context.bot.send_message(chat_id=chat_id,
+                                 text='По твоему запросу в Spotify ничего не нашлось((')
+    else:
+        context.bot.send_message(chat_id=chat_id,
+                                 text=f"Вот, что нашлось в Spotify, и что я об этом думаю:\n\n"
+                                      f"\n{prediction['artist_name']} - {prediction['track_name']}\n"
+                                      f"Вероятность стать хитом:  {prediction['hit_proba'] * 100}%\n\n"
+                                      f"--------------\n\n"
+                                      f"Обрати внимание, тот ли это трек, который тебе был нужен? "
+                                      f"Spotify иногда находит не то, что мы ищем.\n\n"
+                                      f"И помни, что я пока не умею учитывать масштаб исполнителя и смысл "
+                                      f"текста.")
+        print(f'@{username} get predict for {text}')
 
 
 def main():
+    started = time.perf_counter()
+
+    # Модель считается в отдельных процессах, если так настроено. Пул создается до всех потоков,
+    # потому что при fork воркеры получают уже загруженную модель
+    processes = getattr(settings, 'SCORING_PROCESSES', 0)
+    if processes:
+        predictor.scoring_pool = ScoringPool(processes, getattr(settings, 'SCORING_START_METHOD', 'fork'))
+
+    # Модель и клиент Spotify грузятся в фоне: /start и проверка доступа отвечают сразу после деплоя,
+    # а запросы на предсказание просто дождутся загрузки
+    predictor.warm_up(background=True)
+
+    # Новые релизы скорятся в фоне, /top и запросы про свежие треки отвечаются из готового индекса
+    if getattr(settings, 'NEW_RELEASES', True):
+        predictor.release_index = ReleaseIndex()
+        predictor.release_index.start()
+
+    permissions.install_reload_signal()     # kill -HUP перечитывает permissions.txt сразу
+
+    # Локальный /metrics для Prometheus и, если включено, /profile с сэмплирующим профайлером
+    metrics_port = getattr(settings, 'METRICS_PORT', None)
+    if metrics_port:
+        metrics.serve(metrics_port, getattr(settings, 'METRICS_HOST', '127.0.0.1'),
+                      profiler=getattr(settings, 'METRICS_PROFILER', False))
 
     bot = Updater(token=settings.TELEGRAM_TOKEN, request_kwargs=settings.PROXY, use_context=True)
     dp = bot.dispatcher
 
     dp.add_handler(CommandHandler('start', start))
+    dp.add_handler(CommandHandler('top', top))
+    dp.add_handler(CommandHandler('candidates', candidates))
+    dp.add_handler(InlineQueryHandler(inline_predict))
     dp.add_handler(MessageHandler(Filters.text, bot_predict))
 
+    service.start()         # Асинхронный конвейер предсказаний в отдельном потоке
     bot.start_polling()     # Собсно начинаем обращаться к телеге за апдейтами
+    print(f'Bot started in {time.perf_counter() - started:.3f}s')
     bot.idle()              # Означает, что бот работает до принудительной остановки
+    service.stop()
+    if predictor.release_index is not None:
+        predictor.release_index.stop()
+        print(f'New releases index stats: {predictor.release_index.stats()}')
+    print(f'Track index stats: {predictor.get_track_index().stats()}')
+    if predictor.scoring_pool is not None:
+        print(f'Scoring pool stats: {predictor.scoring_pool.stats()}')
+        predictor.scoring_pool.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,324 @@
+import abc
+import argparse
+import os
+import pickle
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+import numpy as np
+
+import features
+import forest_arrays
+
+
+BACKENDS = {}
+
+# Вероятности учителя обрезаются перед логитом, иначе 0 и 1 из леса дают бесконечные цели
+_DISTILL_EPS = 0.01
+
+
+def register(backend):
+    """
+    Добавляет бэкенд в реестр BACKENDS под его name. Можно использовать как декоратор класса.
+    Бэкенд без какого-то из методов Backend упадет с TypeError здесь же, при регистрации.
+
+    :param backend:     класс-наследник Backend
+    :return:            тот же класс
+    """
+
+    BACKENDS[backend.name] = backend()
+    return backend
+
+
+def get_backend(name):
+    """
+    :param name:    str / имя бэкенда из BACKENDS
+    :return:        Backend
+    """
+
+    try:
+        return BACKENDS[name]
+    except KeyError:
+        raise ValueError(f'Unknown inference backend {name!r}, available: {", ".join(BACKENDS)}') from None
+
+
+def _write_atomic(path, write):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as file:
+        write(file)
+    os.replace(tmp_path, path)
+
+
+def _logit(probas):
+    probas = np.clip(probas, _DISTILL_EPS, 1 - _DISTILL_EPS)
+    return np.log(probas / (1 - probas))
+
+
+def _sigmoid_proba(raw):
+    proba = 1 / (1 + np.exp(-raw))
+    return np.column_stack([1 - proba, proba])
+
+
+class Backend(abc.ABC):
+    """
+    Бэкенд инференса: как получить модель из обученного леса, сохранить ее и загрузить.
+    Модель бэкенда - любой объект с predict_proba(X) -> np.ndarray (n, 2), как у sklearn,
+    X - матрица после features.preprocess.
+
+    name - имя в реестре, extension - расширение файла модели,
+    distilled - модель учится заново на предсказаниях леса, а не конвертируется из него без потерь.
+    """
+
+    name = None
+    extension = None
+    distilled = False
+
+    @abc.abstractmethod
+    def build(self, forest, X):
+        """
+        :param forest:      обученный RandomForestClassifier (учитель)
+        :param X:           матрица после features.preprocess, на ней дистиллируется ученик
+        :return:            модель бэкенда
+        """
+
+    @abc.abstractmethod
+    def save(self, model, path):
+        pass
+
+    @abc.abstractmethod
+    def load(self, path):
+        pass
+
+
+@register
+class SklearnBackend(Backend):
+    name = 'sklearn'
+    extension = '.pkl'
+
+    def build(self, forest, X):
+        return forest
+
+    def save(self, model, path):
+        _write_atomic(path, lambda file: pickle.dump(model, file))
+
+    def load(self, path):
+        with open(path, 'rb') as file:
+            return pickle.load(file)
+
+
+@register
+class ArraysBackend(Backend):
+    name = 'arrays'
+    extension = '.npy'
+
+    def build(self, forest, X):
+        trees = [estimator.tree_ for estimator in forest.estimators_]
+        return forest_arrays.ArrayForest(forest_arrays.pack_trees(trees, int(forest.n_classes_)))
+
+    def save(self, model, path):
+        _write_atomic(path, lambda file: np.save(file, np.asarray(model.nodes)))
+
+    def load(self, path):
+        return forest_arrays.load_forest(path)
+
+
+class LogisticModel:
+
+    def __init__(self, coef, intercept):
+        """
+        Логистическая модель: p = sigmoid(X @ coef + intercept), одно матричное умножение на запрос
+
+        :param coef:        np.ndarray (n_features,)
+        :param intercept:   float
+        """
+
+        self.coef = coef
+        self.intercept = intercept
+
+    def predict_proba(self, X):
+        return _sigmoid_proba(np.asarray(X) @ self.coef + self.intercept)
+
+
+@register
+class LogisticBackend(Backend):
+    name = 'logistic'
+    extension = '.npz'
+    distilled = True
+
+    def __init__(self, alpha=1.0):
+        """
+        :param alpha:   float / L2 регуляризация
+        """
+
+        self.alpha = alpha
+
+    def build(self, forest, X):
+        # Ридж-регрессия на логит вероятностей леса: решается одной системой уравнений, без итераций
+        target = _logit(forest.predict_proba(X)[:, 1])
+        A = np.hstack([X, np.ones((len(X), 1))])
+        penalty = self.alpha * np.eye(A.shape[1])
+        penalty[-1, -1] = 0
+        weights = np.linalg.solve(A.T @ A + penalty, A.T @ target)
+        return LogisticModel(weights[:-1], float(weights[-1]))
+
+    def save(self, model, path):
+        _write_atomic(path, lambda file: np.savez(file, coef=model.coef, intercept=model.intercept))
+
+    def load(self, path):
+        with np.load(path) as data:
+            return LogisticModel(data['coef'], float(data['intercept']))
+
+
+class BoostedTrees:
+
+    def __init__(self, nodes, init, learning_rate):
+        """
+        Градиентный бустинг в формате forest_arrays: p = sigmoid(init + learning_rate * сумма деревьев)
+
+        :param nodes:           узлы деревьев из forest_arrays.pack_trees
+        :param init:            float / начальное значение бустинга
+        :param learning_rate:   float
+        """
+
+        self.nodes = nodes
+        self.init = init
+        self.learning_rate = learning_rate
+        self.trees = forest_arrays.ArrayForest(nodes)
+
+    def predict_proba(self, X):
+        raw = self.trees.predict_mean(X)[:, 0] * self.trees.n_estimators * self.learning_rate + self.init
+        return _sigmoid_proba(raw)
+
+
+@register
+class GradientBoostingBackend(Backend):
+    name = 'gbt'
+    extension = '.npz'
+    distilled = True
+
+    def __init__(self, n_estimators=60, max_depth=3, learning_rate=0.1):
+        self.n_estimators = n_estimators
+        self.max_depth = max_depth
+        self.learning_rate = learning_rate
+
+    def build(self, forest, X):
+        from sklearn.ensemble import GradientBoostingRegressor
+
+        boosting = GradientBoostingRegressor(n_estimators=self.n_estimators, max_depth=self.max_depth,
+                                             learning_rate=self.learning_rate, random_state=0)
+        boosting.fit(X, _logit(forest.predict_proba(X)[:, 1]))
+        nodes = forest_arrays.pack_trees([estimator.tree_ for estimator in boosting.estimators_[:, 0]], 1,
+                                         normalize=False)
+        init = float(np.ravel(boosting.init_.predict(X[:1]))[0])
+        return BoostedTrees(nodes, init, self.learning_rate)
+
+    def save(self, model, path):
+        _write_atomic(path, lambda file: np.savez(file, nodes=model.nodes, init=model.init,
+                                                  learning_rate=model.learning_rate))
+
+    def load(self, path):
+        with np.load(path) as data:
+            return BoostedTrees(data['nodes'], float(data['init']), float(data['learning_rate']))
+
+
+def _auc(y, probas):
+    from sklearn.metrics import roc_auc_score
+
+    if len(np.unique(y)) < 2:
+        return None
+    return float(roc_auc_score(y, probas))
+
+
+def compare(forest, scaler, X, y, names=None, test_size=0.25, seed=0, repeat=5):
+    """
+    Сравнение бэкендов с текущим лесом: ученики дистиллируются на части X, на отложенной части
+    считаются качество (ROC AUC и accuracy по y), совпадение с лесом (доля тех же решений при пороге 0.5
+    и средняя разница вероятностей), задержка на 1 и на 1000 строк, размер файла и память после загрузки.
+    Если лес обучался на всем X, его собственное качество на отложенной части завышено.
+
+    :param forest:      обученный RandomForestClassifier
+    :param scaler:      его StandardScaler
+    :param X:           np.ndarray из features.encode
+    :param y:           np.ndarray меток
+    :param names:       list имен бэкендов, по умолчанию все из BACKENDS
+    :param test_size:   float / доля строк для оценки
+    :param seed:        int / seed разбиения
+    :param repeat:      int / повторов замера задержки
+    :return:            словарь {name: метрики}
+    """
+
+    matrix = features.preprocess(X.astype(np.float64), scaler)
+    rows = np.random.RandomState(seed).permutation(len(matrix))
+    split = int(len(rows) * (1 - test_size))
+    train_rows, test_rows = rows[:split], rows[split:]
+    X_test, y_test = matrix[test_rows], y[test_rows]
+    teacher = forest.predict_proba(X_test)[:, 1]
+    sample = np.resize(X_test, (1000, X_test.shape[1]))
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in names or BACKENDS:
+            backend = get_backend(name)
+            started = time.perf_counter()
+            model = backend.build(forest, matrix[train_rows])
+            build_seconds = time.perf_counter() - started
+
+            path = os.path.join(tmp, f'model{backend.extension}')
+            backend.save(model, path)
+            tracemalloc.start()
+            model = backend.load(path)
+            memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            probas = model.predict_proba(X_test)[:, 1]
+            one_row = min(timeit.repeat(lambda: model.predict_proba(X_test[:1]), number=100, repeat=repeat)) / 100
+            many_rows = min(timeit.repeat(lambda: model.predict_proba(sample), number=1, repeat=repeat))
+
+            results[name] = {'auc': _auc(y_test, probas),
+                             'accuracy': float(((probas >= 0.5) == y_test).mean()),
+                             'agreement': float(((probas >= 0.5) == (teacher >= 0.5)).mean()),
+                             'mean_abs_diff': float(np.abs(probas - teacher).mean()),
+                             'one_row_us': one_row * 1e6,
+                             'rows_1000_ms': many_rows * 1e3,
+                             'file_mb': os.path.getsize(path) / 1024 / 1024,
+                             'heap_mb': memory / 1024 / 1024,
+                             'build_seconds': build_seconds}
+
+    base = results.get('sklearn')
+    for name, result in results.items():
+        auc = f'{result["auc"]:.4f}' if result['auc'] is not None else '-'
+        speedup = f' ({base["one_row_us"] / result["one_row_us"]:.1f}x)' if base else ''
+        print(f'{name:<9} auc {auc}, accuracy {result["accuracy"]:.4f}, agreement {result["agreement"]:.4f}, '
+              f'diff {result["mean_abs_diff"]:.4f}, 1 row {result["one_row_us"]:8.1f} us{speedup}, '
+              f'1000 rows {result["rows_1000_ms"]:7.2f} ms, file {result["file_mb"]:7.2f} MB, '
+              f'heap {result["heap_mb"]:7.2f} MB')
+    return results
+
+
+def main():
+    import predictor
+    import training
+
+    parser = argparse.ArgumentParser(description='Сравнение бэкендов инференса с текущим лесом и экспорт ученика')
+    parser.add_argument('dataset', nargs='?', default=os.path.join(training.DATA_DIR, 'dataset.npz'),
+                        help='выборка из training.build_dataset')
+    parser.add_argument('--backends', help=f'через запятую, по умолчанию все: {", ".join(BACKENDS)}')
+    parser.add_argument('--export', help='дистиллировать этот бэкенд на всей выборке и сохранить рядом с моделью')
+    args = parser.parse_args()
+
+    forest, scaler = training.load_models()
+    with np.load(args.dataset) as data:
+        X, y = data['X'], data['y']
+
+    if args.export:
+        training.save_models(forest, scaler, distilled=training.distill(forest, scaler, X, [args.export]))
+        print(f'Saved {predictor._model_path(args.export)}, set INFERENCE_BACKEND = {args.export!r} in settings')
+        return
+
+    compare(forest, scaler, X, y, args.backends.split(',') if args.backends else None)
+
+
+if __name__ == '__main__':
+    main()
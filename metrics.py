@@ -0,0 +1,292 @@
+import bisect
+import collections
+import sys
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+# Границы корзин в секундах: от полмиллисекунды до полуминуты, этого хватает от кэша до ретраев Spotify
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _labels_text(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+class _Timer:
+    __slots__ = ('histogram', 'started')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+class Counter:
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Histogram:
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """
+        Гистограмма с фиксированными корзинами: observe - это bisect и три сложения под локом,
+        без хранения самих значений, так что ее можно дергать на каждом запросе
+
+        :param buckets:     отсортированные верхние границы корзин
+        """
+
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        """
+        with histogram.time(): ... - записывает время выполнения блока в секундах
+        """
+
+        return _Timer(self)
+
+    def quantile(self, q):
+        """
+        Оценка квантиля по корзинам (линейная интерполяция внутри корзины, как histogram_quantile в Prometheus)
+
+        :param q:       float от 0 до 1
+        :return:        float или None, если наблюдений не было
+        """
+
+        with self._lock:
+            counts = list(self.counts)
+            total = self.count
+        if not total:
+            return None
+
+        rank = q * total
+        seen = 0
+        for index, count in enumerate(counts):
+            if count and seen + count >= rank:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+class Registry:
+
+    def __init__(self):
+        """
+        Набор метрик процесса и их выдача в текстовом формате Prometheus.
+        Метрика определяется именем и набором меток, повторный запрос с теми же именем и метками
+        возвращает тот же объект, поэтому метрики удобно создавать один раз на уровне модуля.
+        """
+
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._help = {}
+        self._collectors = []
+
+    def _get(self, kind, name, help_text, labels, factory):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = self._metrics[key] = factory()
+                    self._help.setdefault(name, (kind, help_text))
+        return metric
+
+    def counter(self, name, help_text='', **labels):
+        """
+        :return:    Counter для имени и меток
+        """
+
+        return self._get('counter', name, help_text, labels, Counter)
+
+    def histogram(self, name, help_text='', buckets=LATENCY_BUCKETS, **labels):
+        """
+        :return:    Histogram для имени и меток
+        """
+
+        return self._get('histogram', name, help_text, labels, lambda: Histogram(buckets))
+
+    def add_collector(self, collector):
+        """
+        Метрики, которые и так считаются где-то еще (кэши, склейка запросов, rate limiter):
+        collector() вызывается при каждой выдаче и возвращает список (name, kind, help, labels, value)
+
+        :param collector:   callable
+        """
+
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self):
+        """
+        :return:    str / все метрики в текстовом формате Prometheus
+        """
+
+        with self._lock:
+            metrics = sorted(self._metrics.items(), key=lambda item: item[0])
+            described = dict(self._help)
+            collectors = list(self._collectors)
+
+        lines = []
+        header_done = set()
+
+        def header(name, kind, help_text):
+            if name not in header_done:
+                header_done.add(name)
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+
+        for (name, labels), metric in metrics:
+            kind, help_text = described[name]
+            header(name, kind, help_text)
+            if kind == 'counter':
+                lines.append(f'{name}{_labels_text(labels)} {metric.value}')
+                continue
+            cumulative = 0
+            for bound, count in zip(metric.buckets + ('+Inf',), metric.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{_labels_text(labels + (("le", bound),))} {cumulative}')
+            lines.append(f'{name}_sum{_labels_text(labels)} {metric.sum}')
+            lines.append(f'{name}_count{_labels_text(labels)} {metric.count}')
+
+        for collector in collectors:
+            try:
+                collected = collector()
+            except Exception as error:
+                print(f'!!! Metrics collector failed: {error!r}')
+                continue
+            for name, kind, help_text, labels, value in collected:
+                header(name, kind, help_text)
+                lines.append(f'{name}{_labels_text(sorted(labels.items()))} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def counter(name, help_text='', **labels):
+    return registry.counter(name, help_text, **labels)
+
+
+def histogram(name, help_text='', buckets=LATENCY_BUCKETS, **labels):
+    return registry.histogram(name, help_text, buckets, **labels)
+
+
+def add_collector(collector):
+    registry.add_collector(collector)
+
+
+class SamplingProfiler:
+
+    def __init__(self, interval=0.005):
+        """
+        Сэмплирующий профайлер всех потоков процесса: раз в interval секунд снимает стеки
+        через sys._current_frames и считает одинаковые. Результат - collapsed stacks
+        (по строке "frame;frame;frame count"), из них flamegraph.pl или speedscope рисуют flame graph.
+        Пока не запущен, ничего не стоит.
+
+        :param interval:    float / период сэмплирования в секундах
+        """
+
+        self.interval = interval
+        self._lock = threading.Lock()
+
+    def profile(self, seconds):
+        """
+        Снимает профиль в течение seconds секунд. Одновременно идет только один профиль.
+
+        :param seconds:     float
+        :return:            str / collapsed stacks, самые частые сверху
+        """
+
+        stacks = collections.Counter()
+        with self._lock:
+            own_thread = threading.get_ident()
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id == own_thread:
+                        continue
+                    stack = traceback.extract_stack(frame)
+                    stacks[';'.join(f'{entry.name} ({entry.filename}:{entry.lineno})' for entry in stack)] += 1
+                time.sleep(self.interval)
+
+        return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
+
+
+class _Handler(BaseHTTPRequestHandler):
+    profiler = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/metrics':
+            body = registry.render()
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        elif url.path == '/profile' and self.profiler is not None:
+            seconds = float(parse_qs(url.query).get('seconds', ['10'])[0])
+            body = self.profiler.profile(min(seconds, 300))
+            content_type = 'text/plain; charset=utf-8'
+        else:
+            self.send_error(404)
+            return
+
+        data = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port, host='127.0.0.1', profiler=False):
+    """
+    Поднимает в фоновом потоке HTTP сервер: GET /metrics - метрики в формате Prometheus,
+    GET /profile?seconds=10 - профиль SamplingProfiler, если profiler включен
+
+    :param port:        int
+    :param host:        str / по умолчанию только локально
+    :param profiler:    bool / включить /profile
+    :return:            ThreadingHTTPServer (server.shutdown() - остановить)
+    """
+
+    handler = type('Handler', (_Handler,), {'profiler': SamplingProfiler() if profiler else None})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    return server
@@ -0,0 +1,263 @@
+import json
+import os
+import threading
+import time
+
+from track_index import index_key
+import predictor
+import settings
+
+
+NEW_RELEASES_PATH = getattr(settings, 'NEW_RELEASES_PATH', 'new_releases.json')
+NEW_RELEASES_COUNTRIES = getattr(settings, 'NEW_RELEASES_COUNTRIES', ['RU'])
+NEW_RELEASES_INTERVAL = getattr(settings, 'NEW_RELEASES_INTERVAL', 6 * 3600)
+RELEASE_TYPES = ('albums', 'singles', 'compilations')
+
+
+class ReleaseIndex:
+
+    def __init__(self, path=NEW_RELEASES_PATH, countries=NEW_RELEASES_COUNTRIES, interval=NEW_RELEASES_INTERVAL):
+        """
+        Заранее посчитанные предсказания для новых релизов: раз в interval секунд для каждой страны
+        берутся 100 новых альбомов и синглов (get_new_releases), раскрываются в треки (get_album_tracks),
+        фичи качаются пачками и весь список считается одним вызовом модели. Результат хранится в path,
+        поэтому после перезапуска индекс доступен сразу, без похода в Spotify.
+        Запросы про свежие треки и /top отвечаются из памяти. Если модель поменялась, индекс пересчитывается
+        по сохраненным фичам, тоже без Spotify.
+
+        :param path:        str / json с индексом
+        :param countries:   list стран в формате ISO 3166-1 (RU, US, DE и т.д.)
+        :param interval:    int / как часто обновлять индекс, в секундах
+        """
+
+        self.path = path
+        self.countries = list(countries)
+        self.interval = interval
+
+        self.lookups = 0
+        self.hits = 0
+        self.refreshes = 0
+        self.refresh_seconds = 0.0
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self._set_data(self._load())
+
+    def _load(self):
+        try:
+            with open(self.path, encoding='utf-8') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {'fetched_at': 0, 'version': None, 'tracks': {}, 'countries': {}}
+
+    def _save(self, data):
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(data, file, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def _set_data(self, data):
+        # Ключи поиска строятся один раз при обновлении, lookup - это два обращения к словарям
+        keys = {}
+        for track_id, track in data['tracks'].items():
+            key = index_key(f"{track['artist_name']} {track['track_name']}")
+            if key:
+                keys.setdefault(key, track_id)
+        with self._lock:
+            self._data = data
+            self._keys = keys
+
+    def _fetch(self):
+        """
+        :return:    (словарь {track_id: трек с фичами}, словарь {country: [track_id, ...]})
+        """
+
+        spotify = predictor.get_spotify()
+        tracks = {}
+        countries = {}
+        for country in self.countries:
+            new_releases = spotify.get_new_releases(country)
+            releases = {release['id']: release_type[:-1]
+                        for release_type in RELEASE_TYPES for release in new_releases[release_type]}
+            albums_tracks = spotify.get_album_tracks(list(releases)) if releases else {}
+
+            country_ids = []
+            for album_id, album_tracks in albums_tracks.items():
+                for track in album_tracks.values():
+                    track_id = track['track'][1]
+                    country_ids.append(track_id)
+                    tracks.setdefault(track_id, {'artist_name': ', '.join(artist[0] for artist in track['artists']),
+                                                 'track_name': track['track'][0],
+                                                 'album_id': album_id,
+                                                 'release_type': releases[album_id]})
+            countries[country] = list(dict.fromkeys(country_ids))
+
+        track_ids = list(tracks)
+        for track_id, track_features in zip(track_ids, spotify.get_audio_features(track_ids) if track_ids else []):
+            if track_features:
+                tracks[track_id]['features'] = track_features
+            else:
+                del tracks[track_id]
+        return tracks, countries
+
+    def _score(self, tracks):
+        if not tracks:
+            return predictor._models_version()
+        track_ids = list(tracks)
+        # Индекс считается в фоне, поэтому признаки исполнителя ждем без бюджета, чтобы новые релизы
+        # считались той же моделью, что и обычный запрос
+        artists, cacheable = predictor._fetch_artists(track_ids)
+        hit_probas, version = predictor._score([track['features'] for track in tracks.values()], artists)
+        for track_id, hit_proba in zip(track_ids, hit_probas):
+            tracks[track_id]['hit_proba'] = float(hit_proba)
+            if cacheable:
+                predictor.prediction_cache.put(track_id, hit_proba, version)
+        return version
+
+    def refresh(self):
+        """
+        Перекачивает новые релизы по всем странам и пересчитывает индекс
+        """
+
+        started = time.perf_counter()
+        tracks, countries = self._fetch()
+        version = self._score(tracks)
+        for country, track_ids in countries.items():
+            track_ids = [track_id for track_id in track_ids if track_id in tracks]
+            countries[country] = sorted(track_ids, key=lambda track_id: -tracks[track_id]['hit_proba'])
+
+        data = {'fetched_at': time.time(), 'version': version, 'tracks': tracks, 'countries': countries}
+        self._save(data)
+        self._set_data(data)
+        predictor.get_track_index().add_many(
+            (None, (track['artist_name'], track['track_name'], track_id)) for track_id, track in tracks.items())
+
+        seconds = time.perf_counter() - started
+        with self._lock:
+            self.refreshes += 1
+            self.refresh_seconds += seconds
+        print(f'New releases refreshed: {len(tracks)} tracks from {", ".join(countries)} in {seconds:.1f}s')
+
+    def rescore(self):
+        """
+        Пересчитывает индекс новой моделью по сохраненным фичам, без запросов в Spotify
+        """
+
+        with self._lock:
+            data = self._data
+        tracks = {track_id: dict(track) for track_id, track in data['tracks'].items()}
+        version = self._score(tracks)
+        countries = {country: sorted(track_ids, key=lambda track_id: -tracks[track_id]['hit_proba'])
+                     for country, track_ids in data['countries'].items()}
+
+        data = dict(data, version=version, tracks=tracks, countries=countries)
+        self._save(data)
+        self._set_data(data)
+        print(f'New releases rescored with model {version[:12]}')
+
+    def _current(self):
+        # Предсказания старой модели не отдаем - пусть запрос идет обычным путем, пока индекс не пересчитан
+        version = predictor._loaded_version()
+        if version is None or version != self._data['version']:
+            return None
+        return self._data
+
+    def lookup(self, q):
+        """
+        Мгновенный ответ для свежего трека: по айди, URI, ссылке или по "исполнитель название" в любом порядке.
+        Ни Spotify, ни модель не вызываются.
+
+        :param q:       str / запрос как в predictor.predict
+        :return:        словарь как у predictor.predict или None, если трека нет в индексе
+        """
+
+        with self._lock:
+            self.lookups += 1
+            data = self._current()
+            if data is None:
+                return None
+            track_id = predictor._parse_track_id(q) or self._keys.get(index_key(q) or '')
+            track = data['tracks'].get(track_id) if track_id else None
+            if track is None:
+                return None
+            self.hits += 1
+
+        return {'artist_name': track['artist_name'],
+                'track_name': track['track_name'],
+                'hit_proba': track['hit_proba']}
+
+    def top(self, n=10, country=None, release_type=None):
+        """
+        :param n:               int / сколько треков вернуть
+        :param country:         str / страна, по умолчанию - лучшие по всем странам
+        :param release_type:    str / album, single или compilation, по умолчанию - все
+        :return:                список словарей artist_name, track_name, track_id, release_type, hit_proba
+                                по убыванию hit_proba, пустой, если индекс еще не посчитан или посчитан
+                                старой моделью и ждет rescore
+        """
+
+        with self._lock:
+            data = self._current()
+        if data is None:
+            return []
+        if country is not None:
+            track_ids = data['countries'].get(country.upper(), [])
+        else:
+            track_ids = sorted(data['tracks'], key=lambda track_id: -data['tracks'][track_id]['hit_proba'])
+
+        top = []
+        for track_id in track_ids:
+            track = data['tracks'][track_id]
+            if release_type is None or track['release_type'] == release_type:
+                top.append({'artist_name': track['artist_name'],
+                            'track_name': track['track_name'],
+                            'track_id': track_id,
+                            'release_type': track['release_type'],
+                            'hit_proba': track['hit_proba']})
+                if len(top) == n:
+                    break
+        return top
+
+    def _run(self):
+        while True:
+            try:
+                if time.time() - self._data['fetched_at'] >= self.interval:
+                    self.refresh()
+                elif self._data['tracks'] and predictor._models_version() != self._data['version']:
+                    self.rescore()
+            except Exception as error:
+                print(f'!!! New releases refresh failed: {error!r}')
+            # Просыпаемся чаще, чем обновляемся, чтобы быстро заметить новую модель
+            if self._stop.wait(min(self.interval, 60)):
+                break
+
+    def start(self):
+        """
+        Запускает обновление индекса в фоновом потоке. Если сохраненный индекс еще свежий,
+        первое обновление будет по расписанию
+        """
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='new-releases', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        """
+        :return:    словарь: tracks, age_seconds - возраст индекса, lookups, hits, refreshes, среднее время обновления
+        """
+
+        with self._lock:
+            return {'tracks': len(self._data['tracks']),
+                    'age_seconds': time.time() - self._data['fetched_at'] if self._data['fetched_at'] else None,
+                    'lookups': self.lookups,
+                    'hits': self.hits,
+                    'refreshes': self.refreshes,
+                    'refresh_seconds': self.refresh_seconds / self.refreshes if self.refreshes else 0.0}
@@ -0,0 +1,146 @@
+import os
+import signal
+import threading
+import time
+
+
+class PermissionIndex:
+
+    def __init__(self, path='permissions.txt', check_interval=5, rate_limit=None, rate_period=60,
+                 daily_quota=None):
+        """
+        Список разрешенных пользователей в памяти. Файл перечитывается, только если у него поменялся mtime,
+        причем mtime проверяется не чаще раза в check_interval секунд, так что на каждое сообщение
+        нет ни чтения файла, ни даже stat. Перечитать сразу можно через reload() или сигнал SIGHUP.
+
+        Формат файла - по пользователю на строку, после имени можно указать личные лимиты:
+            vnkl_iam
+            someone rate=5 quota=100
+
+        :param path:            str / путь к файлу со списком
+        :param check_interval:  int / как часто (в секундах) проверять mtime файла
+        :param rate_limit:      int / сколько запросов можно сделать за rate_period, None - без ограничения
+        :param rate_period:     int / окно для rate_limit в секундах
+        :param daily_quota:     int / сколько запросов можно сделать за сутки, None - без ограничения
+        """
+
+        self.path = path
+        self.check_interval = check_interval
+        self.rate_limit = rate_limit
+        self.rate_period = rate_period
+        self.daily_quota = daily_quota
+
+        self.users = {}
+        self.reloads = 0
+
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._checked_at = 0.0
+        self._buckets = {}
+        self._usage = {}
+        self._usage_day = None
+
+        self.reload()
+
+    def _parse(self, line):
+        parts = line.split()
+        limits = {'rate': self.rate_limit, 'quota': self.daily_quota}
+        for part in parts[1:]:
+            name, _, value = part.partition('=')
+            if name in limits and value.isdigit():
+                limits[name] = int(value)
+        return parts[0], (limits['rate'], limits['quota'])
+
+    def reload(self):
+        """
+        Перечитывает файл. Если файл не читается, остается старый список.
+        """
+
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            with open(self.path) as file:
+                users = dict(self._parse(line) for line in file if line.strip())
+        except OSError as error:
+            print(f'!!! Permissions reload failed: {error!r}')
+            return
+
+        with self._lock:
+            self.users = users
+            self._mtime = mtime
+            self._checked_at = time.monotonic()
+            self.reloads += 1
+
+    def _refresh(self):
+        if time.monotonic() - self._checked_at < self.check_interval:
+            return
+        self._checked_at = time.monotonic()
+        try:
+            changed = os.stat(self.path).st_mtime_ns != self._mtime
+        except OSError:
+            return
+        if changed:
+            self.reload()
+
+    def install_reload_signal(self, signum=signal.SIGHUP):
+        """
+        Перечитывать файл по сигналу (по умолчанию SIGHUP). Вызывать из главного потока.
+        """
+
+        signal.signal(signum, lambda *_: self.reload())
+
+    def is_known(self, username):
+        """
+        :param username:    str / имя пользователя в Telegram
+        :return:            bool / есть ли пользователь в списке
+        """
+
+        self._refresh()
+        return username in self.users
+
+    def consume(self, username, quota=True):
+        """
+        Проверяет доступ и лимиты пользователя и, если все в порядке, засчитывает ему один запрос
+
+        :param username:    str / имя пользователя в Telegram
+        :param quota:       bool / учитывать дневную квоту, иначе только rate_limit
+        :return:            None, если можно, иначе причина: 'unknown', 'rate_limited', 'quota_exceeded'
+        """
+
+        self._refresh()
+        limits = self.users.get(username)
+        if limits is None:
+            return 'unknown'
+        rate_limit, daily_quota = limits
+        if not quota:
+            daily_quota = None
+
+        with self._lock:
+            now = time.monotonic()
+
+            if daily_quota is not None:
+                today = time.strftime('%Y-%m-%d')
+                if today != self._usage_day:
+                    self._usage_day = today
+                    self._usage = {}
+                if self._usage.get(username, 0) >= daily_quota:
+                    return 'quota_exceeded'
+
+            if rate_limit is not None:
+                # token bucket: rate_limit запросов подряд, дальше пополняется равномерно за rate_period
+                tokens, updated = self._buckets.get(username, (rate_limit, now))
+                tokens = min(rate_limit, tokens + (now - updated) * rate_limit / self.rate_period)
+                if tokens < 1:
+                    self._buckets[username] = (tokens, now)
+                    return 'rate_limited'
+                self._buckets[username] = (tokens - 1, now)
+
+            if daily_quota is not None:
+                self._usage[username] = self._usage.get(username, 0) + 1
+
+        return None
+
+    def stats(self):
+        return {'users': len(self.users),
+                'reloads': self.reloads,
+                'limited_users': len(self._buckets),
+                'quota_users': len(self._usage)}
@@ -0,0 +1,108 @@
+import sys
+import threading
+from collections import OrderedDict
+
+
+# Примерные накладные расходы OrderedDict на одну запись (узел связного списка + слот в хэш-таблице)
+_ENTRY_OVERHEAD = 100
+
+
+class PredictionCache:
+
+    def __init__(self, max_entries=100000, max_bytes=32 * 1024 * 1024):
+        """
+        LRU кэш предсказаний в памяти процесса: айди трека -> вероятность стать хитом.
+        Ограничен и по количеству записей, и по примерному объему памяти.
+        Кэш привязан к версии модели (хэшу файлов), при смене версии он сбрасывается.
+
+        :param max_entries:     int / максимальное количество записей
+        :param max_bytes:       int / примерный максимальный объем памяти под записи
+        """
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.version = None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _entry_size(track_id, hit_proba):
+        return sys.getsizeof(track_id) + sys.getsizeof(hit_proba) + _ENTRY_OVERHEAD
+
+    def get(self, track_id):
+        """
+        :param track_id:    айди трека
+        :return:            вероятность или None, если в кэше нет
+        """
+
+        with self._lock:
+            hit_proba = self._entries.get(track_id)
+            if hit_proba is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(track_id)
+            self.hits += 1
+            return hit_proba
+
+    def put(self, track_id, hit_proba, version):
+        """
+        Кладет предсказание в кэш. Если предсказание посчитано старой версией модели, оно отбрасывается.
+
+        :param track_id:    айди трека
+        :param hit_proba:   float
+        :param version:     версия модели, которой посчитано предсказание
+        """
+
+        with self._lock:
+            if version != self.version:
+                return
+
+            old = self._entries.pop(track_id, None)
+            if old is not None:
+                self._bytes -= self._entry_size(track_id, old)
+
+            self._entries[track_id] = hit_proba
+            self._bytes += self._entry_size(track_id, hit_proba)
+
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                old_id, old_proba = self._entries.popitem(last=False)
+                self._bytes -= self._entry_size(old_id, old_proba)
+                self.evictions += 1
+
+    def invalidate(self, version):
+        """
+        Сбрасывает кэш и переключает его на новую версию модели
+
+        :param version:     новая версия (хэш файлов модели)
+        """
+
+        with self._lock:
+            if version == self.version:
+                return
+            if self.version is not None:
+                self.invalidations += 1
+            self.version = version
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """
+        :return:    словарь со счетчиками: hits, misses, hit_rate, evictions, invalidations, entries, bytes
+        """
+
+        with self._lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': self.hits / total if total else 0.0,
+                    'evictions': self.evictions,
+                    'invalidations': self.invalidations,
+                    'entries': len(self._entries),
+                    'bytes': self._bytes}
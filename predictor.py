@@ -1,91 +1,772 @@
+import contextlib
+import fcntl
+import hashlib
+import os
 import pickle
-from spotipy_framework import Spotify
-import pandas as pd
-import numpy as np
+import threading
+import time
+from collections import namedtuple
+
+from spotipy_framework import Spotify, AUDIO_FEATURES_BATCH, normalize_query
+from artist_features import ArtistStage, ARTIST_BUDGET
+from spotify_cache import SpotifyCache
+from prediction_cache import PredictionCache
+from query_cache import PrefixQueryCache
+from single_flight import SingleFlight
+from track_index import TrackIndex
+import features
+import inference
+import metrics
+import settings
 
 from settings import SPOTIFY_SID, SPOTIFY_SECRET
 
 
-with open('ml_models/random_forest.pkl', 'rb') as file:
-    forest = pickle.load(file)
+FOREST_PATH = 'ml_models/random_forest.pkl'
+FOREST_ARRAYS_PATH = 'ml_models/random_forest.npy'
+SCALER_PATH = 'ml_models/scaler.pkl'
+EXTENDED_FOREST_PATH = 'ml_models/random_forest_artists.pkl'
+EXTENDED_SCALER_PATH = 'ml_models/scaler_artists.pkl'
+MODELS_LOCK_PATH = 'ml_models/.swap.lock'
+MODELS_CHECK_INTERVAL = getattr(settings, 'MODELS_CHECK_INTERVAL', 5)
 
-with open('ml_models/scaler.pkl', 'rb') as file:
-    scaler = pickle.load(file)
+# Сколько кандидатов из поиска оценивать для инлайн режима и /candidates. Сам поиск берет результатов с запасом,
+# чтобы следующие буквы запроса отвечались из PrefixQueryCache без нового поиска
+CANDIDATES = getattr(settings, 'CANDIDATES', 5)
+CANDIDATES_SEARCH_LIMIT = getattr(settings, 'CANDIDATES_SEARCH_LIMIT', 20)
 
-spotify = Spotify(SPOTIFY_SID, SPOTIFY_SECRET)
+# Имя бэкенда из inference.BACKENDS: sklearn, arrays, logistic, gbt. None - arrays, если .npy выгружен, иначе sklearn
+INFERENCE_BACKEND = getattr(settings, 'INFERENCE_BACKEND', None)
 
+# extended - (forest, scaler) расширенной модели с признаками исполнителя, если она обучена (training.py --artists)
+Models = namedtuple('Models', ['forest', 'scaler', 'version', 'extended'])
 
-def _search_track(q):
-    result = spotify.search_tracks(q)
-    if result[q]:
-        artist_name = ''
-        for i in result[q][0]['artists']:
-            artist_name += f'{i[0]}, '
-        artist_name = artist_name[:-2]
-        track_name = result[q][0]['track'][0]
-        track_id = result[q][0]['track'][1]
+
+def _backend():
+    if INFERENCE_BACKEND:
+        return INFERENCE_BACKEND
+    # Компактный формат из forest_arrays.py, если он выгружен, иначе обычный pickle
+    return 'arrays' if os.path.exists(FOREST_ARRAYS_PATH) else 'sklearn'
+
+
+def _model_path(name):
+    """
+    :param name:    str / имя бэкенда из inference.BACKENDS
+    :return:        str / где лежит модель этого бэкенда
+    """
+
+    if name == 'sklearn':
+        return FOREST_PATH
+    if name == 'arrays':
+        return FOREST_ARRAYS_PATH
+    return os.path.join(os.path.dirname(FOREST_PATH), f'model_{name}{inference.get_backend(name).extension}')
+
+
+def _forest_path():
+    return _model_path(_backend())
+
+
+def _has_extended():
+    # По файлам, а не по загруженной модели: со scoring_pool модель в этом процессе не грузится
+    return os.path.exists(EXTENDED_FOREST_PATH) and os.path.exists(EXTENDED_SCALER_PATH)
+
+
+def _models_paths():
+    paths = [_forest_path(), SCALER_PATH]
+    if _has_extended():
+        paths += [EXTENDED_FOREST_PATH, EXTENDED_SCALER_PATH]
+    return paths
+
+
+def _models_stat():
+    return tuple((path, os.stat(path).st_mtime_ns, os.stat(path).st_size) for path in _models_paths())
+
+
+@contextlib.contextmanager
+def models_swap_lock(exclusive=False, blocking=True):
+    """
+    Межпроцессная блокировка файлов модели (flock на MODELS_LOCK_PATH). Кто подменяет лес и скейлер,
+    берет ее эксклюзивно, кто читает - разделяемо, так что бот никогда не загрузит новый лес со старым скейлером.
+
+    :param exclusive:   bool / эксклюзивная блокировка (для подмены файлов)
+    :param blocking:    bool / ждать блокировку, иначе BlockingIOError, если она занята
+    """
+
+    with open(MODELS_LOCK_PATH, 'a') as lock_file:
+        operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        fcntl.flock(lock_file, operation if blocking else operation | fcntl.LOCK_NB)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _load_models():
+    digest = hashlib.sha256()
+    loaded = []
+    for n, path in enumerate(_models_paths()):
+        if not n:
+            # Модель грузит ее бэкенд (.npy, например, через mmap), поэтому хэш считаем отдельным чтением
+            with open(path, 'rb') as file:
+                for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                    digest.update(chunk)
+            loaded.append(inference.get_backend(_backend()).load(path))
+        else:
+            with open(path, 'rb') as file:
+                data = file.read()
+            digest.update(data)
+            loaded.append(pickle.loads(data))
+    extended = (loaded[2], loaded[3]) if len(loaded) == 4 else None
+    return Models(loaded[0], loaded[1], digest.hexdigest(), extended)
+
+
+models = None
+_models_lock = threading.Lock()
+_models_last_stat = None
+_models_checked_at = 0.0
+
+# Версия модели воркеров scoring_pool, на которой сейчас кэш предсказаний, и файлы модели на момент перехода на нее
+_pool_version = None
+_pool_models_stat = None
+_pool_version_lock = threading.Lock()
+
+prediction_cache = PredictionCache(getattr(settings, 'PREDICTION_CACHE_ENTRIES', 100000),
+                                   getattr(settings, 'PREDICTION_CACHE_BYTES', 32 * 1024 * 1024))
+
+spotify = None
+_spotify_lock = threading.Lock()
+
+# Нечеткий индекс уже найденных треков, создается вместе с клиентом Spotify на том же кэше
+track_index = None
+
+# scoring_pool.ScoringPool, если модель считается в отдельных процессах (см. hit_predictor_bot.main)
+scoring_pool = None
+
+# new_releases.ReleaseIndex с заранее посчитанными новыми релизами, если он запущен (см. hit_predictor_bot.main)
+release_index = None
+
+TRACK_ID_LENGTH = 22
+
+query_flights = SingleFlight()
+track_flights = SingleFlight()
+
+startup_times = {}
+
+candidates_cache = PrefixQueryCache(getattr(settings, 'CANDIDATES_CACHE_ENTRIES', 10000),
+                                    getattr(settings, 'CANDIDATES_CACHE_TTL', 600))
+
+# Признаки исполнителя для расширенной модели, ждем их не дольше ARTIST_BUDGET секунд на запрос
+artist_stage = ArtistStage(lambda: get_spotify(), getattr(settings, 'ARTIST_BUDGET', ARTIST_BUDGET),
+                           getattr(settings, 'ARTIST_WORKERS', 4))
+
+# Время этапов предсказания и итоги запросов, отдаются через metrics (/metrics у бота)
+stage_seconds = {stage: metrics.histogram('predict_stage_seconds', 'Time spent in predictor stages', stage=stage)
+                 for stage in ('search', 'audio_features', 'artists', 'encode', 'model', 'score', 'total')}
+predict_results = {result: metrics.counter('predict_total', 'Predictions by result', result=result)
+                   for result in ('found', 'not_found', 'error')}
+
+
+def _collect_metrics():
+    collected = []
+    stats = prediction_cache.stats()
+    for name in ('hits', 'misses', 'evictions', 'invalidations'):
+        collected.append(('prediction_cache_total', 'counter', 'Prediction cache events', {'event': name}, stats[name]))
+    collected.append(('prediction_cache_entries', 'gauge', 'Prediction cache entries', {}, stats['entries']))
+
+    for kind, stats in flight_stats().items():
+        for name in ('executions', 'shared'):
+            collected.append(('predict_flights_total', 'counter', 'Coalesced identical requests',
+                              {'kind': kind, 'event': name}, stats[name]))
+
+    if spotify is not None:
+        for name, value in spotify.rate_limiter.stats().items():
+            collected.append(('spotify_requests', 'counter', 'Spotify API client counters', {'event': name}, value))
+        if spotify.cache is not None:
+            stats = spotify.cache.stats()
+            for name in ('hits', 'misses', 'evictions'):
+                collected.append(('spotify_cache_total', 'counter', 'Spotify cache events', {'event': name},
+                                  stats[name]))
+        stats = track_index.stats()
+        for name in ('lookups', 'hits'):
+            collected.append(('track_index_total', 'counter', 'Track index lookups', {'event': name}, stats[name]))
+        collected.append(('track_index_saved_seconds', 'counter', 'Estimated search time saved by the track index',
+                          {}, stats['saved_seconds']))
+
+    stats = artist_stage.stats()
+    for name in ('requests', 'timeouts', 'errors', 'rejected'):
+        collected.append(('artist_features_total', 'counter', 'Artist feature lookups', {'event': name}, stats[name]))
+
+    stats = candidates_cache.stats()
+    for name in ('hits', 'prefix_hits', 'misses'):
+        collected.append(('candidates_cache_total', 'counter', 'Candidate search cache lookups', {'event': name},
+                          stats[name]))
+
+    if release_index is not None:
+        stats = release_index.stats()
+        for name in ('lookups', 'hits'):
+            collected.append(('release_index_total', 'counter', 'New releases index lookups', {'event': name},
+                              stats[name]))
+        collected.append(('release_index_tracks', 'gauge', 'Tracks in the new releases index', {}, stats['tracks']))
+
+    version = _loaded_version()
+    if version is not None:
+        collected.append(('models_info', 'gauge', 'Loaded model version',
+                          {'version': version[:12], 'backend': _backend()}, 1))
+    return collected
+
+
+metrics.add_collector(_collect_metrics)
+
+
+def _check_models():
+    """
+    Загружает модель и скейлер при первом обращении. Дальше раз в MODELS_CHECK_INTERVAL секунд
+    проверяет их файлы, и если они поменялись (по хэшу содержимого), перезагружает модель
+    и сбрасывает кэш предсказаний. Перезагрузка идет в одном потоке, остальные запросы в это время
+    считаются на старой модели. Если файлы сейчас подменяются (models_swap_lock) или не читаются,
+    работаем на старой модели до следующей проверки.
+
+    :return:    актуальные Models
+    """
+
+    global models, _models_last_stat, _models_checked_at
+
+    if models is not None and time.monotonic() - _models_checked_at < MODELS_CHECK_INTERVAL:
+        return models
+
+    if models is None:
+        with _models_lock:
+            if models is None:
+                started = time.perf_counter()
+                with models_swap_lock():
+                    _models_last_stat = _models_stat()
+                    loaded = _load_models()
+                prediction_cache.invalidate(loaded.version)
+                _models_checked_at = time.monotonic()
+                models = loaded
+                startup_times['models'] = time.perf_counter() - started
+        return models
+
+    # Перезагрузку делает один поток, остальные не ждут его и продолжают считать на старой модели
+    if not _models_lock.acquire(blocking=False):
+        return models
+    try:
+        if time.monotonic() - _models_checked_at < MODELS_CHECK_INTERVAL:
+            return models
+        _models_checked_at = time.monotonic()
+
+        # Пока файлы подменяются (training.save_models), не читаем их - проверим в следующий раз
+        with models_swap_lock(blocking=False):
+            stat = _models_stat()
+            if stat != _models_last_stat:
+                new_models = _load_models()
+                _models_last_stat = stat
+                if new_models.version != models.version:
+                    prediction_cache.invalidate(new_models.version)
+                    models = new_models
+                    print(f'Models reloaded, version {models.version[:12]}')
+    except BlockingIOError:
+        pass
+    except Exception as error:
+        print(f'!!! Models reload failed: {error!r}')
+    finally:
+        _models_lock.release()
+
+    return models
+
+
+def _accept_pool_version(version):
+    """
+    Версия модели, которую сообщил воркер scoring_pool. Воркеры перезагружают модель каждый по своему таймеру
+    и во время подмены файлов отвечают разными версиями. На другую версию переходим (и сбрасываем кэш
+    предсказаний), только если файлы модели поменялись с прошлого перехода - иначе это отстающий воркер
+    со старой моделью, и его предсказания в кэш просто не попадут.
+
+    :param version:     str / версия от воркера
+    :return:            версия, на которой сейчас кэш предсказаний
+    """
+
+    global _pool_version, _pool_models_stat
+
+    if version == _pool_version:
+        return _pool_version
+    try:
+        stat = _models_stat()
+    except OSError:
+        return _pool_version        # файлы сейчас подменяются
+    with _pool_version_lock:
+        if version != _pool_version and (_pool_version is None or stat != _pool_models_stat):
+            _pool_version, _pool_models_stat = version, stat
+            prediction_cache.invalidate(version)
+    return _pool_version
+
+
+def _models_version():
+    """
+    :return:    версия модели, которой сейчас считаются предсказания. Со scoring_pool ее сообщает воркер,
+                а в этом процессе модель не грузится
+    """
+
+    if scoring_pool is not None:
+        return _accept_pool_version(scoring_pool.check_version())
+    return _check_models().version
+
+
+def _loaded_version():
+    """
+    :return:    последняя известная версия модели без загрузки и без обращения к воркерам, None - еще не загружена
+    """
+
+    if scoring_pool is not None:
+        return _pool_version
+    return models.version if models is not None else None
+
+
+def get_spotify():
+    """
+    Клиент Spotify с кэшем, создается при первом обращении
+
+    :return:    spotipy_framework.Spotify
+    """
+
+    global spotify, track_index
+
+    if spotify is None:
+        with _spotify_lock:
+            if spotify is None:
+                started = time.perf_counter()
+                cache = SpotifyCache(getattr(settings, 'SPOTIFY_CACHE_PATH', 'spotify_cache.sqlite'))
+                track_index = TrackIndex(cache)
+                spotify = Spotify(SPOTIFY_SID, SPOTIFY_SECRET, cache=cache)
+                startup_times['spotify'] = time.perf_counter() - started
+    return spotify
+
+
+def get_track_index():
+    """
+    :return:    track_index.TrackIndex на кэше клиента Spotify
+    """
+
+    get_spotify()
+    return track_index
+
+
+def warm_up(background=False):
+    """
+    Заранее загружает модель и создает клиент Spotify, чтобы первый запрос не ждал загрузки
+
+    :param background:      bool / грузить в фоновом потоке и сразу вернуть управление
+    :return:                threading.Thread, если background, иначе None
+    """
+
+    def run():
+        started = time.perf_counter()
+        try:
+            get_spotify()
+            _models_version()
+        except Exception as error:
+            print(f'!!! Warm-up failed: {error!r}')
+            return
+        startup_times['warm_up'] = time.perf_counter() - started
+        report = ', '.join(f'{stage} {seconds:.3f}s' for stage, seconds in startup_report().items())
+        print(f'Warm-up finished: {report}')
+
+    if background:
+        thread = threading.Thread(target=run, name='warm-up', daemon=True)
+        thread.start()
+        return thread
+    run()
+
+
+def startup_report():
+    """
+    :return:    словарь {этап: секунды}: создание клиента Spotify, загрузка модели, весь warm-up
+    """
+
+    return dict(startup_times)
+
+
+def _top_hit(tracks):
+    if tracks:
+        artist_name = ', '.join(artist[0] for artist in tracks[0]['artists'])
+        track_name = tracks[0]['track'][0]
+        track_id = tracks[0]['track'][1]
         return artist_name, track_name, track_id
     else:
         return None, None, None
 
 
-def _create_df(features):
-    df = pd.DataFrame({
-        'danceability': [features['danceability']],
-        'energy': [features['energy']],
-        'loudness': [features['loudness']],
-        'mode': [features['mode']],
-        'speechiness': [features['speechiness']],
-        'acousticness': [features['acousticness']],
-        'instrumentalness': [features['instrumentalness']],
-        'liveness': [features['liveness']],
-        'valence': [features['valence']],
-        'tempo': [features['tempo']],
-        'duration_ms': [features['duration_ms']],
-        'key_1': [1 if features['key'] == 1 else 0],
-        'key_2': [1 if features['key'] == 2 else 0],
-        'key_3': [1 if features['key'] == 3 else 0],
-        'key_4': [1 if features['key'] == 4 else 0],
-        'key_5': [1 if features['key'] == 5 else 0],
-        'key_6': [1 if features['key'] == 6 else 0],
-        'key_7': [1 if features['key'] == 7 else 0],
-        'key_8': [1 if features['key'] == 8 else 0],
-        'key_9': [1 if features['key'] == 9 else 0],
-        'key_10': [1 if features['key'] == 10 else 0],
-        'key_11': [1 if features['key'] == 11 else 0],
-        'time_signature_3': [1 if features['time_signature'] == 3 else 0],
-        'time_signature_4': [1 if features['time_signature'] == 4 else 0],
-        'time_signature_5': [1 if features['time_signature'] == 5 else 0],
-    })
-    return df
-
-
-def _preprocess_df(df):
-    numerical = ['danceability', 'energy', 'loudness', 'speechiness', 'acousticness', 'instrumentalness',
-                 'liveness', 'valence', 'tempo', 'duration_ms']
-    df['duration_ms'] = (df['duration_ms'] + 1).apply(np.log)
-    df['instrumentalness'] = (df['instrumentalness'] + 1).apply(np.log)
-    df['liveness'] = (df['liveness'] + 1).apply(np.log)
-    df['speechiness'] = (df['speechiness'] + 1).apply(np.log)
-    df[numerical] = scaler.transform(df[numerical])
-    return df
+def _hits(tracks):
+    """
+    :param tracks:  треки одного запроса из search_tracks
+    :return:        list (artist_name, track_name, track_id) в порядке выдачи
+    """
 
+    return [_top_hit([track]) for track in tracks.values()]
+
+
+def _search_track(q):
+    with stage_seconds['search'].time():
+        # Сначала локальный индекс, в поиск Spotify - только за первым результатом
+        track = get_track_index().get(q)
+        if track is not None:
+            return track
+
+        started = time.perf_counter()
+        result = get_spotify().search_tracks(q, limit=1)
+        track_index.record_search(time.perf_counter() - started)
+
+        track = _top_hit(result[q])
+        track_index.add(q, track)
+        return track
+
+
+def _parse_track_id(q):
+    """
+    Достает айди трека из запроса, если это айди, URI (spotify:track:...) или ссылка на трек
+
+    :param q:       str
+    :return:        track_id или None, если это обычный поисковый запрос
+    """
+
+    q = q.strip()
+    if q.startswith('spotify:track:'):
+        q = q[len('spotify:track:'):]
+    elif '/track/' in q:
+        q = q.split('/track/', 1)[1].split('?', 1)[0]
+    if len(q) == TRACK_ID_LENGTH and q.isalnum() and q.isascii():
+        return q
+    return None
+
+
+def _hit_probas(tracks_features, current, artists=None):
+    forest, scaler = current.forest, current.scaler
+    with stage_seconds['encode'].time():
+        if artists is not None and current.extended is not None:
+            forest, scaler = current.extended
+            matrix = features.encode_extended(tracks_features, artists)
+        else:
+            matrix = features.encode(tracks_features)
+        matrix = features.preprocess(matrix, scaler)
+    with stage_seconds['model'].time():
+        return forest.predict_proba(matrix)[:, 1]
+
+
+def _score(tracks_features, artists=None):
+    """
+    Считает модель для списка аудио фич: в этом процессе или, если подключен scoring_pool, в пуле процессов.
+    С признаками исполнителя считается расширенная модель, если она загружена, иначе базовая.
+
+    :param tracks_features:     list словарей с аудио фичами
+    :param artists:             np.ndarray из features.encode_artists в том же порядке или None
+    :return:                    (np.ndarray вероятностей, версия модели, которой они посчитаны)
+    """
+
+    with stage_seconds['score'].time():
+        if scoring_pool is not None:
+            hit_probas, version = scoring_pool.score(tracks_features, artists=artists)
+            # Модель перезагружают воркеры, а кэш предсказаний живет здесь - переключаем его по их версии
+            _accept_pool_version(version)
+            return hit_probas, version
+        current = _check_models()
+        return _hit_probas(tracks_features, current, artists), current.version
+
+
+# Расширенная модель есть, но artist_stage перегружен: запрос считается базовой моделью и не кэшируется
+_ARTISTS_REJECTED = object()
+
+
+def _start_artists(track_ids):
+    # Признаки исполнителя нужны только расширенной модели, без нее в Spotify за ними не ходим
+    if not _has_extended():
+        return None
+    pending = artist_stage.submit(track_ids)
+    return pending if pending is not None else _ARTISTS_REJECTED
+
+
+def _wait_artists(pending):
+    """
+    :param pending:     то, что вернул _start_artists
+    :return:            (признаки исполнителя или None, можно ли класть результат в кэш предсказаний)
+    """
+
+    if pending is None:
+        return None, True
+    if pending is _ARTISTS_REJECTED:
+        return None, False
+    with stage_seconds['artists'].time():
+        artists = artist_stage.result(pending)
+    # Предсказание базовой моделью вместо расширенной не кэшируем - в следующий раз исполнители уже будут в кэше
+    return artists, artists is not None
+
+
+def _fetch_artists(track_ids):
+    """
+    Признаки исполнителя без бюджета - для пакетной обработки и фоновых задач, где ждать можно,
+    а бюджет и лимит artist_stage для интерактивных запросов только заставили бы молча считать базовой моделью
+
+    :param track_ids:   list айди треков
+    :return:            (признаки исполнителя или None, можно ли класть результат в кэш предсказаний)
+    """
+
+    if not _has_extended():
+        return None, True
+    try:
+        with stage_seconds['artists'].time():
+            return artist_stage.fetch(track_ids), True
+    except Exception as error:
+        print(f'!!! Artist features failed: {error!r}')
+        return None, False
+
+
+def _resolve(qs):
+    """
+    Превращает запросы в треки: айди трека резолвится через tracks info, остальное - через локальный индекс
+    track_index, а чего в нем нет - через поиск
+
+    :param qs:      list запросов
+    :return:        словарь {q: (artist_name, track_name, track_id)}
+    """
+
+    resolved = {}
+    ids = {}
+    searches = []
+    for q in qs:
+        track_id = _parse_track_id(q)
+        if track_id:
+            ids[q] = track_id
+        else:
+            searches.append(q)
+
+    if ids:
+        info = get_spotify().get_tracks_info(list(set(ids.values())))
+        for q, track_id in ids.items():
+            track = info.get(track_id)
+            if track:
+                artist_name = ', '.join(artist[0] for artist in track['artists'])
+                resolved[q] = artist_name, track['track'], track_id
+            else:
+                resolved[q] = None, None, None
+
+    if searches:
+        resolved.update(get_track_index().get_many(searches))
+        searches = list({q for q in searches if q not in resolved})
+
+    if searches:
+        started = time.perf_counter()
+        result = get_spotify().search_tracks(searches, limit=1)
+        track_index.record_search(time.perf_counter() - started, len(searches))
+
+        found = {q: _top_hit(result[q]) for q in searches}
+        track_index.add_many(found.items())
+        resolved.update(found)
+
+    return resolved
+
+
+def _cached_probas(track_ids):
+    """
+    :param track_ids:   iterable айди треков
+    :return:            (словарь {track_id: hit_proba} из кэша предсказаний, list айди без предсказания в кэше)
+    """
+
+    probas = {}
+    missing = []
+    for track_id in dict.fromkeys(track_ids):
+        hit_proba = prediction_cache.get(track_id)
+        if hit_proba is None:
+            missing.append(track_id)
+        else:
+            probas[track_id] = hit_proba
+    return probas, missing
+
+
+def _score_features(track_ids, tracks_features, artists, cacheable):
+    """
+    Один вызов модели на все треки, у которых нашлись аудио фичи, и запись в кэш предсказаний.
+    Общий конец пути для синхронного predictor и async_service.PredictionService.
+
+    :param track_ids:           list айди треков
+    :param tracks_features:     list аудио фич в том же порядке (None, если фич нет)
+    :param artists:             признаки исполнителя из _wait_artists в том же порядке или None
+    :param cacheable:           bool из _wait_artists / можно ли класть предсказания в кэш
+    :return:                    словарь {track_id: hit_proba}
+    """
+
+    rows = [row for row, track in enumerate(tracks_features) if track]
+    if not rows:
+        return {}
+    hit_probas, version = _score([tracks_features[row] for row in rows],
+                                 artists[rows] if artists is not None else None)
+    probas = {}
+    for row, hit_proba in zip(rows, hit_probas):
+        probas[track_ids[row]] = hit_proba
+        if cacheable:
+            prediction_cache.put(track_ids[row], hit_proba, version)
+    return probas
+
+
+def _fetch_and_score_ids(track_ids, budget=True):
+    if not budget:
+        with stage_seconds['audio_features'].time():
+            tracks_features = get_spotify().get_audio_features(track_ids)
+        artists, cacheable = _fetch_artists(track_ids)
+        return _score_features(track_ids, tracks_features, artists, cacheable)
+
+    # Признаки исполнителя качаются в фоне одновременно с аудио фичами
+    pending = _start_artists(track_ids)
+    with stage_seconds['audio_features'].time():
+        tracks_features = get_spotify().get_audio_features(track_ids)
+    artists, cacheable = _wait_artists(pending)
+    return _score_features(track_ids, tracks_features, artists, cacheable)
+
+
+def _score_track_ids(track_ids, budget=True):
+    """
+    Вероятности для списка треков: из кэша предсказаний, а для остальных - один запрос audio features
+    (пачками по 100) и один вызов модели на все
+
+    :param track_ids:   iterable айди треков
+    :param budget:      bool / ждать признаки исполнителя не дольше ARTIST_BUDGET (интерактивный запрос),
+                        иначе ждать их полностью (пакетная обработка)
+    :return:            словарь {track_id: hit_proba} для треков, у которых нашлись аудио фичи
+    """
+
+    probas, missing = _cached_probas(track_ids)
+    if missing:
+        probas.update(_fetch_and_score_ids(missing, budget))
+    return probas
+
+
+def _predict_batch(qs):
+    resolved = _resolve(qs)
+    # predict_many - пакетная обработка, бюджет интерактивных запросов к ней не относится
+    probas = _score_track_ids((track[2] for track in resolved.values() if track[2]), budget=False)
+
+    for q in qs:
+        artist_name, track_name, track_id = resolved[q]
+        if track_id in probas:
+            yield q, {'artist_name': artist_name,
+                      'track_name': track_name,
+                      'hit_proba': probas[track_id]}
+        else:
+            yield q, None
+
+
+def _fetch_and_score(track_id):
+    return _fetch_and_score_ids([track_id]).get(track_id)
+
+
+def _score_track(track_id):
+    hit_proba = prediction_cache.get(track_id)
+    if hit_proba is None:
+        hit_proba = track_flights.do(track_id, _fetch_and_score, track_id)
+    return hit_proba
+
+
+def _predict(q):
+    if release_index is not None:
+        prediction = release_index.lookup(q)
+        if prediction is not None:
+            return prediction
 
-def predict(q):
     artist_name, track_name, track_id = _search_track(q)
     if not track_id:
         return None
     else:
-        track_features = spotify.get_audio_features(track_id)[0]
-        df = _create_df(track_features)
-        df = _preprocess_df(df)
-        predict_proba = forest.predict_proba(df)
-        hit_proba = predict_proba[0][1]
+        hit_proba = _score_track(track_id)
+        if hit_proba is None:
+            return None
         return {'artist_name': artist_name,
                 'track_name': track_name,
                 'hit_proba': hit_proba}
 
 
+def predict(q):
+    """
+    Предсказание для одного запроса. Одинаковые запросы, которые пришли одновременно,
+    склеиваются в один поиск и одно предсказание.
+
+    :param q:       str / поисковый запрос
+    :return:        {'artist_name': str, 'track_name': str, 'hit_proba': float} или None
+    """
+
+    with stage_seconds['total'].time():
+        try:
+            prediction = query_flights.do(normalize_query(q), _predict, q)
+        except Exception:
+            predict_results['error'].inc()
+            raise
+    predict_results['found' if prediction else 'not_found'].inc()
+    return prediction
+
+
+def flight_stats():
+    """
+    :return:    счетчики склейки одинаковых запросов: по поисковым запросам и по айди треков
+    """
+
+    return {'queries': query_flights.stats(),
+            'tracks': track_flights.stats()}
+
+
+def _search_candidates(q, n):
+    tracks = candidates_cache.get(q, n)
+    if tracks is not None:
+        return tracks
+
+    with stage_seconds['search'].time():
+        result = get_spotify().search_tracks(q, limit=max(CANDIDATES_SEARCH_LIMIT, n))
+    found = _hits(result[q])
+    candidates_cache.put(q, found)
+    get_track_index().add_many((None, track) for track in found)
+    return found[:n]
+
+
+def _predict_candidates(q, n):
+    tracks = _search_candidates(q, n)
+    probas = _score_track_ids(track[2] for track in tracks)
+    return [{'artist_name': artist_name,
+             'track_name': track_name,
+             'track_id': track_id,
+             'hit_proba': probas[track_id]}
+            for artist_name, track_name, track_id in tracks if track_id in probas]
+
+
+def predict_candidates(q, n=CANDIDATES):
+    """
+    Предсказания для первых n результатов поиска, а не только для первого: один поиск (или PrefixQueryCache),
+    один запрос audio features на всех кандидатов и один вызов модели
+
+    :param q:       str / поисковый запрос
+    :param n:       int / сколько кандидатов
+    :return:        list словарей как у predict() плюс track_id, в порядке выдачи поиска
+    """
+
+    return query_flights.do(('candidates', n, normalize_query(q)), _predict_candidates, q, n)
+
+
+def predict_many(qs, batch_size=AUDIO_FEATURES_BATCH):
+    """
+    Пакетное предсказание для большого количества запросов (названия треков, айди, URI или ссылки).
+    Запросы обрабатываются пачками по batch_size: резолв треков, один запрос audio features на пачку
+    и один вызов модели на всю матрицу пачки. Результаты отдаются по мере готовности каждой пачки.
+
+    :param qs:              iterable запросов
+    :param batch_size:      размер пачки, по умолчанию - максимум эндпоинта audio-features
+    :return:                генератор пар (q, prediction), prediction - как в predict() или None
+    """
+
+    batch = []
+    for q in qs:
+        batch.append(q)
+        if len(batch) == batch_size:
+            yield from _predict_batch(batch)
+            batch = []
+    if batch:
+        yield from _predict_batch(batch)
+
+
 def main():
 
     while True:
@@ -0,0 +1,104 @@
+import threading
+import time
+from collections import OrderedDict
+
+from spotipy_framework import normalize_query
+from track_index import query_words
+
+
+class PrefixQueryCache:
+
+    def __init__(self, max_entries=10000, ttl=600):
+        """
+        Кэш результатов поиска для инлайн режима и списка кандидатов: нормализованный запрос -> найденные треки.
+        Пока пользователь печатает, каждое следующее нажатие дает запрос, который продолжает предыдущий.
+        Если точного запроса в кэше нет, берется самый длинный закэшированный префикс, и его треки
+        фильтруются по словам нового запроса (последнее слово может быть недопечатано, оно сравнивается
+        как префикс). Если после фильтра треков хватает, в поиск Spotify не идем.
+
+        :param max_entries:     int / максимальное количество запросов в кэше (LRU)
+        :param ttl:             int / сколько секунд хранить результаты
+        """
+
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self.hits = 0
+        self.prefix_hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _matches(words, track_words):
+        *complete, last = words
+        return (all(word in track_words for word in complete)
+                and any(track_word.startswith(last) for track_word in track_words))
+
+    def _entry(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < now:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def get(self, q, n):
+        """
+        :param q:       str / поисковый запрос
+        :param n:       int / сколько треков нужно
+        :return:        list (artist_name, track_name, track_id) длиной до n или None, если в кэше нет
+        """
+
+        key = normalize_query(q)
+        words = query_words(q)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entry(key, now)
+            if entry is not None:
+                self.hits += 1
+                return [track for track, _ in entry[1][:n]]
+
+            if words:
+                for end in range(len(key) - 1, 0, -1):
+                    entry = self._entry(key[:end], now)
+                    if entry is None:
+                        continue
+                    tracks = [track for track, track_words in entry[1] if self._matches(words, track_words)]
+                    if len(tracks) >= n:
+                        self.prefix_hits += 1
+                        return tracks[:n]
+                    break
+
+            self.misses += 1
+            return None
+
+    def put(self, q, tracks):
+        """
+        :param q:       str / поисковый запрос
+        :param tracks:  list (artist_name, track_name, track_id) в порядке выдачи поиска
+        """
+
+        key = normalize_query(q)
+        items = [(track, set(query_words(f'{track[0]} {track[1]}'))) for track in tracks]
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, items)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        """
+        :return:    словарь: hits, prefix_hits, misses, hit_rate, entries
+        """
+
+        with self._lock:
+            total = self.hits + self.prefix_hits + self.misses
+            return {'hits': self.hits,
+                    'prefix_hits': self.prefix_hits,
+                    'misses': self.misses,
+                    'hit_rate': (self.hits + self.prefix_hits) / total if total else 0.0,
+                    'entries': len(self._entries)}
@@ -0,0 +1,148 @@
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+import predictor
+
+
+def _init_worker(paths):
+    (predictor.FOREST_PATH, predictor.FOREST_ARRAYS_PATH, predictor.SCALER_PATH,
+     predictor.EXTENDED_FOREST_PATH, predictor.EXTENDED_SCALER_PATH) = paths
+    # Ctrl+C обрабатывает главный процесс, воркеры останавливаются через close()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    predictor._check_models()
+
+
+def _version_job():
+    return predictor._check_models().version
+
+
+def _score_job(tracks_features, artists=None):
+    started = time.perf_counter()
+    current = predictor._check_models()
+    hit_probas = predictor._hit_probas(tracks_features, current, artists)
+    return os.getpid(), current.version, hit_probas, time.perf_counter() - started
+
+
+class ScoringPool:
+
+    def __init__(self, processes=None, start_method='fork'):
+        """
+        Пул процессов под модель, чтобы predict_proba не упирался в одно ядро и GIL
+        вместе с опросом Telegram. Сеть остается в главном процессе, в воркеры уходят только аудио фичи.
+
+        При start_method='fork' модель загружается в главном процессе до запуска воркеров,
+        и воркеры получают ее копией страниц памяти без повторной загрузки. Поэтому пул нужно создавать
+        до того, как запущены другие потоки (Updater, warm-up). При 'spawn'/'forkserver' каждый воркер
+        грузит модель сам - с компактным форматом forest_arrays это mmap одного файла,
+        который делят все процессы.
+
+        :param processes:       int / количество воркеров, по умолчанию по числу ядер
+        :param start_method:    str / fork, spawn или forkserver
+        """
+
+        self.processes = processes or os.cpu_count()
+        self.start_method = start_method
+
+        if start_method == 'fork':
+            predictor._check_models()
+
+        paths = (predictor.FOREST_PATH, predictor.FOREST_ARRAYS_PATH, predictor.SCALER_PATH,
+                 predictor.EXTENDED_FOREST_PATH, predictor.EXTENDED_SCALER_PATH)
+        context = multiprocessing.get_context(start_method)
+        self._pool = context.Pool(self.processes, initializer=_init_worker, initargs=(paths,))
+
+        self._lock = threading.Lock()
+        self._workers = {}
+        self.pending = 0
+        self.errors = 0
+        self.version = None
+
+    def _track(self, pid, rows, busy):
+        with self._lock:
+            worker = self._workers.setdefault(pid, {'jobs': 0, 'rows': 0, 'busy': 0.0, 'last_seen': 0.0})
+            worker['jobs'] += 1
+            worker['rows'] += rows
+            worker['busy'] += busy
+            worker['last_seen'] = time.time()
+
+    def check_version(self, timeout=None):
+        """
+        Спрашивает у воркера версию модели (воркер при этом проверяет файлы модели, как _check_models)
+
+        :param timeout:     секунд на ожидание, None - без ограничения
+        :return:            str / версия модели
+        """
+
+        self.version = self._pool.apply_async(_version_job).get(timeout)
+        return self.version
+
+    def score(self, tracks_features, timeout=None, artists=None):
+        """
+        Считает модель в одном из воркеров и ждет результат
+
+        :param tracks_features:     list словарей с аудио фичами
+        :param timeout:             секунд на ожидание, None - без ограничения
+        :param artists:             np.ndarray признаков исполнителя для расширенной модели или None
+        :return:                    (np.ndarray вероятностей, версия модели)
+        """
+
+        with self._lock:
+            self.pending += 1
+        try:
+            pid, version, hit_probas, busy = self._pool.apply_async(_score_job, (tracks_features, artists)).get(timeout)
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            raise
+        finally:
+            with self._lock:
+                self.pending -= 1
+        self._track(pid, len(tracks_features), busy)
+        self.version = version
+        return hit_probas, version
+
+    def score_batches(self, batches):
+        """
+        Раздает пачки аудио фич по всем воркерам сразу и отдает результаты по мере готовности, в порядке пачек
+
+        :param batches:     iterable списков словарей с аудио фичами
+        :return:            генератор (np.ndarray вероятностей, версия модели)
+        """
+
+        for pid, version, hit_probas, busy in self._pool.imap(_score_job, batches):
+            self._track(pid, len(hit_probas), busy)
+            self.version = version
+            yield hit_probas, version
+
+    def stats(self):
+        """
+        :return:    словарь: pending, errors и по каждому pid воркера jobs, rows, busy (секунд), last_seen
+        """
+
+        with self._lock:
+            return {'processes': self.processes,
+                    'pending': self.pending,
+                    'errors': self.errors,
+                    'workers': {pid: dict(worker) for pid, worker in self._workers.items()}}
+
+    def close(self, timeout=10):
+        """
+        Корректная остановка: ждем до timeout секунд, пока досчитаются начатые задачи,
+        потом закрываем пул. Если не дождались - убиваем воркеров.
+
+        :param timeout:     int / секунд на ожидание
+        """
+
+        deadline = time.monotonic() + timeout
+        while self.pending and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+        if self.pending:
+            print(f'!!! Scoring pool: {self.pending} jobs not finished, terminating workers')
+            self._pool.terminate()
+        else:
+            self._pool.close()
+        self._pool.join()
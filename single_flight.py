@@ -0,0 +1,121 @@
+import asyncio
+import threading
+
+
+class _Call:
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _FlightStats:
+
+    def __init__(self):
+        self.calls = 0
+        self.executions = 0
+        self.shared = 0
+
+        self._in_flight = {}
+
+    def stats(self):
+        """
+        :return:    словарь со счетчиками: calls, executions, shared
+        """
+
+        return {'calls': self.calls,
+                'executions': self.executions,
+                'shared': self.shared}
+
+
+class SingleFlight(_FlightStats):
+
+    def __init__(self):
+        """
+        Склейка одинаковых запросов, которые выполняются одновременно в разных потоках:
+        первый вызов с ключом реально выполняет функцию, остальные ждут и получают тот же результат
+        (или то же исключение). После завершения ключ освобождается, результат не кэшируется.
+        """
+
+        super().__init__()
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args):
+        """
+        :param key:     ключ склейки (нормализованный запрос, айди трека и т.д.)
+        :param func:    что выполнить, если такой ключ сейчас не выполняется
+        :param args:    аргументы func
+        :return:        результат func
+        """
+
+        with self._lock:
+            self.calls += 1
+            call = self._in_flight.get(key)
+            if call is not None:
+                self.shared += 1
+                leader = False
+            else:
+                call = self._in_flight[key] = _Call()
+                self.executions += 1
+                leader = True
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args)
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            call.event.set()
+        return call.result
+
+
+class AsyncSingleFlight(_FlightStats):
+
+    def __init__(self):
+        """
+        То же самое для корутин внутри одного event loop-а. Блокировка не нужна:
+        между await-ами корутины одного loop-а не переключаются
+        """
+
+        super().__init__()
+
+    async def do(self, key, func, *args):
+        """
+        :param key:     ключ склейки
+        :param func:    корутинная функция
+        :param args:    аргументы func
+        :return:        результат func
+        """
+
+        self.calls += 1
+        future = self._in_flight.get(key)
+        if future is not None:
+            self.shared += 1
+            return await asyncio.shield(future)
+
+        future = self._in_flight[key] = asyncio.get_running_loop().create_future()
+        self.executions += 1
+        try:
+            result = await func(*args)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as error:
+            future.set_exception(error)
+            future.exception()      # помечаем исключение прочитанным, если ждущих не было
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._in_flight[key]
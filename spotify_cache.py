@@ -0,0 +1,138 @@
+import json
+import sqlite3
+import threading
+import time
+
+
+class SpotifyCache:
+
+    def __init__(self, path='spotify_cache.sqlite', max_entries=200000, features_ttl=30 * 24 * 3600,
+                 search_ttl=24 * 3600, artists_ttl=24 * 3600):
+        """
+        Локальный кэш ответов Spotify в SQLite: айди трека -> аудио фичи и исполнители,
+        нормализованный поисковый запрос -> найденные треки, айди исполнителя -> его подписчики и популярность.
+        У записей есть TTL, при переполнении выкидываются давно не читанные записи (LRU).
+
+        :param path:            str / путь к файлу базы, ':memory:' - кэш в памяти
+        :param max_entries:     int / максимальное количество записей во всем кэше
+        :param features_ttl:    int / сколько секунд хранить аудио фичи
+        :param search_ttl:      int / сколько секунд хранить результаты поиска
+        :param artists_ttl:     int / сколько секунд хранить подписчиков и популярность исполнителей
+        """
+
+        self.path = path
+        self.max_entries = max_entries
+        self.features_ttl = features_ttl
+        self.search_ttl = search_ttl
+        self.artists_ttl = artists_ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS cache ('
+                         'namespace TEXT NOT NULL, '
+                         'key TEXT NOT NULL, '
+                         'value TEXT NOT NULL, '
+                         'expires REAL NOT NULL, '
+                         'accessed REAL NOT NULL, '
+                         'PRIMARY KEY (namespace, key))')
+        self._db.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+
+    def get_many(self, namespace, keys):
+        """
+        Достает значения из кэша. Просроченные записи считаются промахом и удаляются.
+
+        :param namespace:   str / audio_features, search и т.д.
+        :param keys:        list ключей
+        :return:            словарь {key: value} только для найденных ключей
+        """
+
+        keys = list(set(keys))
+        if not keys:
+            return {}
+
+        now = time.time()
+        found = {}
+        expired = []
+        with self._lock:
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                rows = self._db.execute(f'SELECT key, value, expires FROM cache '
+                                        f'WHERE namespace = ? AND key IN ({", ".join("?" * len(chunk))})',
+                                        [namespace] + chunk)
+                for key, value, expires in rows:
+                    if expires < now:
+                        expired.append(key)
+                    else:
+                        found[key] = json.loads(value)
+
+            self._db.execute('BEGIN')
+            self._db.executemany('DELETE FROM cache WHERE namespace = ? AND key = ?',
+                                 [(namespace, key) for key in expired])
+            self._db.executemany('UPDATE cache SET accessed = ? WHERE namespace = ? AND key = ?',
+                                 [(now, namespace, key) for key in found])
+            self._db.execute('COMMIT')
+
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+
+        return found
+
+    def get(self, namespace, key):
+        return self.get_many(namespace, [key]).get(key)
+
+    def set_many(self, namespace, items, ttl):
+        """
+        Кладет значения в кэш и, если записей стало больше max_entries, выкидывает самые старые по чтению
+
+        :param namespace:   str
+        :param items:       словарь {key: value}, value должен сериализоваться в json
+        :param ttl:         int / время жизни записей в секундах
+        """
+
+        if not items:
+            return
+
+        now = time.time()
+        with self._lock:
+            self._db.execute('BEGIN')
+            self._db.executemany('INSERT OR REPLACE INTO cache (namespace, key, value, expires, accessed) '
+                                 'VALUES (?, ?, ?, ?, ?)',
+                                 [(namespace, key, json.dumps(value), now + ttl, now)
+                                  for key, value in items.items()])
+            excess = self._db.execute('SELECT COUNT(*) FROM cache').fetchone()[0] - self.max_entries
+            if excess > 0:
+                self._db.execute('DELETE FROM cache WHERE rowid IN '
+                                 '(SELECT rowid FROM cache ORDER BY accessed LIMIT ?)', (excess,))
+                self.evictions += excess
+            self._db.execute('COMMIT')
+
+    def set(self, namespace, key, value, ttl):
+        self.set_many(namespace, {key: value}, ttl)
+
+    def clear(self):
+        with self._lock:
+            self._db.execute('DELETE FROM cache')
+
+    def stats(self):
+        """
+        :return:    словарь со счетчиками: hits, misses, evictions, entries, hit_rate
+        """
+
+        with self._lock:
+            entries = self._db.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+        total = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': entries,
+                'hit_rate': self.hits / total if total else 0.0}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,114 @@
+import sys
+from collections import namedtuple
+
+
+Artist = namedtuple('Artist', ['name', 'id'])
+
+Track = namedtuple('Track', ['artists', 'name', 'id', 'popularity'])
+
+ArtistAlbum = namedtuple('ArtistAlbum', ['artist', 'name', 'id'])
+
+
+class RecordFactory:
+
+    def __init__(self, shared_artists=True):
+        """
+        Собирает компактные записи из ответов Spotify API. namedtuple не держат __dict__,
+        а один и тот же артист во всех треках - это один и тот же объект Artist с интернированными строками,
+        так что сотни тысяч треков одних и тех же артистов не плодят копии имен и айди.
+
+        :param shared_artists:  bool / переиспользовать объекты Artist. Справочник артистов только растет,
+                                поэтому для долгоживущих процессов, которым записи нужны на один запрос,
+                                его лучше выключить
+        """
+
+        self.shared_artists = shared_artists
+        self._artists = {}
+
+    def artist(self, name, artist_id):
+        if not self.shared_artists:
+            return Artist(name, artist_id)
+        artist = self._artists.get(artist_id)
+        if artist is None or artist.name != name:
+            artist = self._artists[artist_id] = Artist(sys.intern(name), sys.intern(artist_id))
+        return artist
+
+    def track(self, track):
+        """
+        :param track:       объект трека из ответа API
+        :return:            Track
+        """
+
+        return Track(tuple(self.artist(artist['name'], artist['id']) for artist in track['artists']),
+                     track['name'], track['id'], track.get('popularity'))
+
+    def track_from_legacy(self, track):
+        """
+        :param track:       трек в старом формате {artists: [[name, id]], track: [name, id], popularity: int}
+        :return:            Track
+        """
+
+        return Track(tuple(self.artist(name, artist_id) for name, artist_id in track['artists']),
+                     track['track'][0], track['track'][1], track.get('popularity'))
+
+    def artist_album(self, artist, album):
+        return ArtistAlbum(self.artist(artist['name'], artist['id']), album['name'], album['id'])
+
+
+def _legacy_artists(track):
+    return [[artist.name, artist.id] for artist in track.artists]
+
+
+def track_to_legacy(track):
+    """
+    :param track:       Track
+    :return:            {artists: [[artist_name, artist_id], ...], track: [track_name, track_id], popularity: int}
+    """
+
+    return {'artists': _legacy_artists(track),
+            'track': [track.name, track.id],
+            'popularity': track.popularity}
+
+
+def search_to_legacy(result):
+    """
+    Компактный результат search_tracks -> {search: {number: {artists: [[], []], track: [], popularity: int}}}
+    """
+
+    return {q: {n: track_to_legacy(track) for n, track in enumerate(tracks)} for q, tracks in result.items()}
+
+
+def tracks_to_legacy(tracks):
+    """
+    Компактный результат get_tracks_by_years -> [{artists: [[], []], track: [], popularity: int}, ...]
+    """
+
+    return [track_to_legacy(track) for track in tracks]
+
+
+def album_tracks_to_legacy(result):
+    """
+    Компактный результат get_album_tracks -> {album_id: {track_number: {artists: [[], []], track: []}}}
+    """
+
+    return {album_id: {n: {'artists': _legacy_artists(track), 'track': [track.name, track.id]}
+                       for n, track in enumerate(tracks)}
+            for album_id, tracks in result.items()}
+
+
+def tracks_info_to_legacy(result):
+    """
+    Компактный результат get_tracks_info -> {track_id: {artists: [[], []], track: track_name, popularity: int}}
+    """
+
+    return {track_id: {'artists': _legacy_artists(track), 'track': track.name, 'popularity': track.popularity}
+            for track_id, track in result.items()}
+
+
+def artist_albums_to_legacy(result):
+    """
+    Компактный результат get_artist_albums -> {artist_id: [[[artist_name, artist_id], [album_name, album_id]]]}
+    """
+
+    return {artist_id: [[[album.artist.name, album.artist.id], [album.name, album.id]] for album in albums]
+            for artist_id, albums in result.items()}
@@ -1,16 +1,144 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
 import spotipy
 from spotipy.oauth2 import SpotifyClientCredentials
 
+from spotify_records import (RecordFactory, album_tracks_to_legacy, artist_albums_to_legacy, search_to_legacy,
+                             tracks_info_to_legacy, tracks_to_legacy)
+
+
+AUDIO_FEATURES_BATCH = 100
+TRACKS_BATCH = 50
+ALBUMS_BATCH = 20
+ARTISTS_BATCH = 50
+
+HTTP_POOL_SIZE = 64
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def normalize_query(q):
+    """
+    Приводит поисковый запрос к виду для ключей кэшей: нижний регистр, одиночные пробелы
+    """
+
+    return ' '.join(q.lower().split())
+
+
+def shared_session():
+    """
+    Общая на процесс requests.Session с пулом keep-alive соединений к api.spotify.com.
+    Ретраев на уровне urllib3 нет - повторами занимается Spotify._call.
+
+    :return:    requests.Session
+    """
+
+    global _session
+
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_SIZE,
+                                                        pool_maxsize=HTTP_POOL_SIZE,
+                                                        max_retries=0)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session = session
+    return _session
+
+
+class RateLimiter:
+
+    def __init__(self, rate=20, burst=40):
+        """
+        Token bucket на запросы к API: в среднем не больше rate запросов в секунду, пачкой - до burst.
+        Если Spotify ответил 429, pause() останавливает все запросы через этот лимитер на Retry-After секунд.
+        Один лимитер обычно общий на процесс, там же копятся метрики ожидания и повторов.
+
+        :param rate:        float / запросов в секунду
+        :param burst:       int / сколько запросов можно сделать подряд без ожидания
+        """
+
+        self.rate = rate
+        self.burst = burst
+
+        self.requests = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.throttled = 0
+        self.retries = 0
+
+        self._lock = threading.Lock()
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+    def acquire(self):
+        """
+        Забирает токен на один запрос, если нужно - ждет
+        """
+
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = max(self._paused_until - now, -self._tokens / self.rate if self._tokens < 0 else 0.0)
+            self.requests += 1
+            if wait > 0:
+                self.waits += 1
+                self.wait_time += wait
+
+        if wait > 0:
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        Останавливает выдачу токенов на seconds секунд (для Retry-After)
+        """
+
+        with self._lock:
+            self.throttled += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def record_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def stats(self):
+        return {'requests': self.requests,
+                'waits': self.waits,
+                'wait_time': self.wait_time,
+                'throttled': self.throttled,
+                'retries': self.retries}
+
+
+default_rate_limiter = RateLimiter()
+
+
+def _retry_after(headers, default=1.0):
+    try:
+        return max(float((headers or {}).get('Retry-After', default)), 0.0)
+    except (TypeError, ValueError):
+        return default
+
 
 class Spotify:
 
     def __init__(self, cid, secret, country=None, album_ids=None, artist_ids=None, album_type=None,
-                 track_ids=None, qs=None):
+                 track_ids=None, qs=None, cache=None, client=None, rate_limiter=None, max_retries=4,
+                 requests_timeout=10, api_prefix=None, max_workers=8, compact=False):
         """
-        Подключение к API Spotify и передача известных параметров для работы.
-        Если параметры становятся известны в процессе работы, их можно добавлять
-        к объекту на лету, не создавая новый объект. При этом атрибуты объекта
-        будут перезаписаны.
+        Подключение к API Spotify и параметры по умолчанию для методов.
+        Аргументы, переданные в метод, используются только в этом вызове и параметры
+        объекта не перезаписывают, поэтому один объект можно вызывать из разных потоков.
+        Параметры объекта берутся, только если аргумент в метод не передан.
 
         :param cid:             str / client_cid приложения в Spotify
         :param secret:          str / client_secret приложения в Spotify
@@ -19,10 +147,32 @@ class Spotify:
         :param artist_ids:      list or str
         :param album_type:      str / album, single, appears_on, compilation
         :param track_ids:       list or str
+        :param cache:           SpotifyCache / кэш аудио фич и результатов поиска, None - без кэша
+        :param client:          готовый клиент spotipy.Spotify (или заглушка для тестов), тогда cid и secret
+                                не используются
+        :param rate_limiter:    RateLimiter / по умолчанию общий на процесс default_rate_limiter
+        :param max_retries:     int / сколько раз повторять запрос при 429, 5xx и таймаутах
+        :param requests_timeout: int / таймаут одного HTTP запроса в секундах
+        :param api_prefix:      str / другой адрес API, например локальный мок-сервер
+        :param max_workers:     int / сколько запросов по списку айди делать параллельно
+        :param compact:         bool / отдавать треки и альбомы компактными записями из spotify_records
+                                (Track, ArtistAlbum) списками вместо вложенных словарей. Для сборки больших
+                                датасетов: в разы меньше памяти. Старый формат - функции *_to_legacy оттуда же
         """
 
-        login = SpotifyClientCredentials(client_id=cid, client_secret=secret)
-        self.spotify = spotipy.Spotify(client_credentials_manager=login)
+        if client is None:
+            login = SpotifyClientCredentials(client_id=cid, client_secret=secret)
+            client = spotipy.Spotify(client_credentials_manager=login, requests_session=shared_session(),
+                                     requests_timeout=requests_timeout)
+        if api_prefix is not None:
+            client.prefix = api_prefix
+        self.spotify = client
+        self.cache = cache
+        self.rate_limiter = rate_limiter if rate_limiter is not None else default_rate_limiter
+        self.max_retries = max_retries
+        self.max_workers = max_workers
+        self.compact = compact
+        self.records = RecordFactory(shared_artists=compact)
 
         self.country = self._check_country(country)
         self.album_ids = self._check_album_ids(album_ids)
@@ -46,15 +196,15 @@ class Spotify:
                             singles: [...],
                             compilations: [...]}
         """
-        if country is not None:
-            self.country = self._check_country(country)
+        country = self._check_country(country) if country is not None else self.country
 
         new_releases = {}
         albums = []
         singles = []
         compilations = []
         for _offset in range(0, 100, 50):
-            api_response = self.spotify.new_releases(country=self.country, limit=50, offset=_offset)
+            api_response = self._call(self.spotify.new_releases, country=country, limit=50,
+                                      offset=_offset)
             for release in api_response['albums']['items']:
                 temp_dict = {}
 
@@ -95,28 +245,25 @@ class Spotify:
                                     track: [track_name, track_id],
         """
 
-        if album_ids is not None:
-            self.album_ids = self._check_album_ids(album_ids)
+        album_ids = self._check_album_ids(album_ids) if album_ids is not None else self.album_ids
+
+        # Эндпоинт albums отдает до 20 альбомов за запрос вместе с первыми 50 треками каждого -
+        # ровно то, что раньше возвращал album_tracks по одному альбому
+        batches = [album_ids[i:i + ALBUMS_BATCH] for i in range(0, len(album_ids), ALBUMS_BATCH)]
+        albums = {}
+        for api_response in self._fan_out(lambda batch: self._call(self.spotify.albums, batch), batches):
+            for album in api_response['albums']:
+                if album:
+                    albums[album['id']] = album
 
         albums_tracks = {}
-        for album_id in self.album_ids:
-            api_response = self.spotify.album_tracks(album_id)
-
-            tracks = {}
-            for n, track in enumerate(api_response['items']):
-                track_temp = {}
-                artists = []
-                for artist in track['artists']:
-                    artist_temp = []
-                    artist_temp.append(artist['name'])
-                    artist_temp.append(artist['id'])
-                    artists.append(artist_temp)
-                track_temp['artists'] = artists
-                track_temp['track'] = [track['name'], track['id']]
-                tracks[n] = track_temp
-
-            albums_tracks[album_id] = tracks
+        for album_id in album_ids:
+            if album_id in albums:
+                items = albums[album_id]['tracks']['items']
+                albums_tracks[album_id] = [self.records.track(track) for track in items]
 
+        if not self.compact:
+            return album_tracks_to_legacy(albums_tracks)
         return albums_tracks
 
     def get_artist_albums(self, artist_ids=None, album_type=None, country=None):
@@ -133,38 +280,61 @@ class Spotify:
         :return:            словарь списков: {artist_id: [[artist_name, artist_id], [track_name, track_id]]}
         """
 
-        if artist_ids is not None:
-            self.artist_ids = self._check_artist_ids(artist_ids)
-
-        if album_type is not None:
-            self.album_type = self._check_album_type(album_type)
+        artist_ids = self._check_artist_ids(artist_ids) if artist_ids is not None else self.artist_ids
 
-        if country is not None:
-            self.country = self._check_country(country)
-
-        albums_dict = {}
-        for artist_id in self.artist_ids:
-
-            tracks = []
-            offset = 0
-            check = True
-            while check:
-                api_response = self.spotify.artist_albums(artist_id, self.album_type, self.country, 50, offset)
-                check = api_response['items']
-                if check:
-                    for track in check:
-                        for artist in track['artists']:
-                            if artist['name'] != 'Various Artists':
-                                track_temp = []
-                                track_temp.append([artist['name'], artist['id']])
-                                track_temp.append([track['name'], track['id']])
-                                tracks.append(track_temp)
-                    offset += 50
-
-            albums_dict[artist_id] = tracks
+        albums_dict = {artist_id: [] for artist_id in artist_ids}
+        for artist_id, _, records in self.iter_artist_albums(artist_ids, album_type, country):
+            albums_dict[artist_id].extend(records)
 
         return albums_dict
 
+    def iter_artist_albums(self, artist_ids=None, album_type=None, country=None, start=None):
+        """
+        Потоковый вариант get_artist_albums: отдает альбомы постранично, по мере прихода страниц,
+        и не держит в памяти все альбомы всех артистов. Следующая страница запрашивается в фоне,
+        пока обрабатывается текущая. Если перестать итерироваться (break, close()), дальше запросов не будет.
+
+        :param artist_ids:  list или str
+        :param album_type:  тип альбома, как в get_artist_albums
+        :param country:     id страны в формате ISO 3166-1
+        :param start:       (artist_id, offset) / курсор, с которого продолжить после остановки:
+                            сохраните artist_id и offset последней обработанной страницы и передайте
+                            (artist_id, offset + 50)
+        :return:            генератор (artist_id, offset, [[artist_name, artist_id], [album_name, album_id]], ...])
+        """
+
+        artist_ids = self._check_artist_ids(artist_ids) if artist_ids is not None else self.artist_ids
+        album_type = self._check_album_type(album_type) if album_type is not None else self.album_type
+        country = self._check_country(country) if country is not None else self.country
+
+        index, offset = 0, 0
+        if start is not None:
+            index, offset = artist_ids.index(start[0]), start[1]
+        if index >= len(artist_ids):
+            return
+
+        def fetch(cursor):
+            return self._call(self.spotify.artist_albums, artist_ids[cursor[0]], album_type=album_type, country=country,
+                              limit=50, offset=cursor[1])
+
+        def next_cursor(cursor, api_response):
+            if api_response['items'] and api_response.get('next', True):
+                return cursor[0], cursor[1] + 50
+            if cursor[0] + 1 < len(artist_ids):
+                return cursor[0] + 1, 0
+            return None
+
+        for (i, page_offset), api_response in self._iter_pages(fetch, (index, offset), next_cursor):
+            records = []
+            for album in api_response['items']:
+                for artist in album['artists']:
+                    if artist['name'] != 'Various Artists':
+                        records.append(self.records.artist_album(artist, album))
+            if records:
+                if not self.compact:
+                    records = artist_albums_to_legacy({None: records})[None]
+                yield artist_ids[i], page_offset, records
+
     def get_similar_artists(self, artist_ids=None):
         """
         Возвращает список списков похожих артистов
@@ -173,13 +343,14 @@ class Spotify:
         :return:                словарь списков: {artist_id: [artist_name, artist_id, followers, popularity]}
         """
 
-        if artist_ids is not None:
-            self.artist_ids = self._check_artist_ids(artist_ids)
+        artist_ids = self._check_artist_ids(artist_ids) if artist_ids is not None else self.artist_ids
 
-        similar_artists = {}
-        for artist_id in self.artist_ids:
+        # Пакетного эндпоинта для похожих артистов нет, поэтому запросы идут параллельно
+        responses = self._fan_out(lambda artist_id: self._call(self.spotify.artist_related_artists, artist_id),
+                                  artist_ids)
 
-            api_response = self.spotify.artist_related_artists(artist_id)
+        similar_artists = {}
+        for artist_id, api_response in zip(artist_ids, responses):
 
             artists = []
             for artist in api_response['artists']:
@@ -203,16 +374,15 @@ class Spotify:
         :return:                словарь списков: {artist_id: [track_name, track_id, popularity]}
         """
 
-        if artist_ids is not None:
-            self.artist_ids = self._check_artist_ids(artist_ids)
+        artist_ids = self._check_artist_ids(artist_ids) if artist_ids is not None else self.artist_ids
+        country = self._check_country(country) if country is not None else self.country
 
-        if country is not None:
-            self.country = self._check_country(country)
+        # Пакетного эндпоинта для топов нет, поэтому запросы идут параллельно
+        responses = self._fan_out(lambda artist_id: self._call(self.spotify.artist_top_tracks, artist_id, country),
+                                  artist_ids)
 
         top_tracks = {}
-        for artist_id in self.artist_ids:
-
-            api_response = self.spotify.artist_top_tracks(artist_id, self.country)
+        for artist_id, api_response in zip(artist_ids, responses):
 
             top = []
             for track in api_response['tracks']:
@@ -226,68 +396,139 @@ class Spotify:
 
         return top_tracks
 
+    def get_artists_info(self, artist_ids=None):
+        """
+        Возвращает подписчиков и популярность исполнителей пачками по 50 айди через эндпоинт artists.
+        С кэшем повторные исполнители в Spotify не запрашиваются, пока не истек artists_ttl.
+        Не найденных исполнителей в ответе нет.
+
+        :param artist_ids:      list or str
+        :return:                словарь списков: {artist_id: [artist_name, artist_id, followers, popularity]}
+        """
+
+        artist_ids = self._check_artist_ids(artist_ids) if artist_ids is not None else self.artist_ids
+        artist_ids = list(dict.fromkeys(artist_ids))
+
+        artists = {}
+        if self.cache is not None:
+            artists = self.cache.get_many('artists', artist_ids)
+        missing = [artist_id for artist_id in artist_ids if artist_id not in artists]
+
+        batches = [missing[i:i + ARTISTS_BATCH] for i in range(0, len(missing), ARTISTS_BATCH)]
+        fetched = {}
+        for api_response in self._fan_out(lambda batch: self._call(self.spotify.artists, batch), batches):
+            for artist in api_response['artists']:
+                if artist:
+                    fetched[artist['id']] = [artist['name'], artist['id'], artist['followers']['total'],
+                                             artist['popularity']]
+
+        if self.cache is not None:
+            self.cache.set_many('artists', fetched, self.cache.artists_ttl)
+        artists.update(fetched)
+
+        return artists
+
+    def get_tracks_artists(self, track_ids=None):
+        """
+        Возвращает айди исполнителей треков. Состав исполнителей трека не меняется,
+        поэтому с кэшем он хранится столько же, сколько аудио фичи.
+
+        :param track_ids:       list or str
+        :return:                словарь списков: {track_id: [artist_id, ...]}, не найденных треков в ответе нет
+        """
+
+        track_ids = self._check_track_ids(track_ids) if track_ids is not None else self.track_ids
+        track_ids = list(dict.fromkeys(track_ids))
+
+        tracks_artists = {}
+        if self.cache is not None:
+            tracks_artists = self.cache.get_many('tracks_artists', track_ids)
+        missing = [track_id for track_id in track_ids if track_id not in tracks_artists]
+
+        batches = [missing[i:i + TRACKS_BATCH] for i in range(0, len(missing), TRACKS_BATCH)]
+        fetched = {}
+        for api_response in self._fan_out(lambda batch: self._call(self.spotify.tracks, batch), batches):
+            for track in api_response['tracks']:
+                if track:
+                    fetched[track['id']] = [artist['id'] for artist in track['artists']]
+
+        if self.cache is not None:
+            self.cache.set_many('tracks_artists', fetched, self.cache.features_ttl)
+        tracks_artists.update(fetched)
+
+        return tracks_artists
+
     def get_audio_features(self, track_ids=None):
         """
-        Возвращает аудио фичи треков по их айди
+        Возвращает аудио фичи треков по их айди.
+        Запросы идут пачками по 100 айди - это максимум эндпоинта audio-features.
+        Для не найденных треков в списке будет None.
 
         :param track_ids:       list
-        :return:                список словарей с фичами
+        :return:                список словарей с фичами в порядке track_ids
         """
 
-        if track_ids is not None:
-            self.track_ids = self._check_track_ids(track_ids)
+        # Только локальная переменная: клиент общий для потоков, и параллельный вызов не должен подменить айди
+        track_ids = self._check_track_ids(track_ids) if track_ids is not None else self.track_ids
+
+        cached = {}
+        if self.cache is not None:
+            cached = self.cache.get_many('audio_features', track_ids)
+        missing = [track_id for track_id in dict.fromkeys(track_ids) if track_id not in cached]
 
-        tracks_count = len(self.track_ids)
         tracks_batches = []
-        for i in range(0, tracks_count, 50):
-            x = 50
-            if i + x > tracks_count:
-                x -= i + x - tracks_count
-            tracks_batches.append(self.track_ids[i:i + x])
+        for i in range(0, len(missing), AUDIO_FEATURES_BATCH):
+            tracks_batches.append(missing[i:i + AUDIO_FEATURES_BATCH])
+
+        fetched = {}
+        for batch in tracks_batches:
+            api_response = self._call(self.spotify.audio_features, batch)
+            for track_id, features in zip(batch, api_response):
+                fetched[track_id] = features
+
+        if self.cache is not None:
+            self.cache.set_many('audio_features', {track_id: features for track_id, features in fetched.items()
+                                                   if features}, self.cache.features_ttl)
 
         tracks_features = []
-        for track_ids in tracks_batches:
-            api_response = self.spotify.audio_features(track_ids)
-            for i in api_response:
-                tracks_features.append(i)
+        for track_id in track_ids:
+            tracks_features.append(cached[track_id] if track_id in cached else fetched[track_id])
 
         return tracks_features
 
     def get_tracks_info(self, track_ids=None):
         """
-        Возвращает инфу о треке по его айди
+        Возвращает инфу о треке по его айди. Не найденных треков в ответе нет.
 
         :param track_ids:       str или list
         :return:                словарь словарей
                                 {track_id: {artists: [[], []]}, track: [], popularity: int}, ...}
         """
 
-        if track_ids is not None:
-            if isinstance(track_ids, list):
-                self.track_ids = track_ids
-            elif isinstance(track_ids, str):
-                self.track_ids = [track_ids]
-            else:
-                raise TypeError('track_ids должен быть list или str')
-        elif track_ids is None:
+        if track_ids is None:
             if self.track_ids is None:
                 raise AttributeError('не передан track_ids')
+            track_ids = self.track_ids
+        elif isinstance(track_ids, str):
+            track_ids = [track_ids]
+        elif not isinstance(track_ids, list):
+            raise TypeError('track_ids должен быть list или str')
+
+        # Эндпоинт tracks отдает до 50 треков за запрос
+        batches = [track_ids[i:i + TRACKS_BATCH] for i in range(0, len(track_ids), TRACKS_BATCH)]
+        found = {}
+        for response in self._fan_out(lambda batch: self._call(self.spotify.tracks, batch), batches):
+            for track in response['tracks']:
+                if track:
+                    found[track['id']] = track
 
         tracks = {}
-        for track_id in self.track_ids:
-            api_response = self.spotify.track(track_id)
-            track_temp = {}
-            artists = []
-            for artist in api_response['artists']:
-                artist_temp = []
-                artist_temp.append(artist['name'])
-                artist_temp.append(artist['id'])
-                artists.append(artist_temp)
-            track_temp['artists'] = artists
-            track_temp['track'] = api_response['name']
-            track_temp['popularity'] = api_response['popularity']
-            tracks[track_id] = track_temp
+        for track_id in track_ids:
+            if track_id in found:
+                tracks[track_id] = self.records.track(found[track_id])
 
+        if not self.compact:
+            return tracks_info_to_legacy(tracks)
         return tracks
 
     def search_tracks(self, qs=None, country=None, limit=50):
@@ -301,33 +542,35 @@ class Spotify:
                             {search: {number: {artists: [[], []]}, track: [], popularity: int}, ...}
         """
 
-        if qs is not None:
-            self.qs = self._check_qs(qs)
+        qs = self._check_qs(qs) if qs is not None else self.qs
 
+        # country без значения по умолчанию: поиск без market ищет по всем странам
         if country is not None:
-            self.country = self._check_country(country)
+            country = self._check_country(country)
 
         finded_tracks = {}
-        for q in self.qs:
-            api_response = self.spotify.search(q=q, limit=limit, market=country)
-
-            tracks = {}
-
-            for n, track in enumerate(api_response['tracks']['items']):
-                track_temp = {}
-                artists = []
-                for artist in track['artists']:
-                    artist_temp = []
-                    artist_temp.append(artist['name'])
-                    artist_temp.append(artist['id'])
-                    artists.append(artist_temp)
-                track_temp['artists'] = artists
-                track_temp['track'] = [track['name'], track['id']]
-                track_temp['popularity'] = track['popularity']
-                tracks[n] = track_temp
-
+        missing = []
+        for q in dict.fromkeys(qs):
+            if self.cache is not None:
+                cached = self.cache.get('search', f'{normalize_query(q)}|{country}|{limit}')
+                if cached is not None:
+                    finded_tracks[q] = [self.records.track_from_legacy(track) for track in cached]
+                    continue
+            missing.append(q)
+
+        # Пакетного эндпоинта для поиска нет, поэтому запросы, которых нет в кэше, идут параллельно
+        responses = self._fan_out(lambda q: self._call(self.spotify.search, q=q, limit=limit, market=country),
+                                  missing)
+        for q, api_response in zip(missing, responses):
+            tracks = [self.records.track(track) for track in api_response['tracks']['items']]
+            if self.cache is not None:
+                self.cache.set('search', f'{normalize_query(q)}|{country}|{limit}', tracks_to_legacy(tracks),
+                               self.cache.search_ttl)
             finded_tracks[q] = tracks
+        finded_tracks = {q: finded_tracks[q] for q in qs}
 
+        if not self.compact:
+            return search_to_legacy(finded_tracks)
         return finded_tracks
 
     def get_tracks_by_years(self, year, country=None, limit=100):
@@ -341,32 +584,112 @@ class Spotify:
                             {search: {number: {artists: [[], []]}, track: [], popularity: int}, ...}
         """
 
-        if country is not None:
-            self.country = self._check_country(country)
-
         finded_tracks = []
-        for off in range(0, limit, 50):
-            api_response = self.spotify.search(q=f'year:{year}', limit=50, offset=off, market=country)
-
-            tracks = []
-
-            for n, track in enumerate(api_response['tracks']['items']):
-                track_temp = {}
-                artists = []
-                for artist in track['artists']:
-                    artist_temp = []
-                    artist_temp.append(artist['name'])
-                    artist_temp.append(artist['id'])
-                    artists.append(artist_temp)
-                track_temp['artists'] = artists
-                track_temp['track'] = [track['name'], track['id']]
-                track_temp['popularity'] = track['popularity']
-                tracks.append(track_temp)
-
+        for _, tracks in self.iter_tracks_by_years(year, country, limit):
             finded_tracks.extend(tracks)
 
         return finded_tracks
 
+    def iter_tracks_by_years(self, year, country=None, limit=100, offset=0):
+        """
+        Потоковый вариант get_tracks_by_years: отдает треки постранично по 50, следующая страница
+        запрашивается в фоне, пока обрабатывается текущая. Можно остановиться в любой момент
+        и продолжить потом с offset следующей страницы.
+
+        :param year:        год или диапазон (2019, '2018-2020')
+        :param country:     айди страны
+        :param limit:       до какого offset идти
+        :param offset:      с какого offset начать
+        :return:            генератор (offset, [{artists: [[], []], track: [], popularity: int}, ...])
+        """
+
+        if country is not None:
+            country = self._check_country(country)
+
+        if offset >= limit:
+            return
+
+        def fetch(off):
+            return self._call(self.spotify.search, q=f'year:{year}', limit=50, offset=off, market=country)
+
+        def next_cursor(off, api_response):
+            if api_response['tracks']['items'] and off + 50 < limit:
+                return off + 50
+            return None
+
+        for off, api_response in self._iter_pages(fetch, offset, next_cursor):
+            tracks = [self.records.track(track) for track in api_response['tracks']['items']]
+            if not self.compact:
+                tracks = tracks_to_legacy(tracks)
+            yield off, tracks
+
+    def _iter_pages(self, fetch, cursor, next_cursor):
+        """
+        Постраничный обход с предзагрузкой: пока вызывающий код обрабатывает страницу,
+        следующая уже запрашивается в отдельном потоке.
+
+        :param fetch:           callable(cursor) -> ответ API
+        :param cursor:          курсор первой страницы
+        :param next_cursor:     callable(cursor, ответ) -> курсор следующей страницы или None
+        :return:                генератор (cursor, ответ API)
+        """
+
+        executor = ThreadPoolExecutor(1)
+        future = executor.submit(fetch, cursor)
+        try:
+            while future is not None:
+                api_response = future.result()
+                following = next_cursor(cursor, api_response)
+                future = executor.submit(fetch, following) if following is not None else None
+                yield cursor, api_response
+                cursor = following
+        finally:
+            if future is not None:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def _call(self, method, *args, **kwargs):
+        """
+        Вызов метода spotipy через лимитер и с повторами: на 429 ждем Retry-After (вместе со всеми
+        запросами через этот лимитер), на 5xx, таймауты и обрывы соединения - экспоненциальная пауза
+        со случайным разбросом. Остальные ошибки пробрасываются сразу.
+        """
+
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
+            try:
+                return method(*args, **kwargs)
+            except spotipy.SpotifyException as error:
+                if error.http_status == 429:
+                    self.rate_limiter.pause(_retry_after(error.headers))
+                    delay = 0.0
+                elif 500 <= error.http_status < 600:
+                    delay = 0.5 * 2 ** attempt
+                else:
+                    raise
+                if attempt == self.max_retries:
+                    raise
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+                if attempt == self.max_retries:
+                    raise
+                delay = 0.5 * 2 ** attempt
+
+            self.rate_limiter.record_retry()
+            if delay:
+                time.sleep(delay * random.uniform(0.5, 1.5))
+
+    def _fan_out(self, func, items):
+        """
+        Выполняет func для каждого элемента в пуле до max_workers потоков
+
+        :return:    список результатов в порядке items
+        """
+
+        if len(items) <= 1 or self.max_workers <= 1:
+            return [func(item) for item in items]
+        with ThreadPoolExecutor(min(self.max_workers, len(items))) as executor:
+            return list(executor.map(func, items))
+
     def _check_country(self, country):
         if country is not None:
             if isinstance(country, str) and len(country) == 2:
@@ -0,0 +1,141 @@
+import re
+import threading
+import time
+import unicodedata
+
+
+INDEX_TTL = 90 * 24 * 3600
+
+# Приписки про фиты и продюсеров: в запросах их пишут как попало, а то и вовсе не пишут
+_CREDITS = re.compile(r'[(\[][^)\]]*\b(?:feat|ft|featuring|prod|with)\b[^)\]]*[)\]]|\b(?:feat|ft|featuring)\b.*$')
+_WORD = re.compile(r'\w+')
+
+
+def query_words(text):
+    """
+    Слова запроса по порядку: без регистра, диакритики, пунктуации и приписок про фиты
+
+    :param text:    str
+    :return:        list слов
+    """
+
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return _WORD.findall(_CREDITS.sub(' ', text))
+
+
+def index_key(text):
+    """
+    Нечеткий ключ для запроса или "исполнитель + название": слова из query_words по алфавиту без повторов -
+    так "Artist - Song (feat. X)" и "song artist" дают один ключ
+
+    :param text:    str
+    :return:        str или None, если в тексте нет ни одного слова
+    """
+
+    return ' '.join(sorted(set(query_words(text)))) or None
+
+
+class TrackIndex:
+
+    def __init__(self, cache, ttl=INDEX_TTL, query_ttl=None):
+        """
+        Локальный индекс "нечеткий ключ -> трек", чтобы частые запросы вообще не ходили в поиск Spotify.
+        Пополняется найденными через поиск треками (по ключу запроса и по ключу "исполнитель название")
+        и треками из обучающей выборки (training.py). Хранится в том же SQLite, что и кэш Spotify,
+        поэтому переживает перезапуск и общий для бота, bulk_predict и обучения.
+
+        :param cache:       spotify_cache.SpotifyCache
+        :param ttl:         int / сколько секунд хранить записи "исполнитель название"
+        :param query_ttl:   int / сколько секунд хранить записи по ключу запроса, по умолчанию search_ttl кэша:
+                            первый результат поиска по запросу со временем меняется (новые релизы)
+        """
+
+        self.cache = cache
+        self.ttl = ttl
+        self.query_ttl = query_ttl if query_ttl is not None else cache.search_ttl
+
+        self.lookups = 0
+        self.hits = 0
+        self.lookup_seconds = 0.0
+        self.searches = 0
+        self.search_seconds = 0.0
+
+        self._lock = threading.Lock()
+
+    def get_many(self, qs):
+        """
+        :param qs:      iterable запросов
+        :return:        словарь {q: (artist_name, track_name, track_id)} только для найденных в индексе
+        """
+
+        started = time.perf_counter()
+        keys = {q: index_key(q) for q in qs}
+        found = self.cache.get_many('track_index', [key for key in keys.values() if key])
+        tracks = {q: tuple(found[key]) for q, key in keys.items() if key in found}
+
+        with self._lock:
+            self.lookups += len(keys)
+            self.hits += len(tracks)
+            self.lookup_seconds += time.perf_counter() - started
+        return tracks
+
+    def get(self, q):
+        """
+        :param q:       str / поисковый запрос
+        :return:        (artist_name, track_name, track_id) или None
+        """
+
+        return self.get_many([q]).get(q)
+
+    def add_many(self, tracks):
+        """
+        :param tracks:      iterable пар (q, (artist_name, track_name, track_id)), q может быть None,
+                            тогда трек индексируется только по "исполнитель название"
+        """
+
+        items = {}
+        query_items = {}
+        for q, (artist_name, track_name, track_id) in tracks:
+            if not track_id:
+                continue
+            value = [artist_name, track_name, track_id]
+            key = index_key(f'{artist_name} {track_name}')
+            if key:
+                items[key] = value
+            key = q and index_key(q)
+            if key:
+                query_items[key] = value
+        # Если ключ запроса совпал с "исполнитель название", это точное попадание - храним его долго
+        query_items = {key: value for key, value in query_items.items() if key not in items}
+        if query_items:
+            self.cache.set_many('track_index', query_items, self.query_ttl)
+        self.cache.set_many('track_index', items, self.ttl)
+
+    def add(self, q, track):
+        self.add_many([(q, track)])
+
+    def record_search(self, seconds, count=1):
+        """
+        Засчитывает походы в поиск, которые индекс не смог заменить - по ним считается сэкономленное время
+        """
+
+        with self._lock:
+            self.searches += count
+            self.search_seconds += seconds
+
+    def stats(self):
+        """
+        :return:    словарь: lookups, hits, hit_rate, среднее время поиска и поиска по индексу в мс,
+                    saved_seconds - сколько примерно времени сэкономили попадания в индекс
+        """
+
+        with self._lock:
+            search_ms = self.search_seconds / self.searches * 1000 if self.searches else 0.0
+            lookup_ms = self.lookup_seconds / self.lookups * 1000 if self.lookups else 0.0
+            return {'lookups': self.lookups,
+                    'hits': self.hits,
+                    'hit_rate': self.hits / self.lookups if self.lookups else 0.0,
+                    'search_ms': search_ms,
+                    'lookup_ms': lookup_ms,
+                    'saved_seconds': self.hits * max(search_ms - lookup_ms, 0.0) / 1000}
@@ -0,0 +1,378 @@
+import argparse
+import csv
+import json
+import os
+import pickle
+import resource
+import time
+
+import numpy as np
+from sklearn.ensemble import RandomForestClassifier
+
+import features
+import forest_arrays
+import inference
+import predictor
+
+
+DATA_DIR = 'training_data'
+NEGATIVES_PER_YEAR = 1000
+FEATURES_CHUNK = 1000
+
+
+def _load_json(path, default):
+    try:
+        with open(path, encoding='utf-8') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return default
+
+
+def _dump_json(path, data):
+    # Через временный файл, чтобы упавший посреди записи запуск не испортил кэш этапа
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump(data, file, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def read_chart(path):
+    """
+    Читает историю чартов из CSV. Обязательная колонка week (дата недели чарта, например 2019-05-13),
+    трек задается колонкой track_id (айди, URI или ссылка) или колонками artist и title.
+
+    :param path:        str / путь к CSV
+    :return:            словарь {week: [запрос, ...]} без повторов внутри недели
+    """
+
+    chart = {}
+    with open(path, encoding='utf-8', newline='') as file:
+        for row in csv.DictReader(file):
+            q = (row.get('track_id') or f"{row.get('artist', '')} {row.get('title', '')}").strip()
+            if q:
+                chart.setdefault(row['week'].strip(), {})[q] = None
+    return {week: list(qs) for week, qs in chart.items()}
+
+
+def update_weeks(chart, data_dir=DATA_DIR):
+    """
+    Резолвит в айди треков только те недели чарта, которых еще нет в кэше {data_dir}/weeks.json.
+    Запросы резолвятся так же, как в боте (predictor._resolve, поиск через кэш Spotify),
+    кэш сохраняется после каждой недели.
+
+    :param chart:       словарь из read_chart
+    :param data_dir:    str / каталог с кэшами этапов
+    :return:            словарь {week: [track_id, ...]}
+    """
+
+    path = os.path.join(data_dir, 'weeks.json')
+    weeks = _load_json(path, {})
+
+    new_weeks = sorted(set(chart) - set(weeks))
+    for n, week in enumerate(new_weeks, 1):
+        resolved = predictor._resolve(chart[week])
+        track_ids = [resolved[q][2] for q in chart[week] if resolved[q][2]]
+        weeks[week] = list(dict.fromkeys(track_ids))
+        _dump_json(path, weeks)
+        print(f'Week {week} ({n}/{len(new_weeks)}): {len(weeks[week])} of {len(chart[week])} entries resolved')
+
+    return weeks
+
+
+def update_negatives(years, data_dir=DATA_DIR, per_year=NEGATIVES_PER_YEAR):
+    """
+    Отрицательные примеры - треки тех же лет из поиска year:YYYY. Для каждого года выборка
+    запрашивается один раз и хранится в {data_dir}/negatives.json. Найденные треки попадают
+    и в predictor.track_index, чтобы бот находил их без поиска.
+
+    :param years:       iterable лет (str)
+    :param data_dir:    str / каталог с кэшами этапов
+    :param per_year:    int / сколько треков брать на год
+    :return:            словарь {year: [track_id, ...]}
+    """
+
+    path = os.path.join(data_dir, 'negatives.json')
+    negatives = _load_json(path, {})
+
+    for year in sorted(set(years) - set(negatives)):
+        tracks = predictor.get_spotify().get_tracks_by_years(year, limit=per_year)
+        negatives[year] = list(dict.fromkeys(track['track'][1] for track in tracks))
+        predictor.get_track_index().add_many((None, predictor._top_hit([track])) for track in tracks)
+        _dump_json(path, negatives)
+        print(f'Year {year}: {len(negatives[year])} negative tracks')
+
+    return negatives
+
+
+def update_features(track_ids, data_dir=DATA_DIR):
+    """
+    Докачивает аудио фичи треков, которых еще нет в {data_dir}/features.json, пачками
+    через get_audio_features (кэш Spotify + эндпоинт на 100 айди). Кэш сохраняется после каждой пачки.
+
+    :param track_ids:   iterable айди треков
+    :param data_dir:    str / каталог с кэшами этапов
+    :return:            словарь {track_id: фичи или None, если Spotify их не отдал}
+    """
+
+    path = os.path.join(data_dir, 'features.json')
+    tracks_features = _load_json(path, {})
+
+    missing = [track_id for track_id in dict.fromkeys(track_ids) if track_id not in tracks_features]
+    for i in range(0, len(missing), FEATURES_CHUNK):
+        chunk = missing[i:i + FEATURES_CHUNK]
+        tracks_features.update(zip(chunk, predictor.get_spotify().get_audio_features(chunk)))
+        _dump_json(path, tracks_features)
+        print(f'Audio features: {min(i + FEATURES_CHUNK, len(missing))}/{len(missing)}')
+
+    return tracks_features
+
+
+def update_artists(track_ids, data_dir=DATA_DIR):
+    """
+    Докачивает исполнителей треков (подписчики, популярность), которых еще нет в {data_dir}/artists.json,
+    пачками через get_tracks_artists и get_artists_info. Это текущие значения, а не на момент чарта,
+    так что у старых хитов масштаб исполнителя немного завышен.
+
+    :param track_ids:   iterable айди треков
+    :param data_dir:    str / каталог с кэшами этапов
+    :return:            словарь {track_id: [[artist_name, artist_id, followers, popularity], ...]}
+    """
+
+    path = os.path.join(data_dir, 'artists.json')
+    tracks_artists = _load_json(path, {})
+
+    spotify = predictor.get_spotify()
+    missing = [track_id for track_id in dict.fromkeys(track_ids) if track_id not in tracks_artists]
+    for i in range(0, len(missing), FEATURES_CHUNK):
+        chunk = missing[i:i + FEATURES_CHUNK]
+        chunk_artists = spotify.get_tracks_artists(chunk)
+        artists = spotify.get_artists_info(list({artist_id for artist_ids in chunk_artists.values()
+                                                 for artist_id in artist_ids}))
+        for track_id in chunk:
+            tracks_artists[track_id] = [artists[artist_id] for artist_id in chunk_artists.get(track_id, [])
+                                        if artist_id in artists]
+        _dump_json(path, tracks_artists)
+        print(f'Artists: {min(i + FEATURES_CHUNK, len(missing))}/{len(missing)}')
+
+    return tracks_artists
+
+
+def build_dataset(chart_path, data_dir=DATA_DIR, negatives_per_year=NEGATIVES_PER_YEAR, artists=False):
+    """
+    Собирает обучающую выборку из истории чартов: трек, хоть раз попавший в чарт, - хит (1),
+    трек тех же лет из поиска, который в чарты не попадал, - не хит (0).
+    Все сетевые этапы кэшируются в data_dir, поэтому повторный запуск после добавления
+    новых недель ходит в Spotify только за ними. Матрица сохраняется в {data_dir}/dataset.npz.
+
+    :param chart_path:          str / CSV из read_chart
+    :param data_dir:            str / каталог с кэшами этапов
+    :param negatives_per_year:  int / сколько отрицательных примеров брать на год
+    :param artists:             bool / добавить признаки исполнителя (features.EXTENDED_COLUMNS)
+                                для расширенной модели, сохраняется в {data_dir}/dataset_artists.npz
+    :return:                    (X - матрица features.encode или features.encode_extended, y - метки,
+                                 first_week - неделя первого попадания в чарт, '' для не хитов)
+    """
+
+    os.makedirs(data_dir, exist_ok=True)
+
+    chart = read_chart(chart_path)
+    weeks = update_weeks(chart, data_dir)
+    negatives = update_negatives({week[:4] for week in chart}, data_dir, negatives_per_year)
+
+    hits = {track_id for week in chart for track_id in weeks[week]}
+    others = {track_id for year_ids in negatives.values() for track_id in year_ids} - hits
+    track_ids = sorted(hits) + sorted(others)
+    tracks_features = update_features(track_ids, data_dir)
+
+    first_weeks = {}
+    for week in sorted(chart):
+        for track_id in weeks[week]:
+            first_weeks.setdefault(track_id, week)
+
+    track_ids = [track_id for track_id in track_ids if tracks_features[track_id]]
+    if artists:
+        tracks_artists = update_artists(track_ids, data_dir)
+        X = features.encode_extended([tracks_features[track_id] for track_id in track_ids],
+                                     features.encode_artists([tracks_artists[track_id] for track_id in track_ids]))
+    else:
+        X = features.encode([tracks_features[track_id] for track_id in track_ids])
+    y = np.array([track_id in hits for track_id in track_ids], dtype=np.int64)
+    first_week = np.array([first_weeks.get(track_id, '') for track_id in track_ids])
+
+    dataset_name = 'dataset_artists.npz' if artists else 'dataset.npz'
+    np.savez(os.path.join(data_dir, dataset_name), X=X, y=y, track_ids=np.array(track_ids), first_week=first_week)
+    print(f'Dataset: {len(y)} tracks, {int(y.sum())} hits, {len(y) - int(y.sum())} others, {len(chart)} weeks')
+    return X, y, first_week
+
+
+def _peak_rss_mb():
+    # ru_maxrss в Linux - в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def train(X, y, n_estimators=100, random_state=0, n_jobs=-1):
+    """
+    Обучает скейлер и случайный лес на матрице из build_dataset. Деревья строятся параллельно на n_jobs ядрах.
+
+    :param X:               np.ndarray из features.encode
+    :param y:               np.ndarray меток
+    :param n_estimators:    int / количество деревьев
+    :param random_state:    int / seed
+    :param n_jobs:          int / сколько ядер использовать, -1 - все
+    :return:                (forest, scaler)
+    """
+
+    scaler = features.fit_scaler(X)
+    matrix = features.preprocess(X.copy(), scaler)
+    forest = RandomForestClassifier(n_estimators=n_estimators, random_state=random_state, n_jobs=n_jobs)
+    forest.fit(matrix, y)
+    # В боте модель считается на одну-две строки, параллельный predict_proba там только мешает
+    forest.set_params(n_jobs=None)
+    return forest, scaler
+
+
+def grow(forest, scaler, X, y, add_trees, n_jobs=-1):
+    """
+    Дообучение через warm start: к уже обученному лесу добавляется add_trees новых деревьев,
+    обученных на X, y (например, только на новых неделях чарта). Старые деревья не пересчитываются.
+    Скейлер остается старым - на нем обучены старые деревья.
+
+    :param forest:          обученный RandomForestClassifier
+    :param scaler:          его StandardScaler
+    :param X:               np.ndarray из features.encode
+    :param y:               np.ndarray меток
+    :param add_trees:       int / сколько деревьев добавить
+    :param n_jobs:          int / сколько ядер использовать, -1 - все
+    :return:                тот же forest
+    """
+
+    matrix = features.preprocess(X.copy(), scaler)
+    forest.set_params(warm_start=True, n_estimators=len(forest.estimators_) + add_trees, n_jobs=n_jobs)
+    forest.fit(matrix, y)
+    forest.set_params(warm_start=False, n_jobs=None)
+    return forest
+
+
+def _models_paths(extended):
+    if extended:
+        return predictor.EXTENDED_FOREST_PATH, predictor.EXTENDED_SCALER_PATH
+    return predictor.FOREST_PATH, predictor.SCALER_PATH
+
+
+def load_models(extended=False):
+    """
+    :param extended:    bool / расширенная модель с признаками исполнителя
+    :return:            (forest, scaler) из pickle, в которые сохраняет save_models
+    """
+
+    forest_path, scaler_path = _models_paths(extended)
+    with open(forest_path, 'rb') as file:
+        forest = pickle.load(file)
+    with open(scaler_path, 'rb') as file:
+        scaler = pickle.load(file)
+    return forest, scaler
+
+
+def distill(forest, scaler, X, names):
+    """
+    Дистиллирует лес в модели бэкендов inference (logistic, gbt и т.д.) на всей выборке
+
+    :param forest:      обученный RandomForestClassifier
+    :param scaler:      его StandardScaler
+    :param X:           np.ndarray из features.encode
+    :param names:       iterable имен бэкендов
+    :return:            словарь {name: модель} для save_models
+    """
+
+    matrix = features.preprocess(X.copy(), scaler)
+    return {name: inference.get_backend(name).build(forest, matrix) for name in names}
+
+
+def save_models(forest, scaler, extended=False, distilled=None):
+    """
+    Сохраняет модель туда, откуда ее грузит predictor. Файлы пишутся рядом во временные и подменяются
+    через os.replace под эксклюзивной predictor.models_swap_lock, поэтому запущенный бот (и все воркеры
+    scoring_pool) подхватят новую пару лес + скейлер целиком при следующей проверке, без перезапуска.
+    Если рядом лежит компактный .npy из forest_arrays, он тоже перевыгружается, иначе бот продолжил бы
+    работать на старом лесе из .npy. Расширенная модель (extended) сохраняется рядом с базовой,
+    бот использует ее, когда признаки исполнителя укладываются в бюджет, и базовую - когда нет.
+    Модели из distill() пишутся под той же блокировкой, чтобы ученик всегда соответствовал скейлеру.
+    """
+
+    forest_data = pickle.dumps(forest)
+    scaler_data = pickle.dumps(scaler)
+    forest_path, scaler_path = _models_paths(extended)
+
+    with predictor.models_swap_lock(exclusive=True):
+        for path, data in ((scaler_path, scaler_data), (forest_path, forest_data)):
+            with open(f'{path}.tmp', 'wb') as file:
+                file.write(data)
+            os.replace(f'{path}.tmp', path)
+        if not extended and os.path.exists(predictor.FOREST_ARRAYS_PATH):
+            forest_arrays.export_forest(forest, predictor.FOREST_ARRAYS_PATH)
+        for name, model in (distilled or {}).items():
+            inference.get_backend(name).save(model, predictor._model_path(name))
+
+    return len(forest_data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сборка обучающей выборки из истории чартов и переобучение модели')
+    parser.add_argument('chart', help='CSV с колонками week и track_id или artist, title')
+    parser.add_argument('--data-dir', default=DATA_DIR, help='каталог для кэшей этапов')
+    parser.add_argument('--negatives-per-year', type=int, default=NEGATIVES_PER_YEAR)
+    parser.add_argument('--n-estimators', type=int, default=100)
+    parser.add_argument('--n-jobs', type=int, default=-1, help='сколько ядер использовать, -1 - все')
+    parser.add_argument('--add-trees', type=int, default=0,
+                        help='не обучать заново, а добавить столько деревьев к текущей модели (warm start)')
+    parser.add_argument('--since', help='для --add-trees: учить новые деревья только на хитах с этой недели')
+    parser.add_argument('--dataset-only', action='store_true', help='только собрать выборку, не обучать')
+    parser.add_argument('--artists', action='store_true',
+                        help='расширенная модель с признаками исполнителя (подписчики, популярность)')
+    parser.add_argument('--distill', default='',
+                        help='через запятую бэкенды inference, в которые дистиллировать новый лес (logistic, gbt)')
+    args = parser.parse_args()
+    if args.artists and args.distill:
+        parser.error('--distill нельзя вместе с --artists: ученики дистиллируются только из базовой модели')
+
+    X, y, first_week = build_dataset(args.chart, args.data_dir, args.negatives_per_year, args.artists)
+    if args.dataset_only:
+        return
+
+    if args.add_trees:
+        forest, scaler = load_models(args.artists)
+
+    started = time.perf_counter()
+    rss_before = _peak_rss_mb()
+    if args.add_trees:
+        # Новые деревья учатся на свежих хитах, а X остается полным - на нем дистиллируются ученики
+        X_new, y_new = X, y
+        if args.since:
+            rows = (y == 0) | (first_week >= args.since)
+            X_new, y_new = X[rows], y[rows]
+        trees_before = len(forest.estimators_)
+        forest = grow(forest, scaler, X_new, y_new, args.add_trees, args.n_jobs)
+        print(f'Grown {trees_before} -> {len(forest.estimators_)} trees on {len(y_new)} tracks', end='')
+    else:
+        forest, scaler = train(X, y, args.n_estimators, n_jobs=args.n_jobs)
+        print(f'Trained {len(forest.estimators_)} trees on {len(y)} tracks', end='')
+    print(f' in {time.perf_counter() - started:.1f}s, '
+          f'peak RSS {_peak_rss_mb():.0f} MB (+{_peak_rss_mb() - rss_before:.0f} MB during fit)')
+
+    # Бэкенд, на котором работает бот, пересобирается вместе с базовым лесом, иначе он остался бы учеником
+    # старого леса. Расширенная модель базовый лес не меняет, и ученик базовой модели остается актуальным
+    names = {name for name in args.distill.split(',') if name}
+    if (not args.artists and predictor.INFERENCE_BACKEND
+            and inference.get_backend(predictor.INFERENCE_BACKEND).distilled):
+        names.add(predictor.INFERENCE_BACKEND)
+    distilled = distill(forest, scaler, X, sorted(names)) if names else None
+
+    size = save_models(forest, scaler, args.artists, distilled)
+    forest_path, scaler_path = _models_paths(args.artists)
+    print(f'Saved {forest_path} ({size / 1024 / 1024:.1f} MB), {scaler_path}')
+    for name in distilled or {}:
+        print(f'Saved {predictor._model_path(name)}')
+
+
+if __name__ == '__main__':
+    main()